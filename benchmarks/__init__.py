@@ -0,0 +1,88 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Benchmarks for Friendly.
+
+Each module is a script that prints its results; run them from the
+top of the source tree, for example::
+
+    python -m benchmarks.memory
+"""
+
+import os, resource, sys, time
+
+
+def best(function, repeat=5):
+    """
+    Return the shortest time, in seconds, that C{function} took over
+    C{repeat} calls.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def maxRSS():
+    """
+    Return the peak resident set size of the process, in bytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def inChild(function, *args):
+    """
+    Call C{function} in a child process and return the peak resident
+    set size it grew by, in bytes, so that measurements do not see
+    memory left behind by each other.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = maxRSS()
+        function(*args)
+        os.write(write, str(maxRSS() - before))
+        os._exit(0)
+    os.close(write)
+    result = os.read(read, 64)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return int(result)
+
+
+def report(rows):
+    """
+    Print C{rows} of C{(label, value)} pairs.
+    """
+    width = max(len(label) for label, value in rows)
+    for label, value in rows:
+        print '%-*s  %s' % (width, label, value)
@@ -0,0 +1,89 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Cost of authenticating an incoming peer against the number of
+contacts: the pinned fingerprint of the certificate presented is
+looked up in the certificate index, as the verify callback of the
+TLS context does, and compared with a scan of all contacts.
+"""
+
+import os
+
+from OpenSSL import crypto
+from twisted.internet.ssl import KeyPair
+
+from friendly.core.model import Account, Contact
+from friendly.core.peer import (CertificateIndex, verifyFingerprint,
+                                PIN_DIGEST)
+from benchmarks import best, report
+
+
+COUNTS = (100, 1000, 10000, 100000)
+HANDSHAKES = 1000
+
+
+def main():
+    cert = KeyPair.generate(size=1024).selfSignedCert(1, CN=u"peer")
+    der = cert.dump()
+    rows = [('handshakes', HANDSHAKES)]
+    for count in COUNTS:
+        account = Account(u"benchmark")
+        contacts = [Contact(u"Contact %d" % (i,), None,
+                            certBytes=os.urandom(600))
+                    for i in xrange(count - 1)]
+        contacts.append(Contact(u"Peer", None, certBytes=der))
+        account.addContacts(contacts)
+        index = CertificateIndex()
+        index.addAccount(account)
+        verify = verifyFingerprint(
+            lambda fingerprint: index.lookup(fingerprint, account))
+        # every handshake presents a new certificate object.
+        presented = [crypto.load_certificate(crypto.FILETYPE_ASN1, der)
+                     for i in range(HANDSHAKES)]
+
+        def indexed():
+            for x509 in presented:
+                assert verify(None, x509, 0, 0, 0)
+
+        def scan():
+            for x509 in presented:
+                fingerprint = x509.digest(PIN_DIGEST)
+                for contact in account.contacts:
+                    if contact.fingerprint(PIN_DIGEST) == fingerprint:
+                        break
+                else:
+                    raise AssertionError()
+
+        rows.append(('%d contacts, index, us/handshake' % (count,),
+                     '%.1f' % (best(indexed, 1) * 1e6 / HANDSHAKES,)))
+        if count <= 10000:
+            rows.append(('%d contacts, scan, us/handshake' % (count,),
+                         '%.1f' % (best(scan, 1) * 1e6 / HANDSHAKES,)))
+    report(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Cost of loading accounts with 10,000 contacts from the store, with
+the certificates of the contacts loaded lazily as they are now, and
+with every certificate loaded and parsed up front as before.  Also
+counts the certificates that the certificate index used to
+authenticate peers made the lazy load read.
+
+Usage::
+
+    python -m benchmarks.certificates [contacts]
+"""
+
+import os, sys, shutil, tempfile, time
+
+from benchmarks import inChild, report
+from benchmarks.startup import prepare, ACCOUNTS, CONTACTS, PASSPHRASE
+
+
+def load(directory, eager=False):
+    """
+    Load the accounts in C{directory}, parsing the certificates of all
+    contacts if C{eager}.
+    """
+    from friendly.core.sqlstore import SQLiteAccountStore
+    store = SQLiteAccountStore(os.path.join(directory, 'accounts.sqlite'),
+                               passphrase=PASSPHRASE)
+    accounts = store.load()
+    if eager:
+        for account in accounts:
+            for contact in account.contacts:
+                contact.cert
+    store.close()
+    return accounts
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def main(contacts=CONTACTS):
+    from friendly.core.peer import CertificateIndex
+    directory = tempfile.mkdtemp()
+    try:
+        inChild(prepare, directory, ACCOUNTS, contacts)
+        # warm up the page cache and the imports.
+        load(directory)
+        lazy, accounts = timed(load, directory)
+        eager, _ = timed(load, directory, True)
+        index = CertificateIndex()
+        for account in accounts:
+            index.addAccount(account)
+        read = sum(contact._certBytes is not None
+                   for account in accounts for contact in account.contacts)
+        report([
+                ('contacts', contacts),
+                ('lazy, ms', '%.1f' % (lazy * 1e3,)),
+                ('lazy, RSS growth, kB',
+                 inChild(load, directory) // 1024),
+                ('eager, ms', '%.1f' % (eager * 1e3,)),
+                ('eager, RSS growth, kB',
+                 inChild(load, directory, True) // 1024),
+                ('certificates read for the index', read),
+                ])
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
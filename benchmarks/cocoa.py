@@ -0,0 +1,154 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Stand-ins for the Cocoa modules, so that the application controller
+can be imported and driven headless, on systems without PyObjC.
+
+Only what startup needs behaves like the real thing: classes derived
+from C{NSObject} can be allocated and initialized, C{NSMutableArray}
+is a list, and every other Cocoa name is a class whose methods do
+nothing.
+"""
+
+import re, sys, os, types
+
+
+COCOA_MODULES = ('Foundation', 'AppKit', 'BWToolkitFramework',
+                 'MGScopeBar', 'Automator')
+
+
+def _nothing(*args, **kwargs):
+    return None
+
+
+def _stub(*args, **kwargs):
+    return StubObject()
+
+
+class StubObject(object):
+    """
+    Base of the stand-in Cocoa classes.  Methods that are not defined
+    do nothing and return another stand-in object.
+    """
+
+    @classmethod
+    def alloc(cls):
+        return cls.__new__(cls)
+
+    def init(self):
+        return self
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _stub
+
+
+class _StubMeta(type):
+    def __getattr__(cls, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _stub
+
+
+class NSMutableArray(list):
+    @classmethod
+    def alloc(cls):
+        return cls()
+
+    def initWithArray_(self, items):
+        self.extend(items)
+        return self
+
+    def addObject_(self, item):
+        self.append(item)
+
+    def removeObject_(self, item):
+        self.remove(item)
+
+
+class StubModule(types.ModuleType):
+    """
+    A module in which every public name is defined, as a stand-in
+    class.
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = _StubMeta(name, (StubObject,), {})
+        setattr(self, name, value)
+        return value
+
+
+def _identity(function, *args, **kwargs):
+    return function
+
+
+def objcModule():
+    objc = StubModule('objc')
+    objc.IBAction = _identity
+    objc.IBOutlet = _nothing
+    objc.ivar = _nothing
+    objc.selector = _identity
+    objc.python_method = _identity
+    objc.accessor = _identity
+    objc.signature = lambda signature, **kwargs: _identity
+    return objc
+
+
+def cocoaNames(directory):
+    """
+    Return the Cocoa names used by the Python modules in
+    C{directory}, so that star imports of the stand-in modules define
+    them.
+    """
+    names = set()
+    for path, directories, files in os.walk(directory):
+        for name in files:
+            if name.endswith('.py'):
+                source = open(os.path.join(path, name)).read()
+                names.update(re.findall(r'\b(?:NS|MG)[A-Z]\w*', source))
+    return names
+
+
+def install(directory):
+    """
+    Install the stand-in Cocoa modules, defining the names used by
+    the modules in C{directory}.
+    """
+    classes = dict((name, _StubMeta(name, (StubObject,), {}))
+                   for name in cocoaNames(directory))
+    classes['NSMutableArray'] = NSMutableArray
+    for name in COCOA_MODULES:
+        module = StubModule(name)
+        module.__dict__.update(classes)
+        sys.modules[name] = module
+    sys.modules['objc'] = objcModule()
+    helpers = StubModule('PyObjCTools')
+    helpers.AppHelper = StubModule('PyObjCTools.AppHelper')
+    sys.modules['PyObjCTools'] = helpers
+    sys.modules['PyObjCTools.AppHelper'] = helpers.AppHelper
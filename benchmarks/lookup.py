@@ -0,0 +1,95 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Cost of looking up a contact of an account by email address and by
+certificate fingerprint, in the indexes of the account and with a
+scan of its contacts.
+"""
+
+import os, random
+
+from friendly.core.model import Account, Contact, normalizeEmail
+from benchmarks import best, report
+
+
+COUNTS = (100, 1000, 10000, 100000)
+LOOKUPS = 1000
+
+
+def main():
+    rows = [('lookups', LOOKUPS)]
+    for count in COUNTS:
+        account = Account(u"benchmark")
+        account.addContacts([Contact(u"Contact %d" % (i,),
+                                     u"Contact.%d@Example.com" % (i,),
+                                     certBytes=os.urandom(600))
+                             for i in xrange(count)])
+        wanted = random.sample(account.contacts, min(count, LOOKUPS))
+        wanted = (wanted * LOOKUPS)[:LOOKUPS]
+        emails = [contact.email.lower() for contact in wanted]
+        fingerprints = [contact.fingerprint() for contact in wanted]
+
+        def indexedEmail():
+            for email in emails:
+                assert account.contactWithEmail(email) is not None
+
+        def indexedFingerprint():
+            for fingerprint in fingerprints:
+                assert (account.contactWithFingerprint(fingerprint)
+                        is not None)
+
+        def scanEmail():
+            for email in emails:
+                email = normalizeEmail(email)
+                for contact in account.contacts:
+                    if normalizeEmail(contact.email) == email:
+                        break
+                else:
+                    raise AssertionError()
+
+        def scanFingerprint():
+            for fingerprint in fingerprints:
+                for contact in account.contacts:
+                    if contact.fingerprint() == fingerprint:
+                        break
+                else:
+                    raise AssertionError()
+
+        for label, function, scan in (
+            ('email, index', indexedEmail, False),
+            ('email, scan', scanEmail, True),
+            ('fingerprint, index', indexedFingerprint, False),
+            ('fingerprint, scan', scanFingerprint, True)):
+            if scan and count > 10000:
+                continue
+            rows.append(('%d contacts, %s, us/lookup' % (count, label),
+                         '%.2f' % (best(function, 3) * 1e6 / LOOKUPS,)))
+    report(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Memory used by 100,000 contacts, as compact core records and as
+records with a dictionary of attributes each, like the contacts that
+were full objects with instance variables.
+
+PyObjC is not needed: the wrappers of the Cocoa layer are only created
+for the rows the user interface asks for, so they are left out.
+"""
+
+from friendly.core.model import Account, Contact
+from benchmarks import inChild, report
+
+
+COUNT = 100000
+
+
+class DictContact(object):
+    """
+    A contact record with an attribute dictionary.
+    """
+
+    def __init__(self, name, email, certBytes=None):
+        self.name = name
+        self.email = email
+        self.status = 1
+        self.account = None
+        self.endpoint = None
+        self.cert = None
+        self.certBytes = certBytes
+
+
+def build(factory, count):
+    certBytes = 'x' * 600
+    return [factory(u"Contact %d" % (i,), u"contact%d@example.com" % (i,),
+                    certBytes)
+            for i in xrange(count)]
+
+
+def buildAccount(count):
+    account = Account(u"benchmark")
+    account.addContacts(build(Contact, count))
+
+
+def main(count=COUNT):
+    compact = inChild(build, Contact, count)
+    dictionary = inChild(build, DictContact, count)
+    indexed = inChild(buildAccount, count)
+    report([
+        ('contacts', count),
+        ('compact records, bytes/contact', compact // count),
+        ('dictionary records, bytes/contact', dictionary // count),
+        ('compact records in an account, bytes/contact', indexed // count),
+        ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Cost of dialing a contact over the loopback interface with a full TLS
+handshake, and when the session of the last connection is resumed.
+Every dial waits for the first answer, as L{PeerConnectionManager}
+does before it trusts a connection.
+"""
+
+import time
+
+from twisted.internet import defer, task, reactor
+from twisted.internet.ssl import KeyPair
+
+from friendly.core.model import Account, Contact
+from friendly.core.peer import (CertificateIndex, PeerConnectionManager,
+                                Ping)
+from benchmarks import report
+
+
+DIALS = 200
+KEY_SIZE = 2048
+
+
+def makeAccount(name):
+    cert = KeyPair.generate(size=KEY_SIZE).selfSignedCert(1, CN=name)
+    return Account(name, cert)
+
+
+@defer.inlineCallbacks
+def dial(manager, contact, resume):
+    """
+    Dial C{contact} C{DIALS} times and return the mean time a dial
+    took, in seconds.
+    """
+    elapsed = 0
+    for i in range(DIALS):
+        if not resume:
+            manager.sessions.discard(contact)
+        start = time.time()
+        connection = yield manager.connect(contact)
+        yield connection.callRemote(Ping)
+        elapsed += time.time() - start
+        connection.transport.loseConnection()
+        while manager.connections:
+            yield task.deferLater(reactor, 0.001, lambda: None)
+    defer.returnValue(elapsed / DIALS)
+
+
+@defer.inlineCallbacks
+def run(rows):
+    alice = makeAccount(u"alice")
+    bob = makeAccount(u"bob")
+    bobOfAlice = Contact(u"Bob", None, certBytes=bob.cert.dump())
+    alice.addContact(bobOfAlice)
+    bob.addContact(Contact(u"Alice", None, certBytes=alice.cert.dump()))
+    index = CertificateIndex()
+    dialing = PeerConnectionManager(alice, index=index)
+    listening = PeerConnectionManager(bob, index=index)
+    port = listening.listen(0, interface='127.0.0.1')
+    bobOfAlice.endpoint = ('127.0.0.1', port.getHost().port)
+    try:
+        full = yield dial(dialing, bobOfAlice, False)
+        sessions = dialing.sessions
+        fullCounts = (sessions.full, sessions.resumed)
+        resumed = yield dial(dialing, bobOfAlice, True)
+        resumedCounts = (sessions.full - fullCounts[0],
+                         sessions.resumed - fullCounts[1])
+        rows.extend([
+                ('dials', DIALS),
+                ('key size', KEY_SIZE),
+                ('full handshake, ms/dial', '%.2f' % (full * 1e3,)),
+                ('  full, resumed', '%d, %d' % fullCounts),
+                ('resumed session, ms/dial', '%.2f' % (resumed * 1e3,)),
+                ('  full, resumed', '%d, %d' % resumedCounts),
+                ])
+    finally:
+        dialing.stop()
+        listening.stop()
+
+
+def main():
+    rows = []
+    d = run(rows)
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    report(rows)
+
+
+if __name__ == '__main__':
+    main()
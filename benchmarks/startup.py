@@ -0,0 +1,125 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Headless startup of the application, with stand-ins for the Cocoa
+modules: the phases recorded by the startup timeline, up to the first
+window, for accounts with 10,000 contacts in all.  Also lists the
+modules of the application that were imported, to check that those
+of the other windows are left for later.
+
+Usage::
+
+    python -m benchmarks.startup [contacts]
+"""
+
+import os, sys, shutil, tempfile
+
+from benchmarks import inChild, cocoa
+
+
+ACCOUNTS = 2
+CONTACTS = 10000
+# stands in for the passphrase kept in the keychain.
+PASSPHRASE = 'benchmark'
+
+
+def prepare(directory, accounts, contacts):
+    """
+    Create the database of C{accounts} accounts with C{contacts}
+    contacts in all, in C{directory}.
+    """
+    from twisted.internet.ssl import KeyPair
+    from friendly.core.model import Account, Contact
+    from friendly.core.sqlstore import SQLiteAccountStore
+    keyPair = KeyPair.generate(size=1024)
+    certBytes = keyPair.selfSignedCert(1, CN=u"contact").dump()
+    store = SQLiteAccountStore(os.path.join(directory, 'accounts.sqlite'),
+                               passphrase=PASSPHRASE)
+    for i in range(accounts):
+        account = Account(u"Account %d" % (i,),
+                          keyPair.selfSignedCert(i + 2, CN=u"account"))
+        account.addContacts([
+                Contact(u"Contact %d" % (j,), u"contact%d@example.com" % (j,),
+                        certBytes=certBytes)
+                for j in range(contacts // accounts)])
+        store.addAccount(account)
+    # write the queued statements without a running reactor.
+    store._write(store.writer.pending)
+    store.close()
+
+
+def start(directory):
+    """
+    Go through the startup of C{main.py} and the application
+    controller, up to the first window.
+    """
+    from friendly.timeline import startupTimeline as timeline
+    timeline.enabled = True
+
+    timeline.begin('reactor install')
+    from twisted.internet._threadedselect import install
+    install()
+    timeline.end('reactor install')
+
+    timeline.begin('import frameworks')
+    import BWToolkitFramework, Foundation, AppKit, MGScopeBar, objc
+    from PyObjCTools import AppHelper
+    timeline.end('import frameworks')
+
+    from friendly import keychain
+    keychain.passphraseFor = lambda service, account: PASSPHRASE
+
+    timeline.begin('import friendly')
+    from friendly import app, master
+    timeline.end('import friendly')
+
+    controller = app.FriendlyAppController.alloc().init()
+    controller.cachedAppSupportFolder = directory
+    controller.applicationWillFinishLaunching_(None)
+    return timeline, controller
+
+
+def main(contacts=CONTACTS):
+    directory = tempfile.mkdtemp()
+    try:
+        inChild(prepare, directory, ACCOUNTS, contacts)
+        cocoa.install(os.path.join(os.path.dirname(cocoa.__file__),
+                                   os.pardir, 'friendly'))
+        timeline, controller = start(directory)
+        print timeline.format()
+        print
+        print '%d contacts loaded' % (controller.countOfContacts(),)
+        print 'modules imported:'
+        for name in sorted(sys.modules):
+            if (name.startswith('friendly.')
+                and sys.modules[name] is not None):
+                print '   ', name
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,8 +1,10 @@
 from Foundation import *
 from AppKit import *
 import random
-from twisted.internet import ssl
+from twisted.python import log
 from friendly.model import Account
+from friendly.keygen import keyPairPool
+from friendly.core.peer import PEER_PORT
 
 
 class CreateAccountModel(NSObject):
@@ -16,7 +18,7 @@ class CreateAccountModel(NSObject):
         self.fullName = ""
         self.email = ""
         self.displayName = "New Account"
-        self.listenPort = 1232
+        self.listenPort = PEER_PORT
         self.usePortMapper = False
         self.useExistingIdentity = False
         return self
@@ -34,6 +36,8 @@ class CreateAccountController(NSWindowController):
         self = NSWindowController.initWithWindowNibName_owner_(
             self, "CreateAccount", self)
         self.app = app
+        # have a key pair ready by the time the user is done
+        keyPairPool.fill()
         return self
         
     def addAnnounceEntry_(self, sender):
@@ -70,8 +74,15 @@ class CreateAccountController(NSWindowController):
                 emailAddress = self.model.email
             sslopt['emailAddress'] = emailAddress
         serialNumber = 1
-        cert = ssl.KeyPair.generate().selfSignedCert(serialNumber,
-                                                     **sslopt)
+        d = keyPairPool.get()
+        d.addCallback(self.cbKeyPair, serialNumber, sslopt)
+        d.addErrback(self.ebKeyPair)
+
+    def cbKeyPair(self, keyPair, serialNumber, sslopt):
+        """
+        Create the account once a key pair is available.
+        """
+        cert = keyPair.selfSignedCert(serialNumber, **sslopt)
         print 'SSL certificate generated:'
         print cert.inspect()
 
@@ -79,8 +90,17 @@ class CreateAccountController(NSWindowController):
         account = Account.alloc().initWithName_andCert_(
             self.model.displayName, cert
             )
+        account.core.announceList = [entry['url']
+                                     for entry in self.model.announceList
+                                     if entry.get('url')]
+        account.core.listenPort = self.app.unusedListenPort(
+            self.model.listenPort)
         self.app.addAccount_(account)
+        self.app.peerManagerForAccount(account.core)
         self.close()
+
+    def ebKeyPair(self, failure):
+        log.err(failure, "cannot create account")
         
     def openIdentityFile_(self, sender):
         pass
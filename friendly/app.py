@@ -25,12 +25,18 @@
 from Foundation import *
 from AppKit import *
 
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
+from twisted.internet.error import CannotListenError
 
 from friendly.utils import selector, initWithSuper
-from friendly.account import CreateAccountController
-from friendly.contacts import (ImportContactsController,
-                               ContactListController)
+from friendly.timeline import startupTimeline
+from friendly.keychain import passphraseFor, KeychainError
+# the model classes must be known before accounts are unarchived.
+from friendly import model
+from friendly.core.sqlstore import SQLiteAccountStore
+from friendly.core.store import PassphraseError
+from friendly.core.search import ContactIndex
+from friendly.core.presence import StatusAggregator
 
 from os.path import expanduser
 import objc, os
@@ -47,11 +53,19 @@ class FriendlyAppController(NSObject):
     importContactsController = None
     cachedAppSupportFolder = None
     contactListController = None
+    store = None
+    endpoints = None
 
     
     @initWithSuper
     def init(self):
         self.accounts = []
+        self._contacts = []
+        self._positions = None
+        self.searchIndex = ContactIndex()
+        self.statusUpdates = StatusAggregator(self.contactStatusesChanged)
+        self.peers = dict()
+        self.announcers = dict()
 
     # torrent/bundle handling:
 
@@ -125,16 +139,55 @@ class FriendlyAppController(NSObject):
 
     def saveAccounts(self):
         """
-        Save accounts to the persistent store.
+        Request that changes to the accounts are saved to the
+        persistent store.
+
+        Changes are written behind, in batches, so this returns
+        before they are on disk.
         """
-        print "save accounts"
-        x = NSKeyedArchiver.archiveRootObject_toFile_(
-            self.accounts,
-            os.path.join(self.applicationSupportFolder(), 'accounts.keyarch')
-            )
-        print "x is ", x
-        print self.accounts
-        
+        self.store.commit()
+
+    def loadAccounts(self):
+        """
+        Load accounts from the persistent store, migrating them from
+        the keyed archive of earlier versions if needed.
+
+        The archive is only renamed once its accounts are written, so
+        it is migrated for as long as it is there and the store has no
+        accounts; a migration that did not complete is done again.
+        """
+        supportFolder = self.applicationSupportFolder()
+        path = os.path.join(supportFolder, 'accounts.sqlite')
+        archivePath = os.path.join(supportFolder, 'accounts.keyarch')
+        try:
+            self.store = SQLiteAccountStore(
+                path, passphrase=passphraseFor("Friendly", path))
+            accounts = [model.Account.alloc().initWithAccount_(account)
+                        for account in self.store.load()]
+            migrate = not accounts and os.path.exists(archivePath)
+        except (KeychainError, PassphraseError), e:
+            # run without the accounts rather than risk overwriting
+            # them; nothing of this session is saved.
+            NSRunAlertPanel(
+                "Cannot open your accounts",
+                "Your accounts could not be unlocked (%@).  Friendly "
+                "will run without them, and changes will not be saved.",
+                "OK", None, None, str(e) or e.__class__.__name__)
+            self.store = SQLiteAccountStore(':memory:')
+            accounts = []
+            migrate = False
+        if migrate:
+            accounts = NSKeyedUnarchiver.unarchiveObjectWithFile_(
+                archivePath
+                )
+            if accounts is None:
+                accounts = []
+            for account in accounts:
+                self.store.addAccount(account.core)
+            d = self.store.flush()
+            d.addCallback(lambda _: os.rename(archivePath,
+                                              archivePath + '.migrated'))
+        self.accounts = NSMutableArray.alloc().initWithArray_(accounts)
 
     def addAccount_(self, account):
         """
@@ -142,31 +195,253 @@ class FriendlyAppController(NSObject):
         """
         self.willChangeValueForKey_('accounts')
         self.accounts.addObject_(account)
-        self.didChangeValueForKey_('account')
-        self.saveAccounts()
-        # tell everyone that contacts also changed
+        self.didChangeValueForKey_('accounts')
+        self.store.addAccount(account.core)
+        self._insertContacts_ofAccount_atIndexes_(
+            account.core.contacts, account,
+            NSIndexSet.indexSetWithIndexesInRange_(
+                (0, len(account.core.contacts))
+                )
+            )
+        self._observeAccount_(account)
+
+    def removeAccount_(self, account):
+        """
+        Remove account.
+        """
+        self._removeContactsOfAccount_atIndexes_(
+            account, NSIndexSet.indexSetWithIndexesInRange_(
+                (0, len(account.core.contacts))
+                )
+            )
+        account.removeObserver_forKeyPath_(self, 'contacts')
+        self.searchIndex.removeAccount(account.core)
+        manager = self.peers.pop(account.core, None)
+        if manager is not None:
+            manager.stop()
+        announcer = self.announcers.pop(account.core, None)
+        if announcer is not None:
+            announcer.stop()
+        self.willChangeValueForKey_('accounts')
+        self.accounts.removeObject_(account)
+        self.didChangeValueForKey_('accounts')
+        self.store.removeAccount(account.core)
+
+    def _observeAccount_(self, account):
+        """
+        Start observing changes to the contacts of C{account}.
+        """
+        account.addObserver_forKeyPath_options_context_(
+            self, 'contacts', 0, None
+            )
+        self.searchIndex.addAccount(account.core)
+
+    def _offsetOfAccount_(self, account):
+        """
+        Return the index in the aggregate contact list where the
+        contacts of C{account} start.
+        """
+        offset = 0
+        for other in self.accounts:
+            if other is account:
+                break
+            offset += len(other.core.contacts)
+        return offset
+
+    def _aggregateIndexes_ofAccount_(self, indexes, account):
+        """
+        Translate C{indexes} into the contacts of C{account} to
+        indexes in the aggregate contact list.
+        """
+        aggregateIndexes = indexes.mutableCopy()
+        aggregateIndexes.shiftIndexesStartingAtIndex_by_(
+            0, self._offsetOfAccount_(account)
+            )
+        return aggregateIndexes
+
+    def _insertContacts_ofAccount_atIndexes_(self, contacts, account,
+                                             indexes):
+        if not indexes.count():
+            return
+        indexes = self._aggregateIndexes_ofAccount_(indexes, account)
+        self.willChange_valuesAtIndexes_forKey_(
+            NSKeyValueChangeInsertion, indexes, 'contacts'
+            )
+        for index, contact in zip(model.indexList(indexes), contacts):
+            self._contacts.insert(index, contact)
+        self._positions = None
+        self.didChange_valuesAtIndexes_forKey_(
+            NSKeyValueChangeInsertion, indexes, 'contacts'
+            )
+
+    def _removeContactsOfAccount_atIndexes_(self, account, indexes):
+        if not indexes.count():
+            return
+        indexes = self._aggregateIndexes_ofAccount_(indexes, account)
+        self.willChange_valuesAtIndexes_forKey_(
+            NSKeyValueChangeRemoval, indexes, 'contacts'
+            )
+        for index in reversed(model.indexList(indexes)):
+            del self._contacts[index]
+        self._positions = None
+        self.didChange_valuesAtIndexes_forKey_(
+            NSKeyValueChangeRemoval, indexes, 'contacts'
+            )
+
+    def observeValueForKeyPath_ofObject_change_context_(self, keyPath,
+                                                        account, change,
+                                                        context):
+        """
+        Keep the aggregate contact list in sync with the contacts of
+        the accounts.
+        """
+        kind = change[NSKeyValueChangeKindKey]
+        indexes = change.get(NSKeyValueChangeIndexesKey)
+        if indexes is None:
+            # the contact list was replaced wholesale.
+            self._rebuildContacts()
+        elif kind == NSKeyValueChangeInsertion:
+            self._insertContacts_ofAccount_atIndexes_(
+                [account.core.contacts[index]
+                 for index in model.indexList(indexes)],
+                account, indexes
+                )
+        elif kind == NSKeyValueChangeRemoval:
+            self._removeContactsOfAccount_atIndexes_(account, indexes)
+        else:
+            self._rebuildContacts()
+
+    def _rebuildContacts(self):
+        """
+        Rebuild the aggregate contact list from scratch.
+        """
         self.willChangeValueForKey_('contacts')
+        self._contacts = []
+        for account in self.accounts:
+            self._contacts.extend(account.core.contacts)
+        self._positions = None
         self.didChangeValueForKey_('contacts')
 
-    @objc.accessor
-    def contacts(self):
+    def peerManagerForAccount(self, account):
+        """
+        Return the manager of the connections between core account
+        C{account} and its contacts, listening for contacts on a port
+        of its own and announcing it to the trackers of the account.
+        """
+        manager = self.peers.get(account)
+        if manager is None:
+            # loaded with the first account to connect, not at startup.
+            from friendly.core.peer import (PeerConnectionManager,
+                                            PeerError, PEER_PORT)
+            from friendly.core.announce import (AnnounceClient,
+                                                AccountAnnouncer)
+            manager = PeerConnectionManager(
+                account, resolve=self.endpoints.resolve,
+                statusChanged=self.statusUpdates.setStatus,
+                reached=self.endpoints.reached
+                )
+            port = account.listenPort
+            if port is None or port in self._listenPorts():
+                port = self.unusedListenPort(port or PEER_PORT)
+                account.update(listenPort=port)
+            self.peers[account] = manager
+            try:
+                manager.listen(port)
+            except (CannotListenError, PeerError), e:
+                # nothing is announced for a port that is not listened on
+                NSLog("Cannot accept connections for %@: %@",
+                      account.displayName, str(e))
+                return manager
+            if account.announceList:
+                announcer = AccountAnnouncer(
+                    account, AnnounceClient(account.announceList, port),
+                    self.endpoints
+                    )
+                self.announcers[account] = announcer
+                announcer.start()
+        return manager
+
+    def _listenPorts(self):
+        return set(account.listenPort for account in self.peers)
+
+    def unusedListenPort(self, port=None):
+        """
+        Return C{port}, or the first port after it, that no account
+        accepts connections on.  C{port} defaults to the standard
+        port of peer connections.
+        """
+        if port is None:
+            from friendly.core.peer import PEER_PORT
+            port = PEER_PORT
+        taken = self._listenPorts()
+        while port in taken:
+            port += 1
+        return port
+
+    def _contactPositions(self):
+        """
+        Return a C{dict} mapping the contacts of the aggregate contact
+        list to their index.  It is only rebuilt after contacts were
+        inserted or removed.
+        """
+        if self._positions is None:
+            self._positions = dict((contact, index) for (index, contact)
+                                   in enumerate(self._contacts))
+        return self._positions
+
+    def contactStatusesChanged(self, statuses):
+        """
+        Apply a batch of status changes from the status aggregator,
+        with a single change notification for the aggregate contact
+        list.
+        """
+        positions = self._contactPositions()
+        indexes = NSMutableIndexSet.indexSet()
+        for contact, status in statuses.iteritems():
+            contact.status = status
+            if contact in positions:
+                indexes.addIndex_(positions[contact])
+        if indexes.count():
+            self.willChange_valuesAtIndexes_forKey_(
+                NSKeyValueChangeReplacement, indexes, 'contacts'
+                )
+            self.didChange_valuesAtIndexes_forKey_(
+                NSKeyValueChangeReplacement, indexes, 'contacts'
+                )
+        if self.contactListController is not None:
+            self.contactListController.contactStatusesChanged(statuses)
+
+    def contactEndpointChanged(self, contact, endpoint):
         """
+        Show the endpoint the endpoint directory found C{contact} at.
         """
-        contacts = list()
-        if self.accounts:
-            for account in self.accounts:
-                contacts.extend(account.contacts)
-        return contacts
+        wrapper = contact.wrapper
+        if wrapper is not None:
+            wrapper.willChangeValueForKey_('endpoint')
+        contact.endpoint = endpoint
+        if wrapper is not None:
+            wrapper.didChangeValueForKey_('endpoint')
+
+    # the aggregate contact list holds core contacts; wrappers are
+    # only created for the rows that are asked for, and are pinned
+    # since the array controller of the contact list keeps them.
+
+    def countOfContacts(self):
+        return len(self._contacts)
+
+    def objectInContactsAtIndex_(self, index):
+        return model.wrapperForContact(self._contacts[index], pin=True)
 
-    @objc.accessor
-    def setContacts_(self, contacts):
-        print "setContcts"
+    def contactsAtIndexes_(self, indexes):
+        return [model.wrapperForContact(self._contacts[index], pin=True)
+                for index in model.indexList(indexes)]
     
     @objc.IBAction
     def createAccount_(self, sender):
         """
         """
         if self.createAccountController is None:
+            from friendly.account import CreateAccountController
             self.createAccountController = \
                 CreateAccountController.alloc().initWithApp_(self)
         self.createAccountController.window().makeKeyAndOrderFront_(self)
@@ -174,6 +449,7 @@ class FriendlyAppController(NSObject):
     @objc.IBAction
     def importContacts_(self, sender):
         if self.importContactsController is None:
+            from friendly.contacts import ImportContactsController
             self.importContactsController = \
                 ImportContactsController.alloc().initWithApp_(self)
         self.importContactsController.window().makeKeyAndOrderFront_(self)
@@ -190,6 +466,7 @@ class FriendlyAppController(NSObject):
         """
         """
         if self.contactListController is None:
+            from friendly.contacts import ContactListController
             self.contactListController = \
                 ContactListController.alloc().initWithApp_(self)
         self.contactListController.window().makeKeyAndOrderFront_(self)
@@ -199,22 +476,19 @@ class FriendlyAppController(NSObject):
         """
         """
         # register defaults before anything else
+        startupTimeline.begin('defaults registration')
         defaultsController = NSUserDefaults.standardUserDefaults()
         defaultsController.registerDefaults_(standardDefaults)
+        startupTimeline.end('defaults registration')
 
         # load accounts:
-        self.accounts = NSKeyedUnarchiver.unarchiveObjectWithFile_(
-            os.path.join(self.applicationSupportFolder(), 'accounts.keyarch')
-            )
-        if self.accounts is None:
-            self.accounts = NSMutableArray.alloc().initWithCapacity_(0)
+        startupTimeline.begin('account load')
+        self.loadAccounts()
         for account in self.accounts:
-            for contact in account.contacts:
-                contact.account = account
-
-        self.setContacts_(None)
+            self._observeAccount_(account)
 
-        #self.didChangeValueForKey_('contacts')
+        self._rebuildContacts()
+        startupTimeline.end('account load')
     
     def applicationDidFinishLaunching_(self, sender):
         """
@@ -222,9 +496,30 @@ class FriendlyAppController(NSObject):
         loading.
         """
         NSLog("Application did finish launching.")
+        startupTimeline.end('first window')
+        from friendly.core.endpoints import EndpointDirectory
+        self.endpoints = EndpointDirectory(
+            os.path.join(self.applicationSupportFolder(), 'endpoints.json'),
+            endpointChanged=self.contactEndpointChanged
+            )
+        self.endpoints.load()
+        for account in self.accounts:
+            self.peerManagerForAccount(account.core)
+        if startupTimeline.enabled:
+            NSLog("Startup timeline:\n%@", startupTimeline.format())
 
     def applicationShouldTerminate_(self, sender):
+        self.statusUpdates.stop()
+        for manager in self.peers.values():
+            manager.stop()
+        for announcer in self.announcers.values():
+            announcer.stop()
         if reactor.running:
-            reactor.stop()
+            # write pending changes before the reactor goes away.
+            flushes = [self.store.flush()]
+            if self.endpoints is not None:
+                flushes.append(self.endpoints.flush())
+            d = defer.DeferredList(flushes)
+            d.addBoth(lambda _: reactor.stop())
             return False
         return True
@@ -3,9 +3,29 @@ from AppKit import *
 import random
 
 from zope.interface import Interface
-from twisted.plugin import getPlugins
 from friendly import plugins, ifriendly
-from friendly.model import Contact
+from friendly.registry import PluginRegistry
+from friendly.model import (Contact, normalizeEmail,
+                            certificateFingerprint, wrapperForContact)
+from friendly.core.search import SearchSession
+from friendly.core import model as core
+from friendly.core.endpoints import formatEndpoint
+from friendly.importer import MultiServiceImport, AllImportsFailed
+
+import os
+
+from twisted.python import log
+
+
+# title of the item of the service menu that imports from every
+# service the user entered credentials for.
+ALL_SERVICES = "All Services"
+
+importerRegistry = PluginRegistry(
+    ifriendly.IContactImporter, plugins,
+    os.path.expanduser('~/Library/Caches/Friendly/plugins.json'),
+    NSBundle.mainBundle().objectForInfoDictionaryKey_('CFBundleVersion')
+    )
 
 
 class ImportContactsController(NSWindowController):
@@ -14,6 +34,14 @@ class ImportContactsController(NSWindowController):
 
     The controller is responsible for a window where the user may add
     display names and email addresses of contacts.
+
+    Contacts can be imported from online services.  The username and
+    password fields show the credentials of the selected service, and
+    the credentials of each service are kept while the window is
+    open, so that contacts can be imported from all of them at once.
+
+    @ivar credentials: C{dict} mapping the descriptions of services to
+        C{(username, password)} tuples.
     """
     accountBox = objc.ivar('accountBox')
     contactTable = objc.ivar('contactTable')
@@ -41,72 +69,148 @@ class ImportContactsController(NSWindowController):
         self.disclosureTriangle.setState_(NSOffState)
         self.disclosurePressed_(self.disclosureTriangle)
         # get all contact importers.
-        self.importers = list(
-            getPlugins(ifriendly.IContactImporter, plugins)
-            )
+        self.importers = importerRegistry.getEntries()
+        self.credentials = dict()
         self.serviceBox.removeAllItems()
-        for importer in self.importers:
-            self.serviceBox.addItemWithTitle_(importer.description)
-        
+        for entry in self.importers:
+            self.serviceBox.addItemWithTitle_(entry.description)
+        if len(self.importers) > 1:
+            self.serviceBox.menu().addItem_(NSMenuItem.separatorItem())
+            self.serviceBox.addItemWithTitle_(ALL_SERVICES)
+        self.serviceBox.setTarget_(self)
+        self.serviceBox.setAction_(self.serviceChanged_)
+        self.shownService = None
+        self.serviceChanged_(self.serviceBox)
+
+
     @objc.IBAction
     def addContacts_(self, sender):
         """
         """
         account = self.accountController.selectedObjects()[0]
+        contacts = list()
+        seen = set()
         for description in self.arrayController.arrangedObjects():
             if not description['import']:
                 continue
             name = description['name']
             email = description['email']
-            if account.hasContactWithEmail_(email) or not len(email):
+            if not email or account.hasContactWithEmail_(email):
                 continue
-            contact = Contact.alloc().initWithName_andEmail_(
-                name, email
-                )
-            account.addContact_(contact)
-        self.app.saveAccounts()
+            key = normalizeEmail(email)
+            if key in seen:
+                continue
+            seen.add(key)
+            contacts.append(Contact.alloc().initWithName_andEmail_(
+                    name, email
+                    ))
+        if contacts:
+            account.addContacts_(contacts)
+            self.app.saveAccounts()
 
-    def _addContact(self, description):
+    def _addContacts(self, descriptions):
         """
-        Add a single description to the contact list.
+        Add descriptions to the contact list, with a single update of
+        the array controller.
 
-        @param description: C{dict} describing the contact.
+        @param descriptions: C{list} of C{dict}s describing the
+            contacts.
         """
-        insertedObject = self.arrayController.newObject()
-        insertedObject['import'] = True
-        insertedObject['name'] = description['name']
-        insertedObject['email'] = description['email']
-        row = self.contactTable.numberOfRows()
-        self.arrayController.insertObject_atArrangedObjectIndex_(
-            insertedObject, row
-            )
+        insertedObjects = list()
+        for description in descriptions:
+            insertedObject = self.arrayController.newObject()
+            insertedObject['import'] = True
+            insertedObject['name'] = description['name']
+            insertedObject['email'] = description['email']
+            insertedObjects.append(insertedObject)
+        if insertedObjects:
+            self.arrayController.addObjects_(insertedObjects)
     
-    def cbImporter(self, contacts):
+    def cbImporter(self, count):
         self.spinner.stopAnimation_(self)
-        for contact in contacts:
-            self._addContact(contact)
-        self.status("Imported %d contacts" % len(contacts))
+        self.status("Imported %d contacts" % count)
 
     def ebImporter(self, failure):
         self.status("Failed to import")
-        print failure
+        if not failure.check(AllImportsFailed):
+            # the import logs the failures of its sources itself.
+            log.err(failure, "contact import failed")
         self.spinner.stopAnimation_(self)
 
     def status(self, message):
         self.statusLabel.setHidden_(False)
         self.statusLabel.setStringValue_(message)
         
+    def _storeCredentials(self):
+        """
+        Remember the entered username and password for the service
+        they were entered for.
+        """
+        index = self.shownService
+        if index is not None and index < len(self.importers):
+            self.credentials[self.importers[index].description] = (
+                self.usernameInput.stringValue(),
+                self.passwordInput.stringValue()
+                )
+
     @objc.IBAction
-    def addContactsFromService_(self, sender):
-        importerIndex = self.serviceBox.indexOfSelectedItem()
-        importer = self.importers[importerIndex]
-        username = self.usernameInput.stringValue()
-        password = self.passwordInput.stringValue()
+    def serviceChanged_(self, sender):
+        """
+        Show the credentials of the selected service.  The fields are
+        disabled when all services are selected, since each of them
+        uses its own.
+        """
+        self._storeCredentials()
+        index = self.serviceBox.indexOfSelectedItem()
+        self.shownService = index
+        single = 0 <= index < len(self.importers)
+        username, password = u"", u""
+        if single:
+            username, password = self.credentials.get(
+                self.importers[index].description, (u"", u"")
+                )
+        self.usernameInput.setStringValue_(username)
+        self.passwordInput.setStringValue_(password)
+        self.usernameInput.setEnabled_(single)
+        self.passwordInput.setEnabled_(single)
+
+    def _importFrom(self, importers):
+        """
+        Import contacts from C{importers}, each using the credentials
+        entered for its service.  Services without credentials are
+        skipped.
+        """
+        self._storeCredentials()
+        sources = list()
+        for entry in importers:
+            username, password = self.credentials.get(entry.description,
+                                                      (u"", u""))
+            if username:
+                sources.append((entry.load(), username, password))
+        if not sources:
+            self.status("Enter a username and password first")
+            return
+        seen = [normalizeEmail(description.get('email'))
+                for description in self.arrayController.arrangedObjects()]
+        job = MultiServiceImport(sources, self._addContacts, self.status,
+                                 seen=seen)
         self.spinner.startAnimation_(self)
-        d = importer.importContacts(username, password, self.status)
+        d = job.start()
         d.addCallback(self.cbImporter)
         d.addErrback(self.ebImporter)
 
+    @objc.IBAction
+    def addContactsFromService_(self, sender):
+        importerIndex = self.serviceBox.indexOfSelectedItem()
+        if importerIndex < len(self.importers):
+            self._importFrom([self.importers[importerIndex]])
+        else:
+            self._importFrom(self.importers)
+
+    @objc.IBAction
+    def addContactsFromAllServices_(self, sender):
+        self._importFrom(self.importers)
+
     @objc.IBAction
     def addNewContact_(self, sender):
         """
@@ -145,7 +249,7 @@ class EndpointStringValueTransformer(NSValueTransformer):
 
     def transformedValue_(self, endpoint):
         if endpoint is not None:
-            return "XXX"
+            return formatEndpoint(tuple(endpoint))
         return None
 
 
@@ -155,44 +259,138 @@ class CertificateFingerprintValueTransformer(NSValueTransformer):
         return NSString
 
     def transformedValue_(self, cert):
-        if cert is not None:
-            return cert.digest()
-        return None
+        return certificateFingerprint(cert)
 
             
 class ContactStatusImageValueTransformer(NSValueTransformer):
+    """
+    Transforms the status of a contact into the image shown for it
+    in the contact list.
+    """
+    imageNames = {
+        core.OFFLINE: NSImageNameStatusUnavailable,
+        core.UNKNOWN: NSImageNameStatusNone,
+        core.CONNECTING: NSImageNameStatusPartiallyAvailable,
+        core.CONNECTED: 'status-connected',
+        }
 
     def init(self):
         self = NSValueTransformer.init(self)
-        self.connectedImage = None
+        self.images = dict()
         return self
         
     def transformedValueClass(self):
         return NSImage
 
     def transformedValue_(self, value):
-        if self.connectedImage is None:
-            self.connectedImage = NSImage.imageNamed_(
-                'status-connected'
-                )
-        return self.connectedImage
+        if value not in self.imageNames:
+            value = core.UNKNOWN
+        image = self.images.get(value)
+        if image is None:
+            image = NSImage.imageNamed_(self.imageNames[value])
+            self.images[value] = image
+        return image
         
 
         
 class ContactListController(NSWindowController):
+    """
+    Controller of the contact list window.
+
+    The list is filtered as the user types in the search field.  While
+    a search is active the array controller is bound to the matching
+    contacts, found through the search index of the application,
+    instead of to all contacts.
+    """
     app = objc.IBOutlet()
     arrayController = objc.IBOutlet()
+    searchField = objc.IBOutlet()
+    matches = objc.ivar('matches')
 
     def initWithApp_(self, app):
         self = NSWindowController.initWithWindowNibName_owner_(
             self, "ContactList", self)
         self.app = app
+        self.session = SearchSession(app.searchIndex)
+        self.matches = []
+        self.filtering = False
         return self
 
+    def windowDidLoad(self):
+        if self.searchField is None:
+            # the nib has no search field; put one in the top right
+            # corner of the window.
+            contentView = self.window().contentView()
+            bounds = contentView.bounds()
+            self.searchField = NSSearchField.alloc().initWithFrame_(
+                ((bounds.size.width - 220, bounds.size.height - 32),
+                 (200, 22))
+                )
+            self.searchField.setAutoresizingMask_(
+                NSViewMinXMargin | NSViewMinYMargin
+                )
+            contentView.addSubview_(self.searchField)
+        self.searchField.setTarget_(self)
+        self.searchField.setAction_(self.search_)
+        self.searchField.cell().setSendsSearchStringImmediately_(True)
+
+    def _bindContentTo_withKeyPath_(self, target, keyPath):
+        self.arrayController.unbind_('contentArray')
+        self.arrayController.bind_toObject_withKeyPath_options_(
+            'contentArray', target, keyPath, None
+            )
+
+    @objc.IBAction
+    def search_(self, sender):
+        """
+        Filter the contact list on the words in the search field.
+        """
+        results = self.session.search(sender.stringValue())
+        if results is None:
+            if self.filtering:
+                self.filtering = False
+                self._bindContentTo_withKeyPath_(self.app, 'contacts')
+            return
+        self.willChangeValueForKey_('matches')
+        self.matches = [wrapperForContact(contact, pin=True)
+                        for contact in results]
+        self.didChangeValueForKey_('matches')
+        if not self.filtering:
+            self.filtering = True
+            self._bindContentTo_withKeyPath_(self, 'matches')
+
+    def contactStatusesChanged(self, statuses):
+        """
+        Refresh the rows of the search results whose status changed.
+        """
+        if not self.filtering:
+            return
+        indexes = NSMutableIndexSet.indexSet()
+        for index, contact in enumerate(self.matches):
+            if contact.core in statuses:
+                indexes.addIndex_(index)
+        if indexes.count():
+            self.willChange_valuesAtIndexes_forKey_(
+                NSKeyValueChangeReplacement, indexes, 'matches'
+                )
+            self.didChange_valuesAtIndexes_forKey_(
+                NSKeyValueChangeReplacement, indexes, 'matches'
+                )
+
     @objc.IBAction
     def export_(self, sender):
         pass
 
     @objc.IBAction
     def connect_(self, sender):
-        pass
+        """
+        Connect to the selected contacts.
+        """
+        for contact in self.arrayController.selectedObjects():
+            manager = self.app.peerManagerForAccount(contact.core.account)
+            d = manager.connect(contact.core)
+            d.addErrback(self.ebConnect, contact)
+
+    def ebConnect(self, failure, contact):
+        NSLog("Cannot connect to %@: %@", contact.email,
+              failure.getErrorMessage())
@@ -0,0 +1,609 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Announcing accounts to trackers.
+
+Every account announces its presence, and looks up the presence of
+its contacts, under info-hashes derived from certificate fingerprints.
+Shared bundles can be announced under their own info-hashes.  All
+info-hashes are announced to each tracker in one batch, with the
+compact UDP tracker protocol where the tracker supports it and plain
+HTTP otherwise.  Each tracker is announced to on its own schedule,
+with its own backoff when it fails.
+"""
+
+import struct, random, time, urllib, hashlib
+from urlparse import urlparse
+
+from twisted.internet import defer, protocol, task
+from twisted.python import log
+from twisted.web.client import getPage
+
+from friendly.core.model import (INSERTED, REMOVED, UPDATED,
+                                 certificateFingerprint)
+
+
+# the UDP tracker protocol, see BEP 15.
+UDP_PROTOCOL_ID = 0x41727101980
+CONNECT, ANNOUNCE, SCRAPE, ERROR = range(4)
+NONE, COMPLETED, STARTED, STOPPED = range(4)
+
+eventNames = {NONE: None, COMPLETED: 'completed', STARTED: 'started',
+              STOPPED: 'stopped'}
+
+
+class AnnounceError(Exception):
+    """
+    A tracker failed to answer an announce.
+    """
+
+
+def presenceHash(fingerprint):
+    """
+    Return the info-hash an account with the certificate with the
+    given fingerprint announces its presence under.
+    """
+    return hashlib.sha1('friendly-presence:' + fingerprint).digest()
+
+
+def bdecode(data):
+    """
+    Decode the bencoded string C{data}.
+    """
+    def decode(index):
+        c = data[index]
+        if c == 'i':
+            end = data.index('e', index)
+            return int(data[index + 1:end]), end + 1
+        if c == 'l':
+            result, index = list(), index + 1
+            while data[index] != 'e':
+                value, index = decode(index)
+                result.append(value)
+            return result, index + 1
+        if c == 'd':
+            result, index = dict(), index + 1
+            while data[index] != 'e':
+                key, index = decode(index)
+                result[key], index = decode(index)
+            return result, index + 1
+        colon = data.index(':', index)
+        end = colon + 1 + int(data[index:colon])
+        return data[colon + 1:end], end
+    try:
+        value, end = decode(0)
+    except (IndexError, ValueError):
+        raise AnnounceError("malformed tracker response")
+    return value
+
+
+def compactPeers(data):
+    """
+    Return the C{(host, port)} tuples of a compact peer list.
+    """
+    peers = list()
+    for offset in range(0, len(data) - len(data) % 6, 6):
+        host = '.'.join([str(ord(c)) for c in data[offset:offset + 4]])
+        port, = struct.unpack('>H', data[offset + 4:offset + 6])
+        peers.append((host, port))
+    return peers
+
+
+class UDPTrackerProtocol(protocol.DatagramProtocol):
+    """
+    Client side of the UDP tracker protocol, shared by all trackers.
+
+    Connection ids are kept for a minute, as allowed by the protocol,
+    so a batch of announces costs a single extra round trip at most.
+    """
+    timeout = 15
+    connectionLifetime = 60
+
+    def __init__(self, reactor, clock=time.time):
+        self.reactor = reactor
+        self.clock = clock
+        self.pending = dict()
+        self.connections = dict()
+
+    def datagramReceived(self, data, address):
+        if len(data) < 8:
+            return
+        action, transactionId = struct.unpack('>II', data[:8])
+        entry = self.pending.pop(transactionId, None)
+        if entry is None:
+            return
+        d, timeout = entry
+        timeout.cancel()
+        if action == ERROR:
+            d.errback(AnnounceError(data[8:]))
+        else:
+            d.callback(data[8:])
+
+    def request(self, address, build):
+        """
+        Send the request C{build} returns for a new transaction id to
+        C{address}, and return a L{Deferred} that fires with the body
+        of the answer.
+        """
+        transactionId = random.getrandbits(32)
+        while transactionId in self.pending:
+            transactionId = random.getrandbits(32)
+        d = defer.Deferred()
+        timeout = self.reactor.callLater(self.timeout, self._timedOut,
+                                         transactionId, address)
+        self.pending[transactionId] = (d, timeout)
+        self.transport.write(build(transactionId), address)
+        return d
+
+    def _timedOut(self, transactionId, address):
+        d, timeout = self.pending.pop(transactionId)
+        self.connections.pop(address, None)
+        d.errback(AnnounceError("no answer from %s:%d" % address))
+
+    def connect(self, address):
+        """
+        Return a L{Deferred} that fires with a connection id for the
+        tracker at C{address}.
+        """
+        connection = self.connections.get(address)
+        if (connection is not None
+            and connection[1] + self.connectionLifetime > self.clock()):
+            return defer.succeed(connection[0])
+        d = self.request(address, lambda transactionId: struct.pack(
+                '>QII', UDP_PROTOCOL_ID, CONNECT, transactionId))
+        d.addCallback(self._connected, address)
+        return d
+
+    def _connected(self, body, address):
+        connectionId, = struct.unpack('>Q', body[:8])
+        self.connections[address] = (connectionId, self.clock())
+        return connectionId
+
+    def announce(self, address, announces, peerId, key):
+        """
+        Announce to the tracker at C{address}.
+
+        @param announces: C{list} of C{(infoHash, event, port)}
+            tuples.
+        @return: a L{Deferred} that fires with a C{list} of
+            C{(success, result)} tuples, where the results are
+            C{(infoHash, interval, peers)} tuples.
+        """
+        d = self.connect(address)
+        d.addCallback(self._announce, address, announces, peerId, key)
+        return d
+
+    def _announce(self, connectionId, address, announces, peerId, key):
+        requests = list()
+        for infoHash, event, port in announces:
+            def build(transactionId, infoHash=infoHash, event=event,
+                      port=port):
+                return struct.pack(
+                    '>QII20s20sQQQIIIiH', connectionId, ANNOUNCE,
+                    transactionId, infoHash, peerId, 0, 0, 0, event, 0,
+                    key, -1, port
+                    )
+            d = self.request(address, build)
+            d.addCallback(self._announced, infoHash)
+            requests.append(d)
+        return defer.DeferredList(requests, consumeErrors=True)
+
+    def _announced(self, body, infoHash):
+        interval, leechers, seeders = struct.unpack('>III', body[:12])
+        return infoHash, interval, compactPeers(body[12:])
+
+
+class Tracker(object):
+    """
+    Announce state of a single tracker.
+
+    @ivar udp: C{True} while the tracker is announced to with the UDP
+        protocol.  HTTP trackers are tried over UDP on the same port
+        first.
+    @ivar started: info-hashes the tracker has acknowledged.
+    @ivar sent: info-hashes the tracker has been sent, whether it
+        answered or not.
+    @ivar failures: number of announces that failed in a row.
+    @ivar nextAnnounce: time of the next announce.
+    @ivar announcing: the L{Deferred} of the announce in progress, if
+        any.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or {'http': 80, 'https': 443}.get(
+            parsed.scheme, 80)
+        self.http = parsed.scheme in ('http', 'https')
+        self.udp = parsed.scheme in ('udp', 'http')
+        self.started = set()
+        self.sent = set()
+        self.failures = 0
+        self.nextAnnounce = 0
+        self.announcing = None
+
+
+class AnnounceClient(object):
+    """
+    Announces a set of info-hashes to a list of trackers.
+
+    A timer checks which trackers are due; trackers are announced to
+    concurrently and each schedules its next announce from the
+    interval it asks for, or from its backoff when it failed.
+
+    @ivar received: callable that is called with an info-hash, the
+        C{(host, port)} peers announced under it, and the number of
+        seconds until the tracker expects the next announce.
+    """
+    tick = 15
+    minInterval = 60
+    backoff = 60
+    maxBackoff = 3600
+    httpConcurrency = 4
+    httpTimeout = 30
+
+    def __init__(self, urls, port, received=None, peerId=None,
+                 reactor=None, clock=time.time):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.trackers = [Tracker(url) for url in urls]
+        self.port = port
+        self.received = received or (lambda infoHash, peers, interval:
+                                         None)
+        if peerId is None:
+            peerId = '-FR0001-' + ''.join([random.choice('0123456789')
+                                           for i in range(12)])
+        self.peerId = peerId
+        self.key = random.getrandbits(32)
+        self.reactor = reactor
+        self.clock = clock
+        self.infoHashes = dict()
+        self.udp = UDPTrackerProtocol(reactor, clock)
+        self.udpPort = None
+        self.timer = task.LoopingCall(self.announce)
+        self.timer.clock = reactor
+
+    def start(self):
+        """
+        Start announcing.
+        """
+        if self.udpPort is None:
+            self.udpPort = self.reactor.listenUDP(0, self.udp)
+        if not self.timer.running:
+            self.timer.start(self.tick, now=True)
+
+    def stop(self):
+        """
+        Stop announcing, and tell the trackers that the info-hashes
+        they acknowledged are stopped.
+
+        @return: a L{Deferred} that fires once every tracker answered
+            or failed to.
+        """
+        if self.timer.running:
+            self.timer.stop()
+        stopping = list()
+        for tracker in self.trackers:
+            if tracker.announcing is not None:
+                # the tracker may acknowledge more info-hashes first.
+                d = tracker.announcing
+                d.addCallback(lambda ignored, tracker=tracker:
+                                  self._stopTracker(tracker))
+            else:
+                d = self._stopTracker(tracker)
+            stopping.append(d)
+        d = defer.DeferredList(stopping)
+        d.addCallback(lambda ignored: self._stopListening())
+        return d
+
+    def _stopTracker(self, tracker):
+        announces = [(infoHash, STOPPED, self._port(infoHash))
+                     for infoHash in sorted(tracker.started)
+                     if infoHash in self.infoHashes]
+        tracker.started.clear()
+        tracker.sent.clear()
+        if not announces:
+            return defer.succeed(None)
+        d = self._send(tracker, announces)
+        return d.addErrback(self._stopFailed, tracker)
+
+    def _stopFailed(self, failure, tracker):
+        log.msg("stopping announces to %s failed: %s"
+                % (tracker.url, failure.getErrorMessage()))
+
+    def _stopListening(self):
+        if self.udpPort is not None:
+            self.udpPort.stopListening()
+            self.udpPort = None
+
+    def add(self, infoHash, port=None):
+        """
+        Start announcing C{infoHash}.  Trackers that are not backing
+        off are told about it at the next tick, on its own; it joins
+        the regular announces after that.
+
+        @param port: the port to announce, if not the C{port} of the
+            client.  Port 0 asks for the peers of C{infoHash} without
+            becoming one.
+        """
+        self.infoHashes.setdefault(infoHash, port)
+
+    def remove(self, infoHash):
+        """
+        Stop announcing C{infoHash}.
+        """
+        self.infoHashes.pop(infoHash, None)
+        for tracker in self.trackers:
+            tracker.started.discard(infoHash)
+            tracker.sent.discard(infoHash)
+
+    def announce(self):
+        """
+        Announce to the trackers that are due, and tell the others
+        about the info-hashes they have not been sent yet.
+        """
+        if not self.infoHashes:
+            return
+        now = self.clock()
+        for tracker in self.trackers:
+            if tracker.announcing is not None:
+                continue
+            if tracker.nextAnnounce <= now:
+                self.announceTo(tracker)
+            elif not tracker.failures:
+                fresh = [infoHash for infoHash in self.infoHashes
+                         if infoHash not in tracker.sent]
+                if fresh:
+                    self.announceTo(tracker, fresh)
+
+    def announceTo(self, tracker, infoHashes=None):
+        """
+        Announce C{infoHashes}, or all info-hashes, to C{tracker}.
+        Announcing only some of them leaves the schedule of the
+        tracker alone.
+        """
+        if infoHashes is None:
+            infoHashes = self.infoHashes
+        announces = list()
+        for infoHash in sorted(infoHashes):
+            if infoHash in tracker.started:
+                event = NONE
+            else:
+                event = STARTED
+            announces.append((infoHash, event, self._port(infoHash)))
+            tracker.sent.add(infoHash)
+        partial = len(announces) < len(self.infoHashes)
+        d = tracker.announcing = self._send(tracker, announces)
+        d.addCallbacks(self._announced, self._failed,
+                       callbackArgs=(tracker, partial),
+                       errbackArgs=(tracker,))
+        return d
+
+    def _port(self, infoHash):
+        port = self.infoHashes[infoHash]
+        if port is None:
+            port = self.port
+        return port
+
+    def _send(self, tracker, announces):
+        if tracker.udp:
+            d = self._announceUDP(tracker, announces)
+            if tracker.http:
+                d.addErrback(self._fallBack, tracker, announces)
+        else:
+            d = self._announceHTTP(tracker, announces)
+        return d
+
+    def _announceUDP(self, tracker, announces):
+        d = self.reactor.resolve(tracker.host)
+        d.addCallback(lambda address: self.udp.announce(
+                (address, tracker.port), announces, self.peerId,
+                self.key))
+        d.addCallback(self._checkResults)
+        return d
+
+    def _checkResults(self, results):
+        # an announce fails only if every info-hash failed.
+        answered = [result for (success, result) in results if success]
+        if results and not answered:
+            return results[0][1]
+        return answered
+
+    def _fallBack(self, failure, tracker, announces):
+        # the tracker does not speak UDP; stick to HTTP from now on.
+        tracker.udp = False
+        return self._announceHTTP(tracker, announces)
+
+    def _announceHTTP(self, tracker, announces):
+        semaphore = defer.DeferredSemaphore(self.httpConcurrency)
+        d = defer.DeferredList(
+            [semaphore.run(self._announceHTTPOne, tracker, infoHash, event,
+                           port)
+             for infoHash, event, port in announces],
+            consumeErrors=True
+            )
+        return d.addCallback(self._checkResults)
+
+    def _announceHTTPOne(self, tracker, infoHash, event, port):
+        query = {'info_hash': infoHash, 'peer_id': self.peerId,
+                 'port': port, 'uploaded': 0, 'downloaded': 0,
+                 'left': 0, 'compact': 1, 'key': '%08x' % self.key}
+        if eventNames[event] is not None:
+            query['event'] = eventNames[event]
+        separator = '?' in tracker.url and '&' or '?'
+        url = tracker.url + separator + urllib.urlencode(query)
+        d = getPage(url, timeout=self.httpTimeout)
+        d.addCallback(self._parseHTTP, infoHash)
+        return d
+
+    def _parseHTTP(self, page, infoHash):
+        response = bdecode(page)
+        if not isinstance(response, dict):
+            raise AnnounceError("malformed tracker response")
+        if 'failure reason' in response:
+            raise AnnounceError(response['failure reason'])
+        peers = response.get('peers', '')
+        if isinstance(peers, str):
+            peers = compactPeers(peers)
+        else:
+            peers = [(peer['ip'], peer['port']) for peer in peers]
+        return infoHash, response.get('interval', 0), peers
+
+    def _announced(self, results, tracker, partial):
+        tracker.announcing = None
+        tracker.failures = 0
+        interval = None
+        for infoHash, trackerInterval, peers in results:
+            if infoHash in self.infoHashes:
+                tracker.started.add(infoHash)
+            interval = min(interval or trackerInterval, trackerInterval)
+            self.received(infoHash, peers, trackerInterval)
+        if not partial:
+            tracker.nextAnnounce = self.clock() + max(self.minInterval,
+                                                      interval or 0)
+
+    def _failed(self, failure, tracker):
+        tracker.announcing = None
+        tracker.failures += 1
+        delay = min(self.maxBackoff,
+                    self.backoff * 2 ** (tracker.failures - 1))
+        tracker.nextAnnounce = self.clock() + delay
+        log.msg("announce to %s failed, retrying in %d seconds: %s"
+                % (tracker.url, delay, failure.getErrorMessage()))
+
+
+class AccountAnnouncer(object):
+    """
+    Announces the presence of an account and looks up the presence
+    of its contacts, feeding the endpoints found to a directory.
+
+    @ivar directory: the L{EndpointDirectory} to tell about the
+        endpoints of contacts.
+    @ivar presence: the info-hash the account is announced under, or
+        C{None} while it has no certificate.
+    @ivar contacts: C{dict} mapping info-hashes to the C{list} of
+        contacts looked up under them.
+    @ivar infoHashes: C{dict} mapping contacts to their info-hash.
+    """
+    presence = None
+
+    def __init__(self, account, client, directory):
+        self.account = account
+        self.client = client
+        self.directory = directory
+        self.client.received = self.received
+        self.contacts = dict()
+        self.infoHashes = dict()
+        self.updatePresence()
+        for contact in account.contacts:
+            self.add(contact)
+        account.addObserver(self.accountChanged)
+
+    def updatePresence(self):
+        """
+        Announce the account under the info-hash of its current
+        certificate.
+        """
+        fingerprint = certificateFingerprint(self.account.cert)
+        presence = None
+        if fingerprint is not None:
+            presence = presenceHash(fingerprint)
+        if presence == self.presence:
+            return
+        if self.presence is not None:
+            self.client.remove(self.presence)
+        self.presence = presence
+        if presence is not None:
+            self.client.add(presence)
+
+    def add(self, contact):
+        fingerprint = contact.fingerprint()
+        if fingerprint is None:
+            return
+        infoHash = presenceHash(fingerprint)
+        self.infoHashes[contact] = infoHash
+        if infoHash not in self.contacts:
+            # only look the contact up; do not pose as it.
+            self.client.add(infoHash, port=0)
+        self.contacts.setdefault(infoHash, []).append(contact)
+
+    def remove(self, contact):
+        infoHash = self.infoHashes.pop(contact, None)
+        if infoHash is None:
+            return
+        contacts = self.contacts[infoHash]
+        contacts.remove(contact)
+        if not contacts:
+            del self.contacts[infoHash]
+            self.client.remove(infoHash)
+
+    def update(self, contact):
+        """
+        Look C{contact} up under the info-hash of its current
+        certificate, which it may have gained or changed.
+        """
+        fingerprint = contact.fingerprint()
+        infoHash = None
+        if fingerprint is not None:
+            infoHash = presenceHash(fingerprint)
+        if infoHash != self.infoHashes.get(contact):
+            self.remove(contact)
+            self.add(contact)
+
+    def accountChanged(self, account, kind, indexes, contacts):
+        if kind == INSERTED:
+            for contact in contacts:
+                self.add(contact)
+        elif kind == REMOVED:
+            for contact in contacts:
+                self.remove(contact)
+        elif kind == UPDATED:
+            if not contacts:
+                self.updatePresence()
+            for contact in contacts:
+                self.update(contact)
+
+    def received(self, infoHash, peers, interval):
+        for contact in self.contacts.get(infoHash, ()):
+            for host, port in peers:
+                if not port:
+                    continue
+                self.directory.learn(contact, host, port,
+                                     ttl=2 * max(interval, 60))
+
+    def start(self):
+        self.client.start()
+
+    def stop(self):
+        """
+        Stop announcing the account and looking up its contacts.
+
+        @return: a L{Deferred} that fires once the trackers were told.
+        """
+        if self.accountChanged in self.account.observers:
+            self.account.removeObserver(self.accountChanged)
+        return self.client.stop()
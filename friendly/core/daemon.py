@@ -0,0 +1,179 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Headless Friendly node.
+
+Runs the core of Friendly without AppKit, on the epoll reactor where
+it is available:
+
+    python -m friendly.core.daemon --data ~/.friendly
+"""
+
+import os, sys
+
+from twisted.internet import defer
+from twisted.internet.error import CannotListenError
+from twisted.python import log, usage
+
+# none of these install a reactor.
+from friendly.core.peer import PeerConnectionManager, PeerError, PEER_PORT
+from friendly.core.announce import AnnounceClient, AccountAnnouncer
+from friendly.core.endpoints import EndpointDirectory
+from friendly.core.sqlstore import SQLiteAccountStore
+
+
+def installReactor():
+    """
+    Install the epoll reactor, if the platform has it.
+    """
+    try:
+        from twisted.internet import epollreactor
+        epollreactor.install()
+    except Exception:
+        log.msg("epoll reactor not available, using the default reactor")
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['data', 'd', '~/.friendly', 'Directory holding the node data.'],
+        ['passphrase-file', None, None,
+         'File holding the passphrase encrypting the private keys.'],
+        ]
+
+
+class Daemon(object):
+    """
+    A headless node serving the accounts in C{store}.
+
+    Like the accounts of the application, each account accepts
+    connections from its contacts on a port of its own and announces
+    itself to the trackers of the account.
+
+    @ivar endpoints: the L{EndpointDirectory} contacts are dialed at.
+    @ivar peers: C{dict} mapping accounts to their
+        L{PeerConnectionManager}.
+    @ivar announcers: C{dict} mapping accounts to their
+        L{AccountAnnouncer}.
+    """
+
+    def __init__(self, store, endpoints, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.store = store
+        self.endpoints = endpoints
+        self.reactor = reactor
+        self.accounts = list()
+        self.peers = dict()
+        self.announcers = dict()
+
+    def start(self):
+        self.accounts = self.store.load()
+        self.endpoints.load()
+        for account in self.accounts:
+            log.msg("account %r with %d contacts" % (
+                    account.displayName, len(account.contacts)))
+            self.serve(account)
+
+    def serve(self, account):
+        """
+        Accept connections for C{account} and announce it.
+        """
+        manager = PeerConnectionManager(
+            account, reactor=self.reactor, resolve=self.endpoints.resolve,
+            statusChanged=self.statusChanged,
+            reached=self.endpoints.reached
+            )
+        port = account.listenPort
+        taken = set(other.listenPort for other in self.peers)
+        if port is None or port in taken:
+            port = port or PEER_PORT
+            while port in taken:
+                port += 1
+            account.update(listenPort=port)
+        self.peers[account] = manager
+        try:
+            manager.listen(port)
+        except (CannotListenError, PeerError), e:
+            # nothing is announced for a port that is not listened on
+            log.msg("cannot accept connections for %r: %s" % (
+                    account.displayName, e))
+            return
+        if account.announceList:
+            announcer = AccountAnnouncer(
+                account, AnnounceClient(account.announceList, port,
+                                        reactor=self.reactor),
+                self.endpoints
+                )
+            self.announcers[account] = announcer
+            announcer.start()
+
+    def statusChanged(self, contact, status):
+        contact.status = status
+
+    def stop(self):
+        for manager in self.peers.values():
+            manager.stop()
+        for announcer in self.announcers.values():
+            announcer.stop()
+        return defer.DeferredList([self.store.flush(),
+                                   self.endpoints.flush()])
+
+
+def main(argv=None):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        print '%s: %s' % (sys.argv[0], e)
+        print options
+        sys.exit(1)
+
+    installReactor()
+    from twisted.internet import reactor
+
+    log.startLogging(sys.stdout)
+    directory = os.path.expanduser(options['data'])
+    passphrase = None
+    if options['passphrase-file'] is not None:
+        fp = open(os.path.expanduser(options['passphrase-file']))
+        try:
+            passphrase = fp.read().strip()
+        finally:
+            fp.close()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    store = SQLiteAccountStore(os.path.join(directory, 'accounts.sqlite'),
+                               passphrase=passphrase)
+    daemon = Daemon(store,
+                    EndpointDirectory(os.path.join(directory,
+                                                   'endpoints.json')))
+    reactor.callWhenRunning(daemon.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', daemon.stop)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
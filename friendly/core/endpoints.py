@@ -0,0 +1,297 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Where contacts can be reached.
+
+The directory maps contacts, by the certificate fingerprint they are
+pinned by, to the host and port candidates learned from announces and
+earlier connections.  Candidates expire after a time to live.  When
+every candidate of a contact fails, the contact is not probed again
+until a backoff, doubling with each failure, has passed.  The
+directory is written behind to a JSON file.
+"""
+
+import os, time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from twisted.internet import defer, protocol
+
+from friendly.core.model import PIN_DIGEST
+from friendly.core.writebehind import WriteBehindScheduler
+
+
+class EndpointError(Exception):
+    """
+    No endpoint of a contact is known to be reachable.
+    """
+
+
+def formatEndpoint(endpoint):
+    """
+    Return C{endpoint} as a C{host:port} string, with IPv6 addresses
+    in brackets.
+    """
+    host, port = endpoint
+    if ':' in host:
+        host = '[%s]' % (host,)
+    return '%s:%d' % (host, port)
+
+
+def setEndpoint(contact, endpoint):
+    """
+    Remember C{endpoint} as the endpoint C{contact} was last found
+    at.
+    """
+    contact.endpoint = endpoint
+
+
+class EndpointDirectory(object):
+    """
+    Cache of the endpoints of contacts.
+
+    @ivar candidates: C{dict} mapping L{PIN_DIGEST} fingerprints to
+        a C{dict} of C{[expires, rtt]} lists, keyed by C{(host,
+        port)}.  C{rtt} is the time it last took to connect, or
+        C{None}.
+    @ivar failures: C{dict} mapping fingerprints to a C{[count,
+        retryAt]} list, for contacts none of whose candidates could be
+        reached.
+    @ivar probeInterval: seconds during which the fastest candidate
+        found by a probe is returned without probing again.
+    @ivar endpointChanged: callable that is called with a contact and
+        the endpoint a probe found it at, when it differs from the
+        C{endpoint} of the contact.  The endpoint is not stored with
+        the contact, so this does not notify the observers of its
+        account.
+    """
+    ttl = 24 * 3600
+    probeTimeout = 10
+    probeInterval = 60
+    backoff = 30
+    maxBackoff = 3600
+
+    def __init__(self, path=None, reactor=None, clock=time.time,
+                 endpointChanged=setEndpoint):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.path = path
+        self.endpointChanged = endpointChanged
+        self.reactor = reactor
+        self.clock = clock
+        self.candidates = dict()
+        self.failures = dict()
+        self.probed = dict()
+        self.resolving = dict()
+        self.writer = WriteBehindScheduler(
+            self.write, lambda batch: self.serialize(),
+            delay=5, reactor=reactor
+            )
+
+    def load(self):
+        """
+        Load the directory from C{path}, dropping expired candidates.
+        A directory keyed by another digest is dropped as a whole.
+        """
+        try:
+            fp = open(self.path)
+            try:
+                document = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, OSError, ValueError):
+            return
+        if document.get('digest') != PIN_DIGEST:
+            return
+        now = self.clock()
+        for fingerprint, entries in document['candidates'].iteritems():
+            for host, port, expires, rtt in entries:
+                if expires > now:
+                    self.candidates.setdefault(fingerprint, dict())[
+                        (host, port)] = [expires, rtt]
+        self.failures = dict(document['failures'])
+
+    def serialize(self):
+        candidates = dict()
+        for fingerprint, entries in self.candidates.iteritems():
+            candidates[fingerprint] = [
+                [host, port, expires, rtt]
+                for ((host, port), (expires, rtt)) in entries.iteritems()
+                ]
+        return {'digest': PIN_DIGEST, 'candidates': candidates,
+                'failures': self.failures}
+
+    def write(self, document):
+        """
+        Write C{document}, replacing the file atomically.
+        """
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        fp = open(self.path + '.tmp', 'w')
+        try:
+            json.dump(document, fp)
+        finally:
+            fp.close()
+        os.rename(self.path + '.tmp', self.path)
+
+    def learn(self, contact, host, port, ttl=None):
+        """
+        Record that C{contact} can be reached at C{host} and C{port}
+        for the next C{ttl} seconds.
+        """
+        fingerprint = contact.fingerprint(PIN_DIGEST)
+        if fingerprint is None:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        entries = self.candidates.setdefault(fingerprint, dict())
+        entry = entries.get((host, port))
+        if entry is None:
+            entries[(host, port)] = [self.clock() + ttl, None]
+            # a new candidate is worth trying right away.
+            self.failures.pop(fingerprint, None)
+            self.probed.pop(fingerprint, None)
+        else:
+            entry[0] = max(entry[0], self.clock() + ttl)
+        self.writer.schedule()
+
+    def reached(self, contact, endpoint):
+        """
+        Record that C{contact} was just reached at C{endpoint}.
+        """
+        host, port = endpoint
+        self.learn(contact, host, port)
+
+    def forget(self, contact):
+        """
+        Drop all that is known about C{contact}.
+        """
+        fingerprint = contact.fingerprint(PIN_DIGEST)
+        self.candidates.pop(fingerprint, None)
+        self.failures.pop(fingerprint, None)
+        self.probed.pop(fingerprint, None)
+        self.writer.schedule()
+
+    def endpoints(self, contact):
+        """
+        Return the unexpired candidates of C{contact}, fastest first.
+        """
+        entries = self.candidates.get(contact.fingerprint(PIN_DIGEST))
+        if not entries:
+            return []
+        now = self.clock()
+        for endpoint, (expires, rtt) in entries.items():
+            if expires <= now:
+                del entries[endpoint]
+        def key(endpoint):
+            rtt = entries[endpoint][1]
+            return (rtt is None, rtt)
+        return sorted(entries, key=key)
+
+    def resolve(self, contact):
+        """
+        Return a L{Deferred} firing with the C{(host, port)} endpoint
+        of C{contact} that accepted a connection the fastest.
+
+        Concurrent requests for the same contact share a probe.
+        """
+        fingerprint = contact.fingerprint(PIN_DIGEST)
+        failure = self.failures.get(fingerprint)
+        if failure is not None and failure[1] > self.clock():
+            return defer.fail(EndpointError(
+                "%s was unreachable; not retrying yet" % (contact.email,)))
+        probed = self.probed.get(fingerprint)
+        if (probed is not None
+            and probed[1] + self.probeInterval > self.clock()
+            and probed[0] in self.candidates.get(fingerprint, ())):
+            return defer.succeed(probed[0])
+        d = defer.Deferred()
+        if fingerprint in self.resolving:
+            self.resolving[fingerprint].append(d)
+            return d
+        endpoints = self.endpoints(contact)
+        if not endpoints:
+            return defer.fail(EndpointError(
+                "no known endpoint for %s" % (contact.email,)))
+        self.resolving[fingerprint] = [d]
+        probes = [self.probe(endpoint) for endpoint in endpoints]
+        race = defer.DeferredList(probes, fireOnOneCallback=True,
+                                  consumeErrors=True)
+        race.addCallback(self._probed, contact, fingerprint, endpoints)
+        return d
+
+    def probe(self, endpoint):
+        """
+        Return a L{Deferred} firing with the time it took to connect to
+        C{endpoint}.
+        """
+        host, port = endpoint
+        start = self.clock()
+        creator = protocol.ClientCreator(self.reactor, protocol.Protocol)
+        d = creator.connectTCP(host, port, timeout=self.probeTimeout)
+        def connected(p):
+            p.transport.loseConnection()
+            return self.clock() - start
+        return d.addCallback(connected)
+
+    def _probed(self, result, contact, fingerprint, endpoints):
+        waiting = self.resolving.pop(fingerprint, ())
+        entries = self.candidates.get(fingerprint, dict())
+        if isinstance(result, tuple):
+            rtt, index = result
+            endpoint = endpoints[index]
+            if endpoint in entries:
+                entries[endpoint][1] = rtt
+            self.failures.pop(fingerprint, None)
+            self.probed[fingerprint] = (endpoint, self.clock())
+            if contact.endpoint != endpoint:
+                self.endpointChanged(contact, endpoint)
+            self.writer.schedule()
+            for d in waiting:
+                d.callback(endpoint)
+            return
+        # every probe failed.
+        count = self.failures.get(fingerprint, [0, 0])[0] + 1
+        delay = min(self.maxBackoff, self.backoff * 2 ** (count - 1))
+        self.failures[fingerprint] = [count, self.clock() + delay]
+        self.probed.pop(fingerprint, None)
+        self.writer.schedule()
+        error = EndpointError("%s is unreachable; retrying in %d seconds"
+                              % (contact.email, delay))
+        for d in waiting:
+            d.errback(error)
+
+    def flush(self):
+        """
+        Write pending changes now.
+        """
+        return self.writer.flush()
@@ -0,0 +1,407 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Plain Python account and contact model.
+"""
+
+import hashlib, weakref
+
+
+INSERTED, REMOVED, UPDATED = 'inserted', 'removed', 'updated'
+
+# status of a contact.
+OFFLINE, UNKNOWN, CONNECTING, CONNECTED = range(4)
+
+# digest of the certificate fingerprints peers are pinned by.
+PIN_DIGEST = 'sha256'
+
+
+def normalizeEmail(email):
+    """
+    Return the canonical form of C{email}, used as key in the contact
+    index of an L{Account}.
+    """
+    if not email:
+        return None
+    return email.strip().lower()
+
+
+def fingerprintBytes(der, method='md5'):
+    """
+    Return the fingerprint of the DER encoded certificate C{der}, in
+    the same format as L{Certificate.digest}.
+    """
+    return ':'.join(['%02X' % ord(c)
+                     for c in hashlib.new(method, der).digest()])
+
+
+class FingerprintCache(object):
+    """
+    Cache of certificate fingerprints, keyed by certificate identity.
+
+    Each certificate maps to a dictionary of fingerprints keyed by
+    digest method.  Entries are dropped when the certificate is
+    garbage collected.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def digestsForCertificate(self, cert, digests=None):
+        """
+        Return the dictionary of fingerprints for C{cert}.
+
+        @param digests: dictionary of already known fingerprints to
+            register for C{cert} if it is not already in the cache.
+        """
+        key = id(cert)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0]() is cert:
+            return entry[1]
+        if digests is None:
+            digests = {}
+        ref = weakref.ref(cert, lambda ref: self._expire(key, ref))
+        self.entries[key] = (ref, digests)
+        return digests
+
+    def _expire(self, key, ref):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is ref:
+            del self.entries[key]
+
+    def fingerprint(self, cert, method='md5'):
+        """
+        Return the fingerprint of C{cert} using digest C{method}.
+        """
+        digests = self.digestsForCertificate(cert)
+        fingerprint = digests.get(method)
+        if fingerprint is None:
+            fingerprint = digests[method] = cert.digest(method)
+        return fingerprint
+
+
+fingerprints = FingerprintCache()
+
+
+def certificateFingerprint(cert, method='md5'):
+    """
+    Return the fingerprint of C{cert}, or C{None} if there is no
+    certificate.
+    """
+    if cert is None:
+        return None
+    return fingerprints.fingerprint(cert, method)
+
+
+class Contact(object):
+    """
+    A friend.
+
+    The certificate can be given in its DER encoding, in which case it
+    is only loaded when L{cert} is first accessed.
+
+    @ivar account: the L{Account} the contact belongs to.
+    @ivar wrapper: the object wrapping the contact for the user
+        interface, if any.
+    @ivar storeId: identifier of the contact in the store, if any.
+    """
+    __slots__ = ('name', 'email', 'status', 'account', 'endpoint',
+                 'wrapper', 'storeId', '_cert', '_certBytes',
+                 '_certLoader', '_fingerprints')
+
+    def __init__(self, name, email, certBytes=None, status=UNKNOWN,
+                 certLoader=None, fingerprint=None, fingerprints=None):
+        """
+        @param certLoader: callable returning the DER encoding of the
+            certificate, for when it is not given in C{certBytes}.
+        @param fingerprint: the already known MD5 fingerprint of the
+            certificate.
+        @param fingerprints: C{dict} of other already known
+            fingerprints of the certificate, keyed by digest method.
+        """
+        self.name = name
+        self.email = email
+        self.status = status
+        self.account = None
+        self.endpoint = None
+        self.wrapper = None
+        self.storeId = None
+        self._cert = None
+        self._certBytes = certBytes
+        self._certLoader = certLoader
+        self._fingerprints = None
+        if fingerprints:
+            self._fingerprints = dict(fingerprints)
+        if fingerprint is not None:
+            if self._fingerprints is None:
+                self._fingerprints = {}
+            self._fingerprints['md5'] = fingerprint
+
+    def _getCert(self):
+        if self._cert is None and self.certificateBytes() is not None:
+            from twisted.internet.ssl import Certificate
+            self._cert = Certificate.load(self._certBytes)
+            if self._fingerprints is None:
+                self._fingerprints = {}
+            fingerprints.digestsForCertificate(self._cert,
+                                               self._fingerprints)
+        return self._cert
+
+    def _setCert(self, cert):
+        self._cert = cert
+        self._certBytes = None
+        self._certLoader = None
+        self._fingerprints = None
+        if cert is not None:
+            self._fingerprints = fingerprints.digestsForCertificate(cert)
+
+    cert = property(_getCert, _setCert, doc="""
+        Certificate of peer, loaded on first access if it was given
+        in its DER encoding.
+        """)
+    del _getCert, _setCert
+
+    def certificateBytes(self):
+        """
+        Return the DER encoding of the certificate of the peer, or
+        C{None} if there is no certificate.
+        """
+        if self._certBytes is None and self._certLoader is not None:
+            self._certBytes = self._certLoader()
+            self._certLoader = None
+        if self._certBytes is not None:
+            return self._certBytes
+        if self._cert is not None:
+            return self._cert.dump()
+        return None
+
+    def fingerprint(self, method='md5'):
+        """
+        Return the fingerprint of the certificate of the peer using
+        digest C{method}, or C{None} if there is no certificate.
+
+        The certificate is not loaded to compute the fingerprint.
+        """
+        if self._fingerprints is None:
+            self._fingerprints = {}
+        fingerprint = self._fingerprints.get(method)
+        if fingerprint is None:
+            certBytes = self.certificateBytes()
+            if certBytes is None:
+                return None
+            fingerprint = self._fingerprints[method] = fingerprintBytes(
+                certBytes, method
+                )
+        return fingerprint
+
+    def update(self, **attributes):
+        """
+        Change attributes of the contact, keeping the index of the
+        account up to date and notifying its observers.
+        """
+        account = self.account
+        if account is not None:
+            account.unindexContact(self)
+        for key, value in attributes.iteritems():
+            setattr(self, key, value)
+        if account is not None:
+            account.indexContact(self)
+            account._notify(UPDATED, None, [self])
+
+    def setCertificate(self, cert):
+        """
+        Set certificate of peer.
+        """
+        self.update(cert=cert)
+
+
+def _unindex(index, key, contact):
+    """
+    Remove C{contact} from the list of C{index} at C{key}, dropping
+    the key once no contact is left.
+    """
+    contacts = index.get(key)
+    if not contacts:
+        return
+    for position, other in enumerate(contacts):
+        if other is contact:
+            del contacts[position]
+            break
+    if not contacts:
+        del index[key]
+
+
+class Account(object):
+    """
+    An identity of the user, with its certificate and contacts.
+
+    Observers are called with the account, the kind of change
+    (L{INSERTED}, L{REMOVED} or L{UPDATED}), the affected indexes and
+    the affected contacts, after the account has changed.  Indexes
+    are C{None} for updates.
+
+    @ivar wrapper: the object wrapping the account for the user
+        interface, if any.
+    @ivar storeId: identifier of the account in the store, if any.
+    @ivar announceList: C{list} of the URLs of the trackers the
+        account is announced to.
+    @ivar listenPort: the port to accept connections from contacts
+        on, or C{None} for the default.
+    @ivar contactsByEmail: C{dict} mapping normalized emails to the
+        C{list} of contacts with that email, in order of addition.
+    @ivar contactsByFingerprint: C{dict} mapping fingerprints to the
+        C{list} of contacts with that certificate, in order of
+        addition.
+    """
+    wrapper = None
+    storeId = None
+
+    def __init__(self, displayName=u"", cert=None, announceList=None,
+                 listenPort=None):
+        self.displayName = displayName
+        self.cert = cert
+        self.announceList = list(announceList or ())
+        self.listenPort = listenPort
+        self.contacts = list()
+        self.contactsByEmail = {}
+        self.contactsByFingerprint = {}
+        self.observers = list()
+
+    def addObserver(self, observer):
+        self.observers.append(observer)
+
+    def removeObserver(self, observer):
+        self.observers.remove(observer)
+
+    def update(self, **attributes):
+        """
+        Change attributes of the account and notify its observers.
+        """
+        for key, value in attributes.iteritems():
+            setattr(self, key, value)
+        self._notify(UPDATED, None, [])
+
+    def _notify(self, kind, indexes, contacts):
+        for observer in list(self.observers):
+            observer(self, kind, indexes, contacts)
+
+    def indexContact(self, contact):
+        """
+        Add contact to the email and fingerprint indexes.
+        """
+        email = normalizeEmail(contact.email)
+        if email is not None:
+            self.contactsByEmail.setdefault(email, []).append(contact)
+        fingerprint = contact.fingerprint()
+        if fingerprint is not None:
+            self.contactsByFingerprint.setdefault(
+                fingerprint, []).append(contact)
+
+    def unindexContact(self, contact):
+        """
+        Remove contact from the email and fingerprint indexes, leaving
+        other contacts with the same email or certificate in place.
+        """
+        _unindex(self.contactsByEmail, normalizeEmail(contact.email),
+                 contact)
+        _unindex(self.contactsByFingerprint, contact.fingerprint(),
+                 contact)
+
+    def addContact(self, contact):
+        """
+        Add contact to list of contacts.
+        """
+        self.addContacts([contact])
+
+    def removeContact(self, contact):
+        """
+        Remove contact from list of contacts.
+        """
+        self.removeContacts([contact])
+
+    def addContacts(self, contacts):
+        """
+        Add several contacts to the list of contacts, with a single
+        notification of the observers.
+        """
+        contacts = list(contacts)
+        if not contacts:
+            return
+        start = len(self.contacts)
+        self.contacts.extend(contacts)
+        for contact in contacts:
+            contact.account = self
+            self.indexContact(contact)
+        self._notify(INSERTED, range(start, start + len(contacts)),
+                     contacts)
+
+    def removeContacts(self, contacts):
+        """
+        Remove several contacts from the list of contacts, with a
+        single notification of the observers.
+        """
+        removed = set([id(contact) for contact in contacts])
+        indexes = list()
+        kept = list()
+        gone = list()
+        for index, contact in enumerate(self.contacts):
+            if id(contact) in removed:
+                indexes.append(index)
+                gone.append(contact)
+                self.unindexContact(contact)
+            else:
+                kept.append(contact)
+        if not indexes:
+            return
+        self.contacts[:] = kept
+        self._notify(REMOVED, indexes, gone)
+
+    def contactWithEmail(self, email):
+        """
+        Return the first added contact with the given email, or
+        C{None}.
+        """
+        contacts = self.contactsByEmail.get(normalizeEmail(email))
+        if contacts:
+            return contacts[0]
+        return None
+
+    def contactWithFingerprint(self, fingerprint):
+        """
+        Return the first added contact whose certificate has the given
+        fingerprint, or C{None}.
+        """
+        contacts = self.contactsByFingerprint.get(fingerprint)
+        if contacts:
+            return contacts[0]
+        return None
+
+    def hasContactWithEmail(self, email):
+        """
+        Return C{True} if the account has a contact with the given
+        email.
+        """
+        return self.contactWithEmail(email) is not None
@@ -0,0 +1,674 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Connections to peers.
+
+Each account talks to its contacts over TLS, with both sides
+authenticating with their self-signed certificates: the account
+presents its own certificate and only accepts the certificate stored
+for the contact, compared by its SHA-256 fingerprint.  A single AMP
+connection is kept per contact, and every transfer and query to that
+contact is multiplexed over it.
+"""
+
+import time, hashlib
+from collections import OrderedDict
+
+from zope.interface import implements
+
+from twisted.internet import defer, protocol, task
+from twisted.internet.interfaces import (IHandshakeListener,
+                                         IOpenSSLClientConnectionCreator)
+from twisted.internet.ssl import ContextFactory, CertificateOptions
+from OpenSSL import SSL
+from twisted.protocols import amp
+from twisted.python import log
+
+from friendly.core.model import (INSERTED, REMOVED, UPDATED, OFFLINE,
+                                 CONNECTING, CONNECTED, PIN_DIGEST,
+                                 fingerprints, certificateFingerprint)
+
+
+# port peers listen on by default.
+PEER_PORT = 1232
+
+
+class PeerError(Exception):
+    """
+    A connection to a peer could not be established.
+    """
+
+
+class Ping(amp.Command):
+    """
+    Keepalive; also detects connections that went away silently.
+    """
+    arguments = []
+    response = []
+
+
+class PeerProtocol(amp.AMP):
+    """
+    Connection to a peer.
+
+    The peer is not known to be who it claims until the TLS handshake
+    has completed, at which point the manager is told about the
+    connection.
+
+    @ivar contact: the contact at the other end, once known.
+    @ivar outgoing: C{True} if the connection was dialed by us.
+    @ivar lastUse: time of the last command sent or received, other
+        than keepalives.
+    @ivar pinging: C{True} while a keepalive is unanswered.
+    @ivar deadline: the L{IDelayedCall} closing the connection if it
+        is not authenticated in time.
+    """
+    implements(IHandshakeListener)
+
+    contact = None
+    outgoing = False
+    lastUse = None
+    pinging = False
+    deadline = None
+
+    def __init__(self, manager):
+        amp.AMP.__init__(self)
+        self.manager = manager
+
+    def connectionMade(self):
+        amp.AMP.connectionMade(self)
+        self.deadline = self.manager.reactor.callLater(
+            self.manager.handshakeTimeout, self.manager.expired, self)
+
+    def handshakeCompleted(self):
+        self.lastUse = self.manager.clock()
+        self.manager.authenticated(self)
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.manager.lost(self, reason)
+
+    def ampBoxReceived(self, box):
+        command = box.get(amp.COMMAND)
+        if command is not None and command != Ping.commandName:
+            self.lastUse = self.manager.clock()
+        amp.AMP.ampBoxReceived(self, box)
+
+    def callRemote(self, command, **kw):
+        if command is not Ping:
+            self.lastUse = self.manager.clock()
+        return amp.AMP.callRemote(self, command, **kw)
+
+    @Ping.responder
+    def ping(self):
+        return {}
+
+    def peerFingerprint(self):
+        """
+        Return the L{PIN_DIGEST} fingerprint of the certificate
+        presented by the peer, or C{None}.
+        """
+        return certificateFingerprint(self.transport.getPeerCertificate(),
+                                      PIN_DIGEST)
+
+
+class PeerClientFactory(protocol.ClientFactory):
+    """
+    Dials a single contact.
+
+    @ivar deferred: fires with the connection to the contact once it
+        is authenticated, or fails if that never happens.
+    """
+
+    def __init__(self, manager, contact):
+        self.manager = manager
+        self.contact = contact
+        self.deferred = defer.Deferred()
+
+    def buildProtocol(self, addr):
+        p = PeerProtocol(self.manager)
+        p.factory = self
+        p.contact = self.contact
+        p.outgoing = True
+        return p
+
+    def connected(self, connection):
+        if self.deferred is not None:
+            d, self.deferred = self.deferred, None
+            d.callback(connection)
+
+    def failed(self, reason):
+        if self.deferred is not None:
+            d, self.deferred = self.deferred, None
+            d.errback(reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.failed(reason)
+
+    def clientConnectionLost(self, connector, reason):
+        self.failed(reason)
+
+
+class PeerServerFactory(protocol.ServerFactory):
+    """
+    Accepts connections from the contacts of an account.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def buildProtocol(self, addr):
+        p = PeerProtocol(self.manager)
+        p.factory = self
+        return p
+
+
+class CertificateIndex(object):
+    """
+    Index of the contacts of all accounts by certificate fingerprint,
+    used to authenticate peers during the TLS handshake.
+
+    The index follows changes to the accounts added to it.
+
+    @ivar entries: C{dict} mapping L{PIN_DIGEST} fingerprints to a
+        C{dict} of the contacts with that certificate, keyed by
+        account.
+    """
+
+    def __init__(self):
+        self.entries = dict()
+        self.fingerprints = dict()
+
+    def addAccount(self, account):
+        """
+        Index the contacts of C{account} and follow its changes.
+        """
+        for contact in account.contacts:
+            self.add(account, contact)
+        account.addObserver(self.accountChanged)
+
+    def removeAccount(self, account):
+        """
+        Stop following C{account} and drop its contacts.
+        """
+        account.removeObserver(self.accountChanged)
+        for contact in account.contacts:
+            self.remove(account, contact)
+
+    def accountChanged(self, account, kind, indexes, contacts):
+        if kind == INSERTED:
+            for contact in contacts:
+                self.add(account, contact)
+        elif kind == REMOVED:
+            for contact in contacts:
+                self.remove(account, contact)
+        elif kind == UPDATED:
+            for contact in contacts:
+                self.remove(account, contact)
+                self.add(account, contact)
+
+    def add(self, account, contact):
+        fingerprint = contact.fingerprint(PIN_DIGEST)
+        if fingerprint is None:
+            return
+        self.fingerprints[contact] = fingerprint
+        self.entries.setdefault(fingerprint, dict())[account] = contact
+
+    def remove(self, account, contact):
+        fingerprint = self.fingerprints.pop(contact, None)
+        if fingerprint is None:
+            return
+        contacts = self.entries[fingerprint]
+        if contacts.get(account) is contact:
+            del contacts[account]
+        if not contacts:
+            del self.entries[fingerprint]
+
+    def lookup(self, fingerprint, account):
+        """
+        Return the contact of C{account} with the certificate with
+        the given fingerprint, or C{None}.
+        """
+        contacts = self.entries.get(fingerprint)
+        if contacts is None:
+            return None
+        return contacts.get(account)
+
+    def accounts(self, fingerprint):
+        """
+        Return a C{list} of C{(account, contact)} tuples for all
+        contacts with the certificate with the given fingerprint.
+        """
+        return self.entries.get(fingerprint, dict()).items()
+
+
+certificateIndex = CertificateIndex()
+
+
+def verifyFingerprint(accept):
+    """
+    Return a pyOpenSSL verify callback that accepts the certificate of
+    the peer if C{accept} returns true for its L{PIN_DIGEST}
+    fingerprint.
+
+    Peers use self-signed certificates, so the outcome of the
+    verification against trusted authorities is ignored.
+    """
+    def verify(connection, x509, errno, depth, ok):
+        if depth != 0:
+            return True
+        return bool(accept(fingerprints.fingerprint(x509, PIN_DIGEST)))
+    return verify
+
+
+def sessionReused(connection):
+    """
+    Return C{True} if the handshake of the pyOpenSSL C{connection}
+    resumed an earlier session.
+    """
+    # pyOpenSSL has no public accessor for this.
+    return bool(SSL._lib.SSL_session_reused(connection._ssl))
+
+
+class SessionCache(object):
+    """
+    TLS sessions to resume when dialing contacts again, with least
+    recently used contacts evicted first.
+
+    @ivar resumed: number of handshakes that resumed a session.
+    @ivar full: number of full handshakes.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.sessions = OrderedDict()
+        self.resumed = 0
+        self.full = 0
+
+    def get(self, contact):
+        """
+        Return the session to resume with C{contact}, or C{None}.
+        """
+        session = self.sessions.pop(contact, None)
+        if session is not None:
+            self.sessions[contact] = session
+        return session
+
+    def put(self, contact, session):
+        self.sessions.pop(contact, None)
+        self.sessions[contact] = session
+        while len(self.sessions) > self.size:
+            self.sessions.popitem(last=False)
+
+    def discard(self, contact):
+        self.sessions.pop(contact, None)
+
+    def handshake(self, resumed):
+        """
+        Count a completed handshake.
+        """
+        if resumed:
+            self.resumed += 1
+        else:
+            self.full += 1
+
+
+class PeerContextFactory(ContextFactory):
+    """
+    TLS context of an account, used both to dial and to accept
+    contacts.
+
+    The certificate of the account is presented, and the peer must
+    present the certificate of one of the contacts of the account,
+    which is looked up in a L{CertificateIndex}.  Session tickets are
+    enabled so that reconnecting peers can resume their sessions.
+    """
+
+    def __init__(self, account, index):
+        self.account = account
+        self.index = index
+        self.context = None
+        account.addObserver(self.accountChanged)
+
+    def accountChanged(self, account, kind, indexes, contacts):
+        if kind == UPDATED and not contacts:
+            # the certificate of the account may have changed.
+            self.context = None
+
+    def accept(self, fingerprint):
+        return self.index.lookup(fingerprint, self.account) is not None
+
+    def getContext(self):
+        if self.context is None:
+            cert = self.account.cert
+            options = CertificateOptions(
+                privateKey=cert.privateKey.original,
+                certificate=cert.original, enableSessionTickets=True
+                )
+            context = options.getContext()
+            context.set_session_id(
+                hashlib.md5(cert.dump()).hexdigest()
+                )
+            context.set_verify(
+                SSL.VERIFY_PEER | SSL.VERIFY_FAIL_IF_NO_PEER_CERT,
+                verifyFingerprint(self.accept)
+                )
+            self.context = context
+        return self.context
+
+
+class ClientConnectionCreator(object):
+    """
+    Creates the TLS connection used to dial a contact, resuming the
+    last session with it if there is one.
+    """
+    implements(IOpenSSLClientConnectionCreator)
+
+    def __init__(self, contextFactory, sessions, contact):
+        self.contextFactory = contextFactory
+        self.sessions = sessions
+        self.contact = contact
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = SSL.Connection(self.contextFactory.getContext(), None)
+        session = self.sessions.get(self.contact)
+        if session is not None:
+            connection.set_session(session)
+        return connection
+
+
+def endpointOfContact(contact):
+    """
+    Return the C{(host, port)} endpoint stored for C{contact}.
+    """
+    return contact.endpoint
+
+
+class PeerConnectionManager(object):
+    """
+    Owns the connections between an account and its contacts.
+
+    At most one connection is kept per contact.  When both sides dial
+    each other at the same time, both keep the connection dialed by
+    the side with the smaller certificate fingerprint.
+
+    @ivar resolve: callable that returns the C{(host, port)}
+        endpoint of a contact, or a L{Deferred} firing with it.
+    @ivar statusChanged: callable that is called with a contact and
+        its new status.
+    @ivar reached: callable that is called with a contact and the
+        endpoint it was successfully dialed at.
+    @ivar connections: C{dict} mapping contacts to their connection.
+    @ivar dialTimeout: seconds to wait for a dial to connect.
+    @ivar handshakeTimeout: seconds a connection may take to complete
+        the TLS handshake and, when dialed, get the first answer.
+    @ivar keepaliveInterval: seconds between keepalives, which is also
+        how long a keepalive may stay unanswered.
+    @ivar idleTimeout: seconds a connection may go unused before it
+        is closed.
+    @ivar sessions: the L{SessionCache} of TLS sessions to resume when
+        dialing contacts, which also counts resumed and full
+        handshakes.
+    @ivar index: the L{CertificateIndex} incoming peers are looked up
+        in; the account is added to it for the lifetime of the
+        manager.
+    """
+    dialTimeout = 30
+    handshakeTimeout = 30
+
+    def __init__(self, account, reactor=None, resolve=endpointOfContact,
+                 statusChanged=None, reached=None, maxDials=4,
+                 keepaliveInterval=30, idleTimeout=300, clock=time.time,
+                 index=certificateIndex, sessionCacheSize=256):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.account = account
+        self.index = index
+        index.addAccount(account)
+        self.contextFactory = PeerContextFactory(account, index)
+        self.sessions = SessionCache(sessionCacheSize)
+        self.reactor = reactor
+        self.resolve = resolve
+        self.statusChanged = statusChanged or (lambda contact, status: None)
+        self.reached = reached or (lambda contact, endpoint: None)
+        self.dials = defer.DeferredSemaphore(maxDials)
+        self.keepaliveInterval = keepaliveInterval
+        self.idleTimeout = idleTimeout
+        self.clock = clock
+        self.connections = dict()
+        self.dialing = dict()
+        self.ports = list()
+        self.keepalive = task.LoopingCall(self._keepalive)
+        self.keepalive.clock = reactor
+
+    def start(self):
+        """
+        Start sending keepalives and evicting idle connections.
+        """
+        if not self.keepalive.running:
+            self.keepalive.start(self.keepaliveInterval, now=False)
+
+    def listen(self, port=PEER_PORT, interface=''):
+        """
+        Accept connections from contacts on C{port}.
+
+        @raise PeerError: if the account has no certificate.
+        """
+        if self.account.cert is None:
+            raise PeerError("%s has no certificate"
+                            % (self.account.displayName,))
+        self.start()
+        listening = self.reactor.listenSSL(
+            port, PeerServerFactory(self),
+            self.contextFactory, interface=interface
+            )
+        self.ports.append(listening)
+        return listening
+
+    def connect(self, contact):
+        """
+        Return a L{Deferred} that fires with the connection to
+        C{contact}, dialing it if there is none yet.
+        """
+        connection = self.connections.get(contact)
+        if connection is not None:
+            return defer.succeed(connection)
+        d = defer.Deferred()
+        if contact in self.dialing:
+            self.dialing[contact].append(d)
+            return d
+        self.start()
+        self.dialing[contact] = [d]
+        self.statusChanged(contact, CONNECTING)
+        dial = self.dials.run(self._dial, contact)
+        dial.addCallbacks(self._dialed, self._dialFailed,
+                          callbackArgs=(contact,), errbackArgs=(contact,))
+        return d
+
+    def _dial(self, contact):
+        if self.account.cert is None:
+            return defer.fail(PeerError(
+                "%s has no certificate" % (self.account.displayName,)))
+        if contact.fingerprint() is None:
+            return defer.fail(PeerError(
+                "no certificate for %s" % contact.email))
+        d = defer.maybeDeferred(self.resolve, contact)
+        d.addCallback(self._dialEndpoint, contact)
+        return d
+
+    def _dialEndpoint(self, endpoint, contact):
+        if endpoint is None:
+            raise PeerError("no known endpoint for %s" % contact.email)
+        host, port = endpoint
+        factory = PeerClientFactory(self, contact)
+        self.reactor.connectSSL(host, port, factory,
+                                ClientConnectionCreator(
+                                    self.contextFactory, self.sessions,
+                                    contact),
+                                timeout=self.dialTimeout)
+        return factory.deferred.addCallback(self._reached, contact, endpoint)
+
+    def _reached(self, connection, contact, endpoint):
+        self.reached(contact, endpoint)
+        return connection
+
+    def _dialed(self, connection, contact):
+        for d in self.dialing.pop(contact, ()):
+            d.callback(connection)
+
+    def _dialFailed(self, failure, contact):
+        waiting = self.dialing.pop(contact, ())
+        if contact not in self.connections:
+            self.statusChanged(contact, OFFLINE)
+        for d in waiting:
+            d.errback(failure)
+
+    def authenticated(self, connection):
+        """
+        Register C{connection} now that the TLS handshake completed.
+        """
+        tlsConnection = connection.transport.getHandle()
+        self.sessions.handshake(sessionReused(tlsConnection))
+        fingerprint = connection.peerFingerprint()
+        if connection.outgoing:
+            contact = connection.contact
+            if (fingerprint is None
+                or fingerprint != contact.fingerprint(PIN_DIGEST)):
+                self._reject(connection, "certificate mismatch")
+                return
+            # with TLS 1.3 the client finishes the handshake before the
+            # server has checked its certificate; wait for the first
+            # answer before trusting the connection.
+            d = connection.callRemote(Ping)
+            d.addCallbacks(lambda result: self._register(connection),
+                           self._unconfirmed, errbackArgs=(connection,))
+            return
+        else:
+            contact = None
+            if fingerprint is not None:
+                contact = self.index.lookup(fingerprint, self.account)
+            if contact is None:
+                self._reject(connection, "unknown peer")
+                return
+            connection.contact = contact
+        self._register(connection)
+
+    def _unconfirmed(self, failure, connection):
+        log.msg("peer connection not confirmed: %s"
+                % (failure.getErrorMessage(),))
+        self._cancelDeadline(connection)
+        self.sessions.discard(connection.contact)
+        connection.factory.failed(failure)
+        connection.transport.abortConnection()
+
+    def expired(self, connection):
+        """
+        Close C{connection}, which was not authenticated in time.
+        """
+        connection.deadline = None
+        self._reject(connection, "handshake timed out")
+
+    def _cancelDeadline(self, connection):
+        if connection.deadline is not None:
+            if connection.deadline.active():
+                connection.deadline.cancel()
+            connection.deadline = None
+
+    def _register(self, connection):
+        self._cancelDeadline(connection)
+        contact = connection.contact
+        if connection.outgoing:
+            self.sessions.put(contact,
+                              connection.transport.getHandle().get_session())
+        existing = self.connections.get(contact)
+        if existing is not None:
+            # a connection in the same direction replaces the existing
+            # one, which is probably half-open after the peer went away.
+            if (existing.outgoing != connection.outgoing
+                and self._initiator(existing) <= self._initiator(connection)):
+                connection.transport.loseConnection()
+                if connection.outgoing:
+                    connection.factory.connected(existing)
+                return
+            existing.transport.loseConnection()
+        self.connections[contact] = connection
+        self.statusChanged(contact, CONNECTED)
+        if connection.outgoing:
+            connection.factory.connected(connection)
+
+    def _initiator(self, connection):
+        if connection.outgoing:
+            return certificateFingerprint(self.account.cert, PIN_DIGEST)
+        return connection.contact.fingerprint(PIN_DIGEST)
+
+    def _reject(self, connection, reason):
+        log.msg("rejecting peer connection: %s" % (reason,))
+        self._cancelDeadline(connection)
+        if connection.outgoing:
+            self.sessions.discard(connection.contact)
+            connection.factory.failed(PeerError(reason))
+        connection.transport.abortConnection()
+
+    def lost(self, connection, reason):
+        """
+        Forget C{connection}, which was closed.
+        """
+        self._cancelDeadline(connection)
+        contact = connection.contact
+        if contact is not None and self.connections.get(contact) is connection:
+            del self.connections[contact]
+            self.statusChanged(contact, OFFLINE)
+
+    def _keepalive(self):
+        now = self.clock()
+        for contact, connection in self.connections.items():
+            if now - connection.lastUse > self.idleTimeout:
+                connection.transport.loseConnection()
+            elif connection.pinging:
+                # the previous keepalive was never answered.
+                connection.transport.abortConnection()
+            else:
+                connection.pinging = True
+                d = connection.callRemote(Ping)
+                d.addCallback(self._pong, connection)
+                d.addErrback(lambda failure: None)
+
+    def _pong(self, result, connection):
+        connection.pinging = False
+
+    def stop(self):
+        """
+        Close all connections and stop listening.
+        """
+        if self.keepalive.running:
+            self.keepalive.stop()
+        self.index.removeAccount(self.account)
+        self.account.removeObserver(self.contextFactory.accountChanged)
+        for port in self.ports:
+            port.stopListening()
+        self.ports = list()
+        for connection in self.connections.values():
+            connection.transport.loseConnection()
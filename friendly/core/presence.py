@@ -0,0 +1,106 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Coalescing of contact status updates.
+
+Presence changes can arrive in bursts, for example when all peers
+reconnect after the network comes back.  Rather than redrawing the
+contact list for each of them, changes are buffered per contact and
+applied in batches, at most C{rate} times per second.
+"""
+
+import time
+
+
+class StatusAggregator(object):
+    """
+    Buffers status changes and applies them in rate limited batches.
+
+    Only the latest status of each contact is kept; a contact that
+    changes back to the status it had when the batch started is left
+    out of the batch.
+
+    @ivar apply: callable that is given a C{dict} mapping contacts to
+        their new status.
+    @ivar updates: number of status changes received.
+    @ivar flushes: number of batches applied.
+    """
+
+    def __init__(self, apply, rate=30, reactor=None, clock=time.time):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.apply = apply
+        self.interval = 1.0 / rate
+        self.reactor = reactor
+        self.clock = clock
+        self.pending = dict()
+        self.delayedCall = None
+        self.lastFlush = None
+        self.updates = 0
+        self.flushes = 0
+
+    def setStatus(self, contact, status):
+        """
+        Queue a change of the status of C{contact} to C{status}.
+        """
+        self.updates += 1
+        if contact in self.pending:
+            if self.pending[contact] == status:
+                return
+        elif contact.status == status:
+            return
+        self.pending[contact] = status
+        if self.delayedCall is None:
+            delay = 0
+            if self.lastFlush is not None:
+                delay = max(0, self.lastFlush + self.interval
+                            - self.clock())
+            self.delayedCall = self.reactor.callLater(delay, self.flush)
+
+    def flush(self):
+        """
+        Apply all queued changes now.
+        """
+        if self.delayedCall is not None and self.delayedCall.active():
+            self.delayedCall.cancel()
+        self.delayedCall = None
+        batch, self.pending = self.pending, dict()
+        batch = dict((contact, status)
+                     for (contact, status) in batch.iteritems()
+                     if contact.status != status)
+        self.lastFlush = self.clock()
+        if batch:
+            self.flushes += 1
+            self.apply(batch)
+
+    def stop(self):
+        """
+        Drop all queued changes.
+        """
+        if self.delayedCall is not None and self.delayedCall.active():
+            self.delayedCall.cancel()
+        self.delayedCall = None
+        self.pending.clear()
@@ -0,0 +1,249 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Prefix index over the names and email addresses of contacts, for
+type-ahead search.
+
+Every contact is split into lower case words.  Each word maps to the
+contacts that have it, and the words are kept in a sorted list so
+that all contacts with a word starting with a prefix can be found by
+bisection, in time proportional to the number of matches.  New words
+are merged into the sorted list in bulk, when it is next searched.
+"""
+
+import re
+from bisect import bisect_left
+
+from friendly.core.model import INSERTED, REMOVED, UPDATED
+
+
+_words = re.compile(r'\w+', re.UNICODE)
+
+
+def contactWords(contact):
+    """
+    Return the set of words C{contact} can be found by.
+    """
+    words = set()
+    for text in (contact.name, contact.email):
+        if text:
+            text = text.lower()
+            words.add(text)
+            words.update(_words.findall(text))
+    return words
+
+
+def queryWords(query):
+    """
+    Return the words of search string C{query}, longest first.
+    """
+    words = _words.findall((query or u"").lower())
+    words.sort(key=len, reverse=True)
+    return words
+
+
+def matchWords(contactWords, words):
+    """
+    Return C{True} if every word of C{words} is a prefix of one of
+    C{contactWords}.
+    """
+    for word in words:
+        for contactWord in contactWords:
+            if contactWord.startswith(word):
+                break
+        else:
+            return False
+    return True
+
+
+class ContactIndex(object):
+    """
+    Prefix index over the contacts of a set of accounts.
+
+    The index follows changes to the accounts added to it.
+
+    @ivar postings: C{dict} mapping words to the keys of the contacts
+        that have them.
+    @ivar sortedWords: sorted C{list} of the words, which may still
+        hold words that are gone; C{newWords} are yet to be merged
+        into it.
+    @ivar generation: bumped on every change to the index, so that
+        cached search results can be invalidated.
+    """
+
+    def __init__(self):
+        self.contacts = {}
+        self.words = {}
+        self.postings = {}
+        self.sortedWords = []
+        self.newWords = []
+        self.stale = 0
+        self.generation = 0
+
+    def addAccount(self, account):
+        """
+        Index the contacts of C{account} and follow its changes.
+        """
+        for contact in account.contacts:
+            self.add(contact)
+        account.addObserver(self.accountChanged)
+
+    def removeAccount(self, account):
+        """
+        Stop following C{account} and drop its contacts.
+        """
+        account.removeObserver(self.accountChanged)
+        for contact in account.contacts:
+            self.remove(contact)
+
+    def accountChanged(self, account, kind, indexes, contacts):
+        if kind == INSERTED:
+            for contact in contacts:
+                self.add(contact)
+        elif kind == REMOVED:
+            for contact in contacts:
+                self.remove(contact)
+        elif kind == UPDATED:
+            for contact in contacts:
+                self.remove(contact)
+                self.add(contact)
+
+    def add(self, contact):
+        key = id(contact)
+        if key in self.contacts:
+            return
+        words = contactWords(contact)
+        self.contacts[key] = contact
+        self.words[key] = words
+        for word in words:
+            keys = self.postings.get(word)
+            if keys is None:
+                keys = self.postings[word] = set()
+                self.newWords.append(word)
+            keys.add(key)
+        self.generation += 1
+
+    def remove(self, contact):
+        key = id(contact)
+        if self.contacts.pop(key, None) is None:
+            return
+        for word in self.words.pop(key):
+            keys = self.postings[word]
+            keys.discard(key)
+            if not keys:
+                # left in the sorted list until it is rebuilt.
+                del self.postings[word]
+                self.stale += 1
+        self.generation += 1
+
+    def _sortedWords(self):
+        if self.stale > len(self.postings):
+            self.sortedWords = sorted(self.postings)
+            self.newWords = []
+            self.stale = 0
+        elif self.newWords:
+            # the sort merges the new words into the sorted run.
+            self.sortedWords.extend(self.newWords)
+            self.sortedWords.sort()
+            self.newWords = []
+        return self.sortedWords
+
+    def prefixed(self, prefix):
+        """
+        Return the keys of all contacts with a word starting with
+        C{prefix}.
+        """
+        keys = set()
+        words = self._sortedWords()
+        index = bisect_left(words, prefix)
+        while index < len(words) and words[index].startswith(prefix):
+            keys.update(self.postings.get(words[index], ()))
+            index += 1
+        return keys
+
+    def search(self, query):
+        """
+        Return the contacts matching every word of C{query}, or
+        C{None} if C{query} has no words.
+        """
+        words = queryWords(query)
+        if not words:
+            return None
+        return self.filter(self.prefixed(words[0]), words[1:])
+
+    def filter(self, keys, words):
+        """
+        Return the contacts of C{keys} that match all C{words}.
+        """
+        return [self.contacts[key] for key in keys
+                if key in self.contacts
+                and matchWords(self.words[key], words)]
+
+
+class SearchSession(object):
+    """
+    Successive searches as the user types.
+
+    A query that extends the previous one is answered by filtering
+    the previous result rather than consulting the index, as long as
+    the index has not changed in between.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.query = None
+        self.words = None
+        self.results = None
+        self.generation = None
+
+    def refines(self, words):
+        """
+        Return C{True} if every word of the previous query is a
+        prefix of some word of C{words}.
+        """
+        if not self.words or self.generation != self.index.generation:
+            return False
+        return matchWords(words, self.words)
+
+    def search(self, query):
+        """
+        Return the contacts matching C{query}, or C{None} if all
+        contacts match.
+        """
+        words = queryWords(query)
+        if not words:
+            results = None
+        elif self.refines(words):
+            results = self.index.filter(
+                [id(contact) for contact in self.results], words
+                )
+        else:
+            results = self.index.search(query)
+        self.query = query
+        self.words = words
+        self.results = results
+        self.generation = self.index.generation
+        return results
@@ -0,0 +1,299 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Persistence of accounts and contacts in an SQLite database.
+
+Every change to an account or its contacts is turned into statements
+touching only the affected rows.  The statements are written behind,
+in a single transaction per batch, from a worker thread.
+Certificates of contacts are only read from the database when they
+are needed.  Private keys of accounts are encrypted with a passphrase
+kept outside of the database.
+"""
+
+import sqlite3
+
+from friendly.core.writebehind import WriteBehindScheduler
+
+from friendly.core.model import (Account, Contact, normalizeEmail,
+                                 INSERTED, REMOVED, UPDATED)
+from friendly.core.store import (dumpCertificate, loadCertificate,
+                                 isEncrypted)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY,
+    displayName TEXT,
+    cert TEXT,
+    announceList TEXT,
+    listenPort INTEGER
+);
+CREATE TABLE IF NOT EXISTS contacts (
+    id INTEGER PRIMARY KEY,
+    account INTEGER NOT NULL REFERENCES accounts (id),
+    name TEXT,
+    email TEXT,
+    normalizedEmail TEXT,
+    cert BLOB,
+    fingerprint TEXT,
+    status INTEGER,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS contactsByAccount ON contacts (account);
+CREATE INDEX IF NOT EXISTS contactsByEmail ON contacts (normalizedEmail);
+CREATE INDEX IF NOT EXISTS contactsByFingerprint ON contacts (fingerprint);
+"""
+
+
+class SQLiteAccountStore(object):
+    """
+    Store of accounts in an SQLite database.
+
+    Accounts loaded from or added to the store are observed, and
+    their changes written to the database.  Identifiers of new rows
+    are assigned by the store, so that changes can be queued before
+    the rows have been written.
+
+    @ivar writer: the L{WriteBehindScheduler} writing the changes.
+    @ivar passphrase: the passphrase encrypting the private keys of
+        the accounts, or C{None} to store them unencrypted.
+    """
+
+    def __init__(self, path, delay=0.5, reactor=None, passphrase=None):
+        self.path = path
+        self.passphrase = passphrase
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self._migrate()
+        self.connection.commit()
+        # only ever used by one write at a time, from the worker
+        # threads of the writer.
+        self.writeConnection = sqlite3.connect(path,
+                                               check_same_thread=False)
+        self.nextAccountId = self._nextId('accounts')
+        self.nextContactId = self._nextId('contacts')
+        self.writer = WriteBehindScheduler(self._write, delay=delay,
+                                           reactor=reactor)
+
+    def _migrate(self):
+        """
+        Add the columns missing from databases created by earlier
+        versions.
+        """
+        for table, column, kind in (('accounts', 'announceList', 'TEXT'),
+                                    ('accounts', 'listenPort', 'INTEGER'),
+                                    ('contacts', 'sha256', 'TEXT')):
+            columns = [row[1] for row in self.connection.execute(
+                    "PRAGMA table_info(%s)" % (table,))]
+            if column not in columns:
+                self.connection.execute(
+                    "ALTER TABLE %s ADD COLUMN %s %s" % (table, column, kind)
+                    )
+
+    def _nextId(self, table):
+        row = self.connection.execute(
+            "SELECT MAX(id) FROM %s" % (table,)
+            ).fetchone()
+        return (row[0] or 0) + 1
+
+    def _write(self, batch):
+        """
+        Write a batch of statements in a single transaction.
+        """
+        connection = self.writeConnection
+        try:
+            for statement, rows in batch:
+                connection.executemany(statement, rows)
+        except:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    def execute(self, statement, rows):
+        """
+        Queue C{statement} to be executed for each of C{rows}.
+        """
+        if rows:
+            self.writer.schedule((statement, rows))
+
+    def commit(self):
+        """
+        Request that the queued changes are written soon.
+        """
+        self.writer.schedule()
+
+    def flush(self):
+        """
+        Write the queued changes now.
+
+        @return: a L{Deferred} that fires when they are written.
+        """
+        return self.writer.flush()
+
+    def close(self):
+        self.connection.close()
+        self.writeConnection.close()
+
+    def load(self):
+        """
+        Load all accounts and their contacts.  Certificates of the
+        contacts are loaded when first used, but the other columns of
+        every contact are read here, since accounts hold their contacts
+        in a list.
+
+        Private keys stored unencrypted by earlier versions are
+        encrypted with the passphrase of the store, if it has one.
+        """
+        accounts = list()
+        rows = self.connection.execute(
+            "SELECT id, displayName, cert, announceList, listenPort "
+            "FROM accounts ORDER BY id"
+            ).fetchall()
+        for accountId, displayName, cert, announceList, listenPort in rows:
+            account = Account(displayName,
+                              loadCertificate(cert, self.passphrase),
+                              (announceList or u"").split(),
+                              listenPort)
+            account.storeId = accountId
+            if (self.passphrase is not None
+                and hasattr(account.cert, 'privateKey')
+                and not isEncrypted(cert)):
+                self.execute("UPDATE accounts SET cert = ? WHERE id = ?",
+                             [(self.accountRow(account)[1], accountId)])
+            contacts = list()
+            for (contactId, name, email, fingerprint, status,
+                 sha256) in self.connection.execute(
+                "SELECT id, name, email, fingerprint, status, sha256 "
+                "FROM contacts WHERE account = ? ORDER BY id", (accountId,)):
+                certLoader = None
+                if fingerprint is not None:
+                    certLoader = lambda contactId=contactId: \
+                        self.loadCertificateBytes(contactId)
+                fingerprints = None
+                if sha256 is not None:
+                    fingerprints = {'sha256': sha256}
+                contact = Contact(name, email, status=status,
+                                  certLoader=certLoader,
+                                  fingerprint=fingerprint,
+                                  fingerprints=fingerprints)
+                contact.storeId = contactId
+                contacts.append(contact)
+            account.addContacts(contacts)
+            account.addObserver(self.accountChanged)
+            accounts.append(account)
+        return accounts
+
+    def loadCertificateBytes(self, contactId):
+        """
+        Return the DER encoding of the certificate of a contact.
+        """
+        row = self.connection.execute(
+            "SELECT cert FROM contacts WHERE id = ?", (contactId,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return str(row[0])
+
+    def addAccount(self, account):
+        """
+        Add C{account} and its contacts to the store.
+        """
+        account.storeId = self.nextAccountId
+        self.nextAccountId += 1
+        self.execute(
+            "INSERT INTO accounts (id, displayName, cert, announceList, "
+            "listenPort) VALUES (?, ?, ?, ?, ?)",
+            [(account.storeId,) + self.accountRow(account)]
+            )
+        self.insertContacts(account, account.contacts)
+        account.addObserver(self.accountChanged)
+
+    def removeAccount(self, account):
+        """
+        Remove C{account} and its contacts from the store.
+        """
+        account.removeObserver(self.accountChanged)
+        self.execute("DELETE FROM contacts WHERE account = ?",
+                     [(account.storeId,)])
+        self.execute("DELETE FROM accounts WHERE id = ?",
+                     [(account.storeId,)])
+        account.storeId = None
+
+    def accountRow(self, account):
+        """
+        Return the column values of C{account}, other than its id.
+        """
+        return (account.displayName,
+                dumpCertificate(account.cert, self.passphrase),
+                u"\n".join(account.announceList), account.listenPort)
+
+    def contactRow(self, contact):
+        certBytes = contact.certificateBytes()
+        if certBytes is not None:
+            certBytes = sqlite3.Binary(certBytes)
+        return (contact.name, contact.email, normalizeEmail(contact.email),
+                certBytes, contact.fingerprint(), contact.status,
+                contact.fingerprint('sha256'))
+
+    def insertContacts(self, account, contacts):
+        rows = list()
+        for contact in contacts:
+            contact.storeId = self.nextContactId
+            self.nextContactId += 1
+            rows.append((contact.storeId, account.storeId)
+                        + self.contactRow(contact))
+        self.execute(
+            "INSERT INTO contacts (id, account, name, email, "
+            "normalizedEmail, cert, fingerprint, status, sha256) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def accountChanged(self, account, kind, indexes, contacts):
+        """
+        Queue a change of C{account} to be written to the database.
+        """
+        if kind == INSERTED:
+            self.insertContacts(account, contacts)
+        elif kind == REMOVED:
+            self.execute("DELETE FROM contacts WHERE id = ?",
+                         [(contact.storeId,) for contact in contacts])
+            for contact in contacts:
+                contact.storeId = None
+        elif kind == UPDATED and not contacts:
+            self.execute(
+                "UPDATE accounts SET displayName = ?, cert = ?, "
+                "announceList = ?, listenPort = ? WHERE id = ?",
+                [self.accountRow(account) + (account.storeId,)]
+                )
+        elif kind == UPDATED:
+            self.execute(
+                "UPDATE contacts SET name = ?, email = ?, "
+                "normalizedEmail = ?, cert = ?, fingerprint = ?, "
+                "status = ?, sha256 = ? WHERE id = ?",
+                [self.contactRow(contact) + (contact.storeId,)
+                 for contact in contacts]
+                )
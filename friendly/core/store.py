@@ -0,0 +1,92 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Encoding of the certificates of accounts and contacts for storage.
+"""
+
+
+# cipher protecting private keys dumped with a passphrase.
+KEY_CIPHER = 'aes-256-cbc'
+
+
+class PassphraseError(Exception):
+    """
+    A private key could not be decrypted with the passphrase given.
+    """
+
+
+def dumpCertificate(cert, passphrase=None):
+    """
+    Return the PEM encoding of C{cert}, including the private key if
+    there is one.
+
+    @param passphrase: if given, the private key is encrypted with
+        it.
+    """
+    if cert is None:
+        return None
+    if passphrase is None or not hasattr(cert, 'privateKey'):
+        return cert.dumpPEM()
+    from OpenSSL import crypto
+    return (cert.dump(crypto.FILETYPE_PEM)
+            + crypto.dump_privatekey(crypto.FILETYPE_PEM,
+                                     cert.privateKey.original,
+                                     KEY_CIPHER, passphrase))
+
+
+def isEncrypted(pem):
+    """
+    Return true if the private key in C{pem} is encrypted.
+    """
+    return pem is not None and 'ENCRYPTED PRIVATE KEY' in pem
+
+
+def loadCertificate(pem, passphrase=None):
+    """
+    Load a certificate dumped with L{dumpCertificate}.
+
+    @param passphrase: the passphrase the private key was encrypted
+        with, if it was.
+    @raise PassphraseError: if the private key cannot be decrypted.
+    """
+    if pem is None:
+        return None
+    from twisted.internet.ssl import Certificate, PrivateCertificate
+    pem = str(pem)
+    if isEncrypted(pem):
+        from OpenSSL import crypto
+        from twisted.internet.ssl import KeyPair
+        try:
+            key = crypto.load_privatekey(crypto.FILETYPE_PEM, pem,
+                                         passphrase or '')
+        except crypto.Error, e:
+            raise PassphraseError(e)
+        return PrivateCertificate.fromCertificateAndKeyPair(
+            Certificate.loadPEM(pem), KeyPair(key))
+    if 'PRIVATE KEY' in pem:
+        return PrivateCertificate.loadPEM(pem)
+    return Certificate.loadPEM(pem)
+
@@ -0,0 +1,163 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Write-behind persistence.
+
+Changes are queued and written in batches: all changes requested
+within C{delay} seconds of each other end up in a single write, which
+is done in a worker thread.  A batch that fails to be written is
+logged and queued again, ahead of the changes made since.
+"""
+
+import time
+
+from twisted.internet import defer, threads
+from twisted.python import log
+
+
+class WriteBehindScheduler(object):
+    """
+    Coalesces queued changes into batched writes.
+
+    @ivar prepare: callable that is given the list of queued changes
+        in the reactor thread, and returns what should be written.
+    @ivar write: callable that is given the result of C{prepare} in a
+        worker thread, and writes it.
+    @ivar writes: number of writes done.
+    @ivar failures: number of writes that failed in a row.  Failed
+        batches are retried after C{delay} seconds, doubled for every
+        failure up to C{maxRetryDelay} seconds.
+    @ivar requests: number of changes queued.
+    @ivar writeTime: total time spent writing, in seconds.
+    @ivar lastWriteTime: time spent on the last write, in seconds.
+    """
+    maxRetryDelay = 60
+
+    def __init__(self, write, prepare=list, delay=0.5, reactor=None,
+                 clock=time.time):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.write = write
+        self.prepare = prepare
+        self.delay = delay
+        self.reactor = reactor
+        self.clock = clock
+        self.pending = list()
+        self.requested = False
+        self.delayedCall = None
+        self.writing = None
+        self.waiting = list()
+        self.writes = 0
+        self.failures = 0
+        self.requests = 0
+        self.writeTime = 0.0
+        self.lastWriteTime = 0.0
+
+    def schedule(self, change=None):
+        """
+        Queue C{change} and make sure it is written within C{delay}
+        seconds.  Without a change, only request a write.
+        """
+        if change is not None:
+            self.pending.append(change)
+        self.requests += 1
+        self.requested = True
+        if self.delayedCall is None and self.writing is None:
+            self.delayedCall = self.reactor.callLater(self.delay,
+                                                      self._flush)
+
+    def flush(self):
+        """
+        Write all queued changes now.
+
+        @return: a L{Deferred} that fires when everything queued so
+            far has been written.
+        """
+        d = defer.Deferred()
+        if not self.requested and self.writing is None:
+            d.callback(None)
+            return d
+        self.waiting.append(d)
+        if self.writing is None:
+            self._flush()
+        return d
+
+    def _flush(self):
+        if self.delayedCall is not None and self.delayedCall.active():
+            self.delayedCall.cancel()
+        self.delayedCall = None
+        if not self.requested:
+            waiting, self.waiting = self.waiting, list()
+            for d in waiting:
+                d.callback(None)
+            return
+        batch, self.pending = self.pending, list()
+        self.requested = False
+        waiting, self.waiting = self.waiting, list()
+        payload = self.prepare(batch)
+        self.writing = threads.deferToThread(self._write, payload)
+        self.writing.addCallback(self._written, waiting)
+        self.writing.addErrback(self._failed, batch, waiting)
+
+    def _write(self, payload):
+        start = self.clock()
+        self.write(payload)
+        return self.clock() - start
+
+    def _written(self, duration, waiting):
+        self.writing = None
+        self.writes += 1
+        self.failures = 0
+        self.writeTime += duration
+        self.lastWriteTime = duration
+        if not self.requested:
+            # nothing was queued since; flushes requested meanwhile
+            # fire after those of this write, in order.
+            waiting, self.waiting = waiting + self.waiting, list()
+        self._next()
+        for d in waiting:
+            d.callback(None)
+
+    def _failed(self, failure, batch, waiting):
+        self.writing = None
+        self.failures += 1
+        log.err(failure, "write-behind failed, retrying")
+        self.pending[:0] = batch
+        self.requested = True
+        self._next()
+        for d in waiting:
+            d.errback(failure)
+
+    def _next(self):
+        # changes queued while writing wait for the next write.
+        if self.waiting:
+            self._flush()
+        elif self.requested and self.delayedCall is None:
+            delay = self.delay
+            if self.failures:
+                delay = min(self.maxRetryDelay,
+                            delay * 2 ** self.failures)
+            self.delayedCall = self.reactor.callLater(delay, self._flush)
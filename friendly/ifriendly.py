@@ -10,3 +10,15 @@ class IContactImporter(Interface):
         Returns a deferred that will be called with a list of
         dictionaries.
         """
+
+
+class IStreamingContactImporter(IContactImporter):
+
+    def streamContacts(username, password, progress, received):
+        """
+        Import contacts, delivering them as they are parsed.
+
+        C{received} is called one or more times with a list of
+        dictionaries.  Returns a deferred that will be called with
+        the total number of contacts when the import is done.
+        """
@@ -0,0 +1,129 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Running several contact importers at once.
+"""
+
+from twisted.internet import defer
+from twisted.python import log
+
+from friendly.ifriendly import IStreamingContactImporter
+from friendly.core.model import normalizeEmail
+
+
+class AllImportsFailed(Exception):
+    """
+    Every source of a L{MultiServiceImport} failed.  The failures
+    were logged as they happened.
+
+    @ivar failures: the failure of each source.
+    """
+
+    def __init__(self, failures):
+        Exception.__init__(self, "every contact import failed")
+        self.failures = failures
+
+
+class MultiServiceImport(object):
+    """
+    Import contacts from several services concurrently, merging the
+    results as they arrive.
+
+    Contacts are deduplicated by normalized email, across sources and
+    against the addresses in C{seen}.
+
+    @ivar sources: C{list} of C{(importer, username, password)}
+        tuples.
+    @ivar received: callable that is called with lists of new
+        contacts.
+    @ivar progress: callable that is called with status messages.
+    """
+
+    def __init__(self, sources, received, progress, concurrency=2,
+                 seen=None):
+        self.sources = sources
+        self.received = received
+        self.progress = progress
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.seen = set(seen or ())
+        self.count = 0
+        self.failures = list()
+
+    def merge(self, contacts):
+        """
+        Pass the contacts not seen before on to C{received}.
+        """
+        fresh = list()
+        for contact in contacts:
+            email = normalizeEmail(contact['email'])
+            if email is None or email in self.seen:
+                continue
+            self.seen.add(email)
+            fresh.append(contact)
+        if fresh:
+            self.count += len(fresh)
+            self.received(fresh)
+
+    def importFrom(self, importer, username, password):
+        """
+        Import contacts from a single source.
+        """
+        def progress(message):
+            self.progress("%s: %s" % (importer.description, message))
+        if IStreamingContactImporter.providedBy(importer):
+            d = importer.streamContacts(username, password, progress,
+                                        self.merge)
+        else:
+            d = importer.importContacts(username, password, progress)
+            d.addCallback(self.merge)
+        d.addErrback(self._failed, progress)
+        return d
+
+    def _failed(self, failure, progress):
+        progress("Failed to import")
+        log.err(failure, "contact import failed")
+        self.failures.append(failure)
+
+    def _done(self, results):
+        if self.failures and len(self.failures) == len(self.sources):
+            raise AllImportsFailed(self.failures)
+        return self.count
+
+    def start(self):
+        """
+        Start importing from all sources, at most C{concurrency} at a
+        time.
+
+        @return: a L{Deferred} that will be called with the number of
+            new contacts when all sources are done, or errbacked with
+            L{AllImportsFailed} if all of them failed.
+        """
+        d = defer.gatherResults([
+                self.semaphore.run(self.importFrom, *source)
+                for source in self.sources
+                ])
+        d.addCallback(self._done)
+        return d
@@ -0,0 +1,106 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Passphrases kept in the keychain of the user.
+
+The keychain is reached through the C{security} tool, since there
+are no bindings for the Security framework.
+"""
+
+import os, base64, subprocess
+
+
+SECURITY = '/usr/bin/security'
+
+# exit status of the security tool when there is no such item
+# (errSecItemNotFound).
+ITEM_NOT_FOUND = 44
+
+
+class KeychainError(Exception):
+    """
+    The keychain could not be read or written, for example because
+    it is locked or the user denied access.
+    """
+
+
+def _run(arguments, input=None):
+    process = subprocess.Popen(
+        [SECURITY] + arguments, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = process.communicate(input)
+    return process.returncode, output, error
+
+
+def findPassphrase(service, account):
+    """
+    Return the passphrase stored for C{account} of C{service}, or
+    C{None} if there is none.
+
+    @raise KeychainError: if the keychain could not be read.
+    """
+    status, output, error = _run(['find-generic-password', '-s', service,
+                                  '-a', account, '-w'])
+    if status == ITEM_NOT_FOUND:
+        return None
+    if status != 0:
+        raise KeychainError(error.strip() or "security exited with %d"
+                            % (status,))
+    return output.rstrip('\n')
+
+
+def storePassphrase(service, account, passphrase):
+    """
+    Store C{passphrase} for C{account} of C{service}.  An existing
+    item is never replaced.
+
+    The passphrase is given to the security tool on its standard
+    input, so that it does not show up in the process list.
+
+    @raise KeychainError: if the passphrase could not be stored.
+    """
+    # -w must come last to be prompted for, once and to confirm.
+    status, output, error = _run(['add-generic-password', '-s', service,
+                                  '-a', account, '-w'],
+                                 '%s\n%s\n' % (passphrase, passphrase))
+    if status != 0:
+        raise KeychainError(error.strip() or "security exited with %d"
+                            % (status,))
+
+
+def passphraseFor(service, account):
+    """
+    Return the passphrase stored for C{account} of C{service},
+    storing a new random one if there is none.
+
+    @raise KeychainError: if the keychain could not be used.
+    """
+    passphrase = findPassphrase(service, account)
+    if passphrase is None:
+        passphrase = base64.b64encode(os.urandom(32))
+        storePassphrase(service, account, passphrase)
+    return passphrase
@@ -0,0 +1,119 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Generation of key pairs outside of the main thread.
+
+RSA key generation is slow enough to stall both the user interface
+and the interleaved reactor, so it is done in the reactor thread
+pool.  L{KeyPairPool} keeps a few key pairs ready in advance so that
+creating an account only has to sign the certificate.
+"""
+
+from twisted.internet import defer, threads
+from twisted.internet.ssl import KeyPair
+from twisted.python import log
+
+
+def generateKeyPair():
+    """
+    Generate a new key pair in a worker thread.
+
+    @return: a L{Deferred} that will be called with the L{KeyPair}.
+    """
+    return threads.deferToThread(KeyPair.generate)
+
+
+class KeyPairPool(object):
+    """
+    Pool of pre-generated key pairs.
+
+    @ivar size: number of key pairs to keep ready.
+    @ivar retryDelay: seconds to wait before generating again after
+        a generation nobody was waiting for failed.
+    """
+    retryDelay = 30
+
+    def __init__(self, size=1, generate=generateKeyPair, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.size = size
+        self.generate = generate
+        self.reactor = reactor
+        self.keyPairs = []
+        self.waiting = []
+        self.pending = 0
+        self.refill = None
+
+    def fill(self):
+        """
+        Start generating key pairs until the pool holds C{size} of
+        them, in addition to those already promised to callers.
+        """
+        while (len(self.keyPairs) + self.pending
+               < self.size + len(self.waiting)):
+            self.pending += 1
+            d = self.generate()
+            d.addCallbacks(self._generated, self._failed)
+
+    def _generated(self, keyPair):
+        self.pending -= 1
+        if self.waiting:
+            self.waiting.pop(0).callback(keyPair)
+        else:
+            self.keyPairs.append(keyPair)
+
+    def _failed(self, failure):
+        self.pending -= 1
+        if self.waiting:
+            self.waiting.pop(0).errback(failure)
+            return
+        log.err(failure, "key pair generation failed")
+        if self.refill is None:
+            self.refill = self.reactor.callLater(self.retryDelay,
+                                                 self._refill)
+
+    def _refill(self):
+        self.refill = None
+        self.fill()
+
+    def get(self):
+        """
+        Get a key pair from the pool and start generating a
+        replacement.
+
+        @return: a L{Deferred} that will be called with the
+            L{KeyPair}.
+        """
+        if self.keyPairs:
+            d = defer.succeed(self.keyPairs.pop(0))
+        else:
+            d = defer.Deferred()
+            self.waiting.append(d)
+        self.fill()
+        return d
+
+
+keyPairPool = KeyPairPool()
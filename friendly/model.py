@@ -3,92 +3,271 @@
 #
 
 from Foundation import *
-from OpenSSL import crypto
-from twisted.internet.ssl import Certificate
+
+from friendly.core import model as core
+from friendly.core.model import normalizeEmail, certificateFingerprint
+
+
+CONTACT_KEYS = ('name', 'email', 'status', 'endpoint', 'cert')
+
+
+def coreProperty(key, doc=None):
+    """
+    Return a property that reads and writes attribute C{key} of the
+    wrapped core object, with key-value observing notifications.
+    """
+    def get(self):
+        return getattr(self.core, key)
+    def set(self, value):
+        self.willChangeValueForKey_(key)
+        self.core.update(**{key: value})
+        self.didChangeValueForKey_(key)
+    return property(get, set, doc=doc)
+
+
+class WrapperCache(object):
+    """
+    Cache of the L{Contact} wrappers of core contacts.
+
+    Wrappers are only created for the contacts the user interface
+    actually asks for.  When there are more than twice C{size} of
+    them, the least recently used are dropped until C{size} remain.
+    A dropped wrapper that is still referenced elsewhere keeps
+    working, but a new one is created the next time it is asked for.
+
+    Wrappers that are handed to an array controller are pinned
+    instead: the controller holds on to them, and one dropped under it
+    would no longer be told about changes to its contact.  Pinned
+    wrappers are only dropped when their contact is discarded.
+
+    @ivar pinned: C{set} of the core contacts whose wrappers are
+        pinned.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.tick = 0
+        self.used = dict()
+        self.pinned = set()
+
+    def wrapperForContact(self, contact, pin=False):
+        """
+        Return the wrapper of core contact C{contact}, pinning it if
+        C{pin} is true.
+        """
+        if contact.wrapper is None:
+            Contact.alloc().initWithContact_(contact)
+        if pin:
+            if contact not in self.pinned:
+                self.pinned.add(contact)
+                self.used.pop(contact, None)
+        elif contact not in self.pinned:
+            self.tick += 1
+            self.used[contact] = self.tick
+        return contact.wrapper
+
+    def adopt(self, contact):
+        """
+        Start caching the wrapper of C{contact}.
+        """
+        if contact in self.pinned:
+            return
+        self.tick += 1
+        self.used[contact] = self.tick
+        if len(self.used) > 2 * self.size:
+            self.evict()
+
+    def evict(self):
+        contacts = sorted(self.used, key=self.used.get)
+        for contact in contacts[:-self.size]:
+            contact.wrapper = None
+            del self.used[contact]
+
+    def discard(self, contact):
+        """
+        Stop caching the wrapper of C{contact}.
+        """
+        if self.used.pop(contact, None) is not None:
+            contact.wrapper = None
+        elif contact in self.pinned:
+            self.pinned.remove(contact)
+            contact.wrapper = None
+
+
+wrappers = WrapperCache()
+
+
+def wrapperForContact(contact, pin=False):
+    """
+    Return the L{Contact} wrapping core contact C{contact}.
+
+    @param pin: whether the wrapper is going to be held by an array
+        controller, see L{WrapperCache}.
+    """
+    return wrappers.wrapperForContact(contact, pin)
+
+
+def indexSet(indexes):
+    """
+    Return an C{NSIndexSet} holding C{indexes}.
+    """
+    indexSet = NSMutableIndexSet.indexSet()
+    for index in indexes:
+        indexSet.addIndex_(index)
+    return indexSet
+
+
+def indexList(indexes):
+    """
+    Return the indexes of L{NSIndexSet} C{indexes} as a sorted list.
+    """
+    result = list()
+    index = indexes.firstIndex()
+    while index != NSNotFound:
+        result.append(index)
+        index = indexes.indexGreaterThanIndex_(index)
+    return result
 
 
 class Contact(NSObject):
     """
+    Cocoa wrapper around a L{core.Contact}.
     """
-    name = objc.ivar('name')
-    email = objc.ivar('email')
-    cert = objc.ivar('cert')
-    status = objc.ivar('status')
-    account = objc.ivar('account')
-    endpont = objc.ivar('endpoint')
+    name = coreProperty('name')
+    email = coreProperty('email')
+    status = coreProperty('status')
+    endpoint = coreProperty('endpoint')
+    cert = coreProperty('cert', doc="""
+        Certificate of peer, loaded on first access if the contact
+        was unarchived.
+        """)
     
     def initWithName_andEmail_(self, name, email):
+        return self.initWithContact_(core.Contact(name, email))
+
+    def initWithContact_(self, contact):
+        """
+        Initialize wrapper around core contact C{contact}.
+        """
         self = NSObject.init(self)
         if self is None:
             return None
-        self.name = name
-        self.email = email
-        self.cert = None
-        self.status = 1
-        self.account = None
+        self.core = contact
+        contact.wrapper = self
+        wrappers.adopt(contact)
         return self
 
+    def coreContactDidChange(self):
+        """
+        Notify observers that the attributes of the wrapped core
+        contact have changed.
+        """
+        for key in CONTACT_KEYS:
+            self.willChangeValueForKey_(key)
+        for key in CONTACT_KEYS:
+            self.didChangeValueForKey_(key)
+
     def initWithCoder_(self, coder):
         """
         Initialize model object with the content from the L{NSCoder}.
+
+        The certificate is kept in its DER encoding and only loaded
+        when L{cert} is first accessed.
         """
-        self = NSObject.init(self)
-        if self is None:
-            return None
-        self.account = None
-        self.cert = None
-        self.name = coder.decodeObjectForKey_("name")
-        self.email = coder.decodeObjectForKey_("email")
+        name = coder.decodeObjectForKey_("name")
+        email = coder.decodeObjectForKey_("email")
         certBytes, lenBytes = coder.decodeBytesForKey_returnedLength_(
             "cert", None
             )
-        print lenBytes
         if lenBytes:
-            self.cert = Certificate.load(certBytes)
-        return self
+            contact = core.Contact(name, email, str(certBytes[:lenBytes]))
+            contact.fingerprint()
+        else:
+            contact = core.Contact(name, email)
+        return self.initWithContact_(contact)
 
     def encodeWithCoder_(self, coder):
         """
         Encode instance with L{NSCoder} provided in coder.
         """
-        coder.encodeObject_forKey_(self.name, "name")
-        coder.encodeObject_forKey_(self.email, "email")
-        if self.cert is not None:
-            certBytes = self.cert.dump()
-        else:
+        coder.encodeObject_forKey_(self.core.name, "name")
+        coder.encodeObject_forKey_(self.core.email, "email")
+        certBytes = self.core.certificateBytes()
+        if certBytes is None:
             certBytes = ''
         coder.encodeBytes_length_forKey_(certBytes, "cert")
         #coder.encodeBytes_length_forKey_(certBytes, len(certBytes), "cert")
 
+    def _getAccount(self):
+        if self.core.account is None:
+            return None
+        return self.core.account.wrapper
+
+    account = property(_getAccount, doc="""
+        The L{Account} the contact belongs to.
+        """)
+    del _getAccount
+
+    def certificateBytes(self):
+        """
+        Return the DER encoding of the certificate of the peer, or
+        C{None} if there is no certificate.
+        """
+        return self.core.certificateBytes()
+
+    def fingerprintWithMethod_(self, method):
+        """
+        Return the fingerprint of the certificate of the peer using
+        digest C{method}, or C{None} if there is no certificate.
+        """
+        return self.core.fingerprint(method)
+
+    def fingerprint(self):
+        """
+        Return the MD5 fingerprint of the certificate of the peer, or
+        C{None} if there is no certificate.
+        """
+        return self.core.fingerprint()
+
     def setCertificate_(self, cert):
         """
         Set certificate of peer.
         """
-        self.cert = cert
+        self.willChangeValueForKey_('cert')
+        self.core.setCertificate(cert)
+        self.didChangeValueForKey_('cert')
 
 
 class Account(NSObject):
-    displayName = objc.ivar('displayName')
-    contacts = objc.ivar('contacts')
-    cert = objc.ivar('cert')
+    """
+    Cocoa wrapper around a L{core.Account}.
+
+    The contacts of the core account are exposed through indexed
+    accessors for the C{contacts} key, so that wrappers are only
+    created for the contacts that are actually looked at.  Changes to
+    the core account are reported as indexed change notifications.
+    """
+    displayName = coreProperty('displayName')
+    cert = coreProperty('cert')
     
     def init(self):
-        self = NSObject.init(self)
-        if self is None:
-            return None
-        self.displayName = u""
-        self.contacts = NSMutableArray.alloc().initWithCapacity_(0)
-        self.cert = None
-        return self
+        return self.initWithAccount_(core.Account())
 
     def initWithName_andCert_(self, name, cert):
         """
         """
-        self = self.init()
+        return self.initWithAccount_(core.Account(name, cert))
+
+    def initWithAccount_(self, account):
+        """
+        Initialize wrapper around core account C{account}.
+        """
+        self = NSObject.init(self)
         if self is None:
             return None
-        self.displayName = name
-        self.cert = cert
+        self.core = account
+        account.wrapper = self
+        account.addObserver(self.coreAccount_didChange_atIndexes_contacts_)
         return self
         
     def initWithCoder_(self, coder):
@@ -96,45 +275,109 @@ class Account(NSObject):
         Initialize account model object with the content from the
         L{NSCoder}.
         """
-        self = NSObject.init(self)
-        if self is None:
-            return None
-        self.displayName = coder.decodeObjectForKey_("displayName")    
-        self.contacts = coder.decodeObjectForKey_("contacts")
-        if self.contacts is None:
-            self.contacts = NSMutableArray.alloc().initWithCapacity_(0)
-        return self
+        account = core.Account(coder.decodeObjectForKey_("displayName"))
+        contacts = coder.decodeObjectForKey_("contacts")
+        if contacts is not None:
+            account.addContacts([contact.core for contact in contacts])
+        return self.initWithAccount_(account)
         
     def encodeWithCoder_(self, coder):
         """
         Encode account with encoder.
         """
-        coder.encodeObject_forKey_(self.displayName, "displayName")
-        coder.encodeObject_forKey_(self.contacts, "contacts")
-        
+        coder.encodeObject_forKey_(self.core.displayName, "displayName")
+        coder.encodeObject_forKey_(
+            [wrapperForContact(contact) for contact in self.core.contacts],
+            "contacts"
+            )
+
+    def countOfContacts(self):
+        return len(self.core.contacts)
+
+    def objectInContactsAtIndex_(self, index):
+        return wrapperForContact(self.core.contacts[index], pin=True)
+
+    def contactsAtIndexes_(self, indexes):
+        return [wrapperForContact(self.core.contacts[index], pin=True)
+                for index in indexList(indexes)]
+
+    def coreAccount_didChange_atIndexes_contacts_(self, account, kind,
+                                                  indexes, contacts):
+        """
+        Report a change of the core account with key-value observing
+        notifications.
+        """
+        if kind == core.INSERTED:
+            indexes = indexSet(indexes)
+            self.willChange_valuesAtIndexes_forKey_(
+                NSKeyValueChangeInsertion, indexes, 'contacts'
+                )
+            self.didChange_valuesAtIndexes_forKey_(
+                NSKeyValueChangeInsertion, indexes, 'contacts'
+                )
+        elif kind == core.REMOVED:
+            indexes = indexSet(indexes)
+            self.willChange_valuesAtIndexes_forKey_(
+                NSKeyValueChangeRemoval, indexes, 'contacts'
+                )
+            self.didChange_valuesAtIndexes_forKey_(
+                NSKeyValueChangeRemoval, indexes, 'contacts'
+                )
+            for contact in contacts:
+                wrappers.discard(contact)
+        elif kind == core.UPDATED:
+            for contact in contacts:
+                if contact.wrapper is not None:
+                    contact.wrapper.coreContactDidChange()
+
     def addContact_(self, contact):
         """
         Add contact to list of contacts.
         """
-        self.willChangeValueForKey_('contacts')
-        self.contacts.addObject_(contact)
-        self.didChangeValueForKey_('contacts')
+        self.core.addContact(contact.core)
 
     def removeContact_(self, contact):
         """
         Remove contact from list of contacts.
         """
-        self.willChangeValueForKey_('contacts')
-        self.contacts.removeObject_(contact)
-        self.didChangeValueForKey_('contacts')
-        
+        self.core.removeContact(contact.core)
+
+    def addContacts_(self, contacts):
+        """
+        Add several contacts to the list of contacts, with a single
+        indexed change notification.
+        """
+        self.core.addContacts([contact.core for contact in contacts])
+
+    def removeContacts_(self, contacts):
+        """
+        Remove several contacts from the list of contacts, with a
+        single indexed change notification.
+        """
+        self.core.removeContacts([contact.core for contact in contacts])
+
+    def contactWithEmail_(self, email):
+        """
+        Return the contact with the given email, or C{None}.
+        """
+        contact = self.core.contactWithEmail(email)
+        if contact is None:
+            return None
+        return wrapperForContact(contact)
+
+    def contactWithFingerprint_(self, fingerprint):
+        """
+        Return the contact whose certificate has the given
+        fingerprint, or C{None}.
+        """
+        contact = self.core.contactWithFingerprint(fingerprint)
+        if contact is None:
+            return None
+        return wrapperForContact(contact)
+
     def hasContactWithEmail_(self, email):
         """
         Return C{True} if the account has a contact with the given
         email.
         """
-        for contact in self.contacts:
-            if contact.email == email:
-                return True
-        return False
-    
+        return self.core.hasContactWithEmail(email)
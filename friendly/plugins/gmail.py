@@ -1,86 +1,631 @@
 from twisted.names.srvconnect import SRVConnector
+from twisted.names import client as namesclient, dns
+from twisted.names.error import DNSNameError
 from twisted.words.protocols.jabber import xmlstream, client, jid
 from zope.interface import implements
 from twisted.plugin import IPlugin
-from friendly.ifriendly import IContactImporter
-from twisted.internet import defer, reactor
-import sys
+from friendly.ifriendly import IStreamingContactImporter
+from twisted.internet import defer, reactor, task, error
+from twisted.python import failure
+import os, hashlib, random
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class SRVCache(object):
+    """
+    Cache of SRV lookups.
+
+    Entries are kept for the smallest TTL of the returned records.
+    Domains without SRV records are cached for C{negativeTTL} seconds.
+    Lookups that time out are not cached, so that the next attempt
+    asks again instead of giving up on SRV for a while.
+
+    @ivar hits: number of lookups served from the cache.
+    @ivar misses: number of lookups that had to query the resolver.
+    """
+
+    def __init__(self, resolver=None, clock=reactor, negativeTTL=300,
+                 defaultTTL=300):
+        self.resolver = resolver
+        self.clock = clock
+        self.negativeTTL = negativeTTL
+        self.defaultTTL = defaultTTL
+        self.entries = dict()
+        self.pending = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, service, domain):
+        """
+        Look up the servers for C{service} at C{domain}.
+
+        @return: a L{Deferred} that will be called with a list of
+            C{(host, port)} tuples ordered by priority and weight, or
+            an empty list if there are no SRV records.
+        """
+        name = '_%s._tcp.%s' % (service, domain)
+        entry = self.entries.get(name)
+        if entry is not None:
+            expires, records = entry
+            if expires > self.clock.seconds():
+                self.hits += 1
+                return defer.succeed(self.order(records))
+            del self.entries[name]
+        self.misses += 1
+        d = defer.Deferred()
+        if name in self.pending:
+            self.pending[name].append(d)
+            return d
+        self.pending[name] = [d]
+        resolver = self.resolver
+        if resolver is None:
+            resolver = namesclient.getResolver()
+        lookup = resolver.lookupService(name)
+        lookup.addCallbacks(self._cbLookup, self._ebLookup)
+        lookup.addCallback(self._store, name)
+        lookup.addErrback(self._fail, name)
+        return d
+
+    def _cbLookup(self, (answers, authority, additional)):
+        records = list()
+        ttl = None
+        for a in answers:
+            if a.type != dns.SRV or not a.payload:
+                continue
+            if a.payload.target == dns.Name('.'):
+                # the service is decidedly not available.
+                return self.negativeTTL, list()
+            records.append((a.payload.priority, a.payload.weight,
+                            str(a.payload.target), a.payload.port))
+            if ttl is None or a.ttl < ttl:
+                ttl = a.ttl
+        if not records:
+            return self.negativeTTL, records
+        if ttl is None:
+            ttl = self.defaultTTL
+        return ttl, records
+
+    def _ebLookup(self, failure):
+        if failure.check(defer.TimeoutError):
+            # fall back for now, but ask again next time.
+            return 0, list()
+        failure.trap(DNSNameError)
+        return self.negativeTTL, list()
+
+    def _store(self, (ttl, records), name):
+        if ttl > 0:
+            self.entries[name] = (self.clock.seconds() + ttl, records)
+        for d in self.pending.pop(name):
+            d.callback(self.order(records))
+
+    def _fail(self, failure, name):
+        for d in self.pending.pop(name):
+            d.errback(failure)
+
+    def order(self, records):
+        """
+        Order C{records} by priority and, within each priority, by a
+        weighted random selection as described in RFC 2782.
+        """
+        servers = list()
+        byPriority = dict()
+        for priority, weight, host, port in records:
+            byPriority.setdefault(priority, []).append((weight, host, port))
+        for priority in sorted(byPriority):
+            candidates = byPriority[priority]
+            while candidates:
+                total = sum([weight for weight, host, port in candidates])
+                pick = random.randint(0, total)
+                for index, (weight, host, port) in enumerate(candidates):
+                    pick -= weight
+                    if pick <= 0:
+                        break
+                del candidates[index]
+                servers.append((host, port))
+        return servers
+
+
+srvCache = SRVCache()
 
 
 class XMPPClientConnector(SRVConnector):
+    """
+    Connector for XMPP clients that looks up servers through a shared
+    L{SRVCache}, and falls back to port 5222 at the domain itself.
+
+    Each attempt to connect, including the retries of the factory,
+    tries the next server of the ordered list.  The servers are looked
+    up again once all of them have been tried.
 
-    def __init__(self, reactor, domain, factory):
+    @ivar attempt: index of the next server to try.
+    """
+
+    def __init__(self, reactor, domain, factory, cache=srvCache):
         SRVConnector.__init__(self, reactor, 'xmpp-client', domain, factory)
+        self.cache = cache
+        self.attempt = 0
 
-    def pickServer(self):
-        host, port = SRVConnector.pickServer(self)
+    def connect(self):
+        self.stopAfterDNS = 0
+        self.factory.doStart()
+        self.factory.startedConnecting(self)
+        if self.servers and self.attempt < len(self.servers):
+            self._reallyConnect()
+            return
+        d = self.cache.lookup(self.service, self.domain)
+        d.addCallback(self._cbServers)
+        d.addErrback(self.connectionFailed)
+
+    def _cbServers(self, servers):
+        self.servers = servers
+        self.orderedServers = []
+        self.attempt = 0
+        self._reallyConnect()
 
-        if not self.servers and not self.orderedServers:
+    def pickServer(self):
+        if not self.servers:
             # no SRV record, fall back..
-            port = 5222
+            return self.domain, 5222
+        server = self.servers[self.attempt]
+        self.attempt += 1
+        return server
 
-        return host, port
 
+def connectXMPPClient(jid, factory):
+    """
+    Connect C{factory} to the XMPP server of C{jid}.
+    """
+    connector = XMPPClientConnector(reactor, jid.host, factory)
+    connector.connect()
+    return connector
 
-class GoogleTalkContactImporter(object):
+
+class PooledStreamFactory(xmlstream.XmlStreamFactory):
     """
+    Factory of the connections of a pooled stream, which gives up
+    after C{maxRetries} failed attempts to connect.
+
+    @ivar exhausted: callable called with the reason of the last
+        failure once the factory gives up.
     """
-    implements(IPlugin, IContactImporter)
 
-    description = "Google Talk (gmail)"
+    def __init__(self, authenticator, exhausted):
+        xmlstream.XmlStreamFactory.__init__(self, authenticator)
+        self.exhausted = exhausted
 
-    def connected(self, xs):
-        self.status("Authenticating...")
-        self.xmlstream = xs
+    def clientConnectionFailed(self, connector, reason):
+        if self.maxRetries is not None and self.retries >= self.maxRetries:
+            self.exhausted(reason)
+            return
+        xmlstream.XmlStreamFactory.clientConnectionFailed(
+            self, connector, reason)
 
-    def disconnected(self, xs):
-        self.factory.stopTrying()
-        self.connector.disconnect()
 
-    def rosterCallback(self, element):
-        contacts = list()
-        queryElement = element.firstChildElement()
-        for itemElement in queryElement.elements():
-            email = itemElement['jid']
-            name = itemElement.getAttribute('name', email)
-            contacts.append({
-                    'name': name, 'email': email
-                    })
-        self.xmlstream.sendFooter()
-        if self.deferred is not None:
-            deferred, self.deferred = self.deferred, None
-            deferred.callback(contacts)
-            
+class PooledStream(object):
+    """
+    An authenticated XML stream, shared by all requests for the same
+    JID.
+
+    @ivar users: number of requests currently using the stream.
+    @ivar waiting: deferreds waiting for authentication to complete.
+    """
+
+    def __init__(self, password):
+        self.password = password
+        self.xmlstream = None
+        self.factory = None
+        self.connector = None
+        self.users = 0
+        self.waiting = list()
+        self.expiry = None
+        self.closed = False
+
+
+class XMPPStreamPool(object):
+    """
+    Pool of authenticated XML streams keyed by JID.
+
+    Streams are kept open for C{idleTimeout} seconds after the last
+    user released them, so that repeated or parallel requests do not
+    pay for a new TCP, TLS, SASL and bind handshake.
+
+    @ivar connect: callable that connects a client factory for a
+        JID, and returns the connector.
+    @ivar configurationForTLS: creates the TLS connections of the
+        streams, or C{None} to verify servers against the trust roots
+        of the platform.
+    @ivar maxRetries: number of times to retry connecting before the
+        requests waiting for a stream fail.
+    """
+    maxRetries = 3
+
+    def __init__(self, reactor, idleTimeout=120, connect=connectXMPPClient,
+                 configurationForTLS=None):
+        self.reactor = reactor
+        self.idleTimeout = idleTimeout
+        self.connect = connect
+        self.configurationForTLS = configurationForTLS
+        self.streams = dict()
+
+    def acquire(self, jid, password, status):
+        """
+        Get an authenticated stream for C{jid}.
+
+        The stream must be given back with L{release} when the caller
+        is done with it.
+
+        @return: a L{Deferred} that will be called with the stream.
+        """
+        key = jid.full()
+        stream = self.streams.get(key)
+        if stream is not None and stream.password != password:
+            self._close(key, stream)
+            stream = None
+        if stream is None:
+            stream = self.streams[key] = PooledStream(password)
+            self._connect(key, jid, stream, status)
+        stream.users += 1
+        if stream.expiry is not None:
+            stream.expiry.cancel()
+            stream.expiry = None
+        if stream.waiting or stream.xmlstream is None:
+            d = defer.Deferred()
+            stream.waiting.append(d)
+            return d
+        return defer.succeed(stream.xmlstream)
+
+    def release(self, jid, xs):
+        """
+        Give back a stream acquired with L{acquire}.
+        """
+        key = jid.full()
+        stream = self.streams.get(key)
+        if stream is None or stream.xmlstream is not xs:
+            return
+        stream.users -= 1
+        if not stream.users:
+            stream.expiry = self.reactor.callLater(
+                self.idleTimeout, self._close, key, stream
+                )
+
+    def _connect(self, key, jid, stream, status):
+        def connected(xs):
+            status("Authenticating...")
+
+        def authenticated(xs):
+            stream.xmlstream = xs
+            waiting, stream.waiting = stream.waiting, list()
+            for d in waiting:
+                d.callback(xs)
+
+        def initFailed(failure):
+            self._close(key, stream, failure)
+
+        def disconnected(reason):
+            self._close(key, stream, reason)
+
+        stream.factory = PooledStreamFactory(
+            client.XMPPAuthenticator(
+                jid, stream.password,
+                configurationForTLS=self.configurationForTLS),
+            disconnected)
+        stream.factory.maxRetries = self.maxRetries
+        stream.factory.clock = self.reactor
+        stream.factory.addBootstrap(xmlstream.STREAM_CONNECTED_EVENT, connected)
+        stream.factory.addBootstrap(xmlstream.STREAM_END_EVENT, disconnected)
+        stream.factory.addBootstrap(xmlstream.STREAM_AUTHD_EVENT, authenticated)
+        stream.factory.addBootstrap(xmlstream.INIT_FAILED_EVENT, initFailed)
+        stream.connector = self.connect(jid, stream.factory)
+
+    def _close(self, key, stream, reason=None):
+        if self.streams.get(key) is stream:
+            del self.streams[key]
+        if stream.closed:
+            return
+        stream.closed = True
+        if stream.expiry is not None:
+            if stream.expiry.active():
+                stream.expiry.cancel()
+            stream.expiry = None
+        stream.factory.stopTrying()
+        if stream.xmlstream is not None:
+            xs, stream.xmlstream = stream.xmlstream, None
+            xs.sendFooter()
+        stream.connector.disconnect()
+        waiting, stream.waiting = stream.waiting, list()
+        for d in waiting:
+            d.errback(reason or failure.Failure(error.ConnectionDone()))
+
+    def closeAll(self):
+        """
+        Close all streams in the pool.
+        """
+        for key, stream in self.streams.items():
+            self._close(key, stream)
+
+
+NS_ROSTER = 'jabber:iq:roster'
+NS_ROSTER_VER = 'urn:xmpp:features:rosterver'
+ROSTER_PUSH = "/iq[@type='set']/query[@xmlns='%s']" % NS_ROSTER
+
+
+class RosterPushes(object):
+    """
+    Roster pushes received on an XML stream.
+
+    Pushes are only accepted from the account of the user itself
+    (RFC 6121, section 2.1.6).  Each is acknowledged once and handed
+    to all the roster sessions using the stream.
+
+    @ivar sessions: the L{RosterSession}s waiting for pushes.
+    """
+
+    def __init__(self, xs):
+        self.xs = xs
+        self.sessions = list()
+        xs.addObserver(ROSTER_PUSH, self.onPush)
+
+    def accepted(self, iq):
+        sender = iq.getAttribute('from')
+        if sender is None:
+            return True
+        try:
+            sender = jid.internJID(sender)
+        except jid.InvalidFormat:
+            return False
+        return sender == jid.internJID(self.xs.authenticator.jid.userhost())
+
+    def onPush(self, iq):
+        if not self.accepted(iq):
+            return
+        iq.handled = True
+        self.xs.send(xmlstream.toResponse(iq, 'result'))
+        for session in list(self.sessions):
+            session.rosterPush(iq)
+
+
+def rosterPushes(xs):
+    """
+    Return the L{RosterPushes} of C{xs}, observing the stream from the
+    first call on.
+    """
+    pushes = getattr(xs, 'rosterPushes', None)
+    if pushes is None:
+        pushes = xs.rosterPushes = RosterPushes(xs)
+    return pushes
+
+
+class RosterCache(object):
+    """
+    On-disk cache of rosters and their version tokens, one file per
+    JID.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, jid):
+        return os.path.join(
+            self.directory, hashlib.sha1(jid.userhost()).hexdigest()
+            )
+
+    def load(self, jid):
+        """
+        Return the cached version token and items of the roster of
+        C{jid}.  Items map JIDs to names.
+        """
+        try:
+            fp = open(self.path(jid))
+            try:
+                roster = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, OSError, ValueError):
+            return None, dict()
+        return roster['ver'], roster['items']
+
+    def store(self, jid, ver, items):
+        """
+        Store the roster of C{jid}.
+        """
+        path = self.path(jid)
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            fp = open(path + '.tmp', 'w')
+            try:
+                json.dump({'ver': ver, 'items': items}, fp)
+            finally:
+                fp.close()
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            pass
+
+
+class RosterSession(object):
+    """
+    A single roster request.
+
+    If the server supports roster versioning (XEP-0237) and a cache
+    is given, the cached version token is sent along with the request
+    and only the changes pushed by the server are applied to the
+    cached roster.
+
+    @ivar pushTimeout: seconds to wait for further roster pushes
+        before the roster is considered up to date.
+    """
+    pushTimeout = 1.0
+
+    def __init__(self, pool, status, received, chunkSize, cache=None):
+        self.pool = pool
+        self.status = status
+        self.received = received
+        self.chunkSize = chunkSize
+        self.cache = cache
+        self.count = 0
+        self.ver = None
+        self.items = dict()
+        self.pushed = None
+        self.settled = None
+
+    def start(self, username, password):
+        """
+        Fetch the roster of C{username}.
+
+        @return: a L{Deferred} that will be called with the number of
+            contacts when all of them have been delivered.
+        """
+        self.jid = jid.JID(username)
+        d = self.pool.acquire(self.jid, password, self.status)
+        d.addCallback(self.authenticated)
+        return d
+
+    def supportsVersioning(self, xs):
+        return (NS_ROSTER_VER, 'ver') in (getattr(xs, 'features', None)
+                                          or {})
+
     def authenticated(self, xs):
         """
         """
         self.status("Retreiving...")
-        iq = client.IQ(xs, type="get")
-        iq.addElement(("jabber:iq:roster", "query"))
-        iq.addCallback(self.rosterCallback)
-        iq.send()
-
-    def initFailed(self, failure):
-        if self.deferred is not None:
-            deferred, self.deferred = self.deferred, None
-            deferred.errback(failure)
-        self.xmlstream.sendFooter()
-    
+        versioning = (self.cache is not None
+                      and self.supportsVersioning(xs))
+        iq = xmlstream.IQ(xs, "get")
+        query = iq.addElement((NS_ROSTER, "query"))
+        if versioning:
+            self.ver, self.items = self.cache.load(self.jid)
+            query['ver'] = self.ver or ''
+            rosterPushes(xs).sessions.append(self)
+        d = iq.send()
+        d.addCallback(self.rosterCallback, xs, versioning)
+        d.addBoth(self._finish, xs, versioning)
+        d.addCallback(self.deliver)
+        return d
+
+    def _finish(self, result, xs, versioning):
+        if versioning:
+            rosterPushes(xs).sessions.remove(self)
+            if self.settled is not None and self.settled.active():
+                self.settled.cancel()
+        self.pool.release(self.jid, xs)
+        return result
+
+    def rosterCallback(self, element, xs, versioning):
+        """
+        Handle the result of the roster query.
+        """
+        queryElement = element.firstChildElement()
+        if queryElement is None:
+            # the cached roster is current, apart from the changes
+            # that the server is going to push.
+            self.pushed = defer.Deferred()
+            self.settled = self.pool.reactor.callLater(
+                self.pushTimeout, self.pushed.callback, None
+                )
+            self.pushed.addCallback(self._store, versioning)
+            return self.pushed
+        self.items = dict()
+        for itemElement in queryElement.elements():
+            self.applyItem(itemElement)
+        self.ver = queryElement.getAttribute('ver')
+        return self._store(None, versioning)
+
+    def _store(self, result, versioning):
+        if versioning and self.ver is not None:
+            self.cache.store(self.jid, self.ver, self.items)
+
+    def applyItem(self, itemElement):
+        """
+        Apply a roster item to the roster.
+        """
+        email = itemElement['jid']
+        if itemElement.getAttribute('subscription') == 'remove':
+            self.items.pop(email, None)
+        else:
+            self.items[email] = itemElement.getAttribute('name', email)
+
+    def rosterPush(self, iq):
+        """
+        Apply a roster push to the roster.
+        """
+        queryElement = iq.query
+        for itemElement in queryElement.elements():
+            self.applyItem(itemElement)
+        if queryElement.hasAttribute('ver'):
+            self.ver = queryElement['ver']
+        if self.settled is not None and self.settled.active():
+            self.settled.reset(self.pushTimeout)
+
+    def rosterItems(self):
+        """
+        Generate contact dictionaries from the items of the roster.
+        """
+        for email, name in self.items.iteritems():
+            yield {'name': name, 'email': email}
+
+    def deliverContacts(self, contacts):
+        """
+        Pass C{contacts} to C{received} in chunks, yielding between
+        chunks so that the reactor and the user interface get a
+        chance to run.
+        """
+        chunk = list()
+        for contact in contacts:
+            chunk.append(contact)
+            if len(chunk) == self.chunkSize:
+                self.count += len(chunk)
+                self.received(chunk)
+                chunk = list()
+                yield None
+        if chunk:
+            self.count += len(chunk)
+            self.received(chunk)
+
+    def deliver(self, result):
+        d = task.coiterate(self.deliverContacts(self.rosterItems()))
+        d.addCallback(lambda _: self.count)
+        return d
+
+
+class GoogleTalkContactImporter(object):
+    """
+    """
+    implements(IPlugin, IStreamingContactImporter)
+
+    description = "Google Talk (gmail)"
+    chunkSize = 100
+
+    def __init__(self, pool=None, cache=None):
+        if pool is None:
+            pool = XMPPStreamPool(reactor)
+        if cache is None:
+            cache = RosterCache(os.path.expanduser(
+                    '~/Library/Caches/Friendly/Rosters'
+                    ))
+        self.pool = pool
+        self.cache = cache
+
     def importContacts(self, username, password, callback):
         """
         See L{IContactImporter.importContacts}.
         """
-        self.status = callback
-        self.deferred = defer.Deferred()
-        self.jid = jid.JID(username)
-        self.factory = client.XMPPClientFactory(self.jid, password)
-        self.factory.addBootstrap(xmlstream.STREAM_CONNECTED_EVENT, self.connected)
-        self.factory.addBootstrap(xmlstream.STREAM_END_EVENT, self.disconnected)
-        self.factory.addBootstrap(xmlstream.STREAM_AUTHD_EVENT, self.authenticated)
-        self.factory.addBootstrap(xmlstream.INIT_FAILED_EVENT, self.initFailed)
-        self.connector = XMPPClientConnector(reactor, self.jid.host, self.factory)
-        self.connector.connect()
-        return self.deferred
+        contacts = list()
+        d = self.streamContacts(username, password, callback,
+                                contacts.extend)
+        d.addCallback(lambda _: contacts)
+        return d
+
+    def streamContacts(self, username, password, callback, received):
+        """
+        See L{IStreamingContactImporter.streamContacts}.
+        """
+        session = RosterSession(self.pool, callback, received,
+                                self.chunkSize, self.cache)
+        return session.start(username, password)
         
 
 googleTalkContactImporter = GoogleTalkContactImporter()
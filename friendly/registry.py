@@ -0,0 +1,223 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Registry of contact importer plugins.
+
+Finding the importers with L{twisted.plugin.getPlugins} imports every
+plugin module, and with them L{twisted.words} and L{twisted.names}.
+The registry keeps a manifest with the description and entry point of
+each importer, so that the import window can list the services
+without importing anything.  The manifest is rebuilt when a plugin
+file, or the version of the application, changes, and when an entry
+point of the manifest cannot be imported.
+"""
+
+import os
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from twisted.python.reflect import namedAny
+
+
+class ImporterEntry(object):
+    """
+    Entry for a single importer plugin.
+
+    @ivar description: description of the service.
+    @ivar name: fully qualified name of the importer object.
+    @ivar registry: the L{PluginRegistry} the entry was read from, if
+        it came from a manifest.
+    """
+
+    def __init__(self, description, name, registry=None):
+        self.description = description
+        self.name = name
+        self.registry = registry
+        self.importer = None
+
+    def load(self):
+        """
+        Import the plugin module and return the importer.
+
+        If the entry point is gone, the plugins are discovered again
+        and the importer of the same service is returned.
+        """
+        if self.importer is None:
+            try:
+                self.importer = namedAny(self.name)
+            except (ImportError, ValueError, AttributeError):
+                if self.registry is None:
+                    raise
+                self.importer = self.registry.rediscover(self)
+        return self.importer
+
+
+class PluginRegistry(object):
+    """
+    Manifest-backed registry of the plugins in a package that provide
+    an interface.
+
+    @ivar version: version of the application; a manifest written by
+        another version is rebuilt.
+    """
+    extensions = ('.py', '.pyc', '.pyo')
+
+    def __init__(self, interface, package, path, version=None):
+        self.interface = interface
+        self.package = package
+        self.path = path
+        self.version = version
+        self.entries = None
+
+    def pluginFiles(self):
+        """
+        Return a dictionary mapping the plugin files of the package
+        to their modification times.
+
+        Packages imported from a zip archive, as in application
+        bundles, are represented by the archive.
+        """
+        files = dict()
+        for directory in self.package.__path__:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                archive = self.archiveOf(directory)
+                if archive is not None:
+                    files[archive] = os.path.getmtime(archive)
+                continue
+            for name in names:
+                if os.path.splitext(name)[1] in self.extensions:
+                    path = os.path.join(directory, name)
+                    try:
+                        files[path] = os.path.getmtime(path)
+                    except OSError:
+                        pass
+        return files
+
+    def archiveOf(self, path):
+        """
+        Return the path of the file containing C{path}, or C{None}.
+        """
+        while path and not os.path.exists(path):
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+        if path and os.path.isfile(path):
+            return path
+        return None
+
+    def readManifest(self, files):
+        """
+        Return the entries of the manifest, or C{None} if there is no
+        manifest or it is out of date.
+        """
+        try:
+            fp = open(self.path)
+            try:
+                manifest = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, OSError, ValueError):
+            return None
+        if (manifest.get('files') != files
+            or manifest.get('version') != self.version):
+            return None
+        return [ImporterEntry(entry['description'], entry['name'], self)
+                for entry in manifest['entries']]
+
+    def writeManifest(self, files, entries):
+        manifest = {
+            'version': self.version,
+            'files': files,
+            'entries': [{'description': entry.description,
+                         'name': entry.name} for entry in entries]
+            }
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            fp = open(self.path + '.tmp', 'w')
+            try:
+                json.dump(manifest, fp)
+            finally:
+                fp.close()
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            pass
+
+    def discover(self):
+        """
+        Import the plugins and build entries for them.
+        """
+        from twisted.plugin import getCache
+        entries = list()
+        for moduleName, dropin in sorted(getCache(self.package).items()):
+            for plugin in dropin.plugins:
+                for provided in plugin.provided:
+                    if provided.isOrExtends(self.interface):
+                        break
+                else:
+                    continue
+                entry = ImporterEntry(
+                    None, '%s.%s' % (dropin.moduleName, plugin.name)
+                    )
+                entry.importer = plugin.load()
+                entry.description = entry.importer.description
+                entries.append(entry)
+        return entries
+
+    def rediscover(self, stale):
+        """
+        Discover the plugins again, after the entry point of C{stale}
+        could not be imported, and return the importer of the same
+        service.
+
+        @raise KeyError: if no plugin provides the service any more.
+        """
+        self.entries = self.discover()
+        self.writeManifest(self.pluginFiles(), self.entries)
+        for entry in self.entries:
+            if entry.description == stale.description:
+                return entry.load()
+        raise KeyError(stale.description)
+
+    def getEntries(self):
+        """
+        Return the entries of the registry, from the manifest if it is
+        up to date.
+        """
+        if self.entries is None:
+            self.entries = self.readManifest(self.pluginFiles())
+            if self.entries is None:
+                self.entries = self.discover()
+                # discovery may have compiled the plugins.
+                self.writeManifest(self.pluginFiles(), self.entries)
+        return self.entries
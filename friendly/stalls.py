@@ -0,0 +1,297 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Event loop stall detection.
+
+The reactor runs in a worker thread and hands every iteration over to
+the main thread through the function given to C{reactor.interleave}.
+Anything slow on the main thread therefore stalls both the user
+interface and networking.  L{StallMonitor} wraps the interleave
+function to measure how long each call waits in the main thread queue
+and how long it runs, and reports calls that run longer than a
+threshold, together with where the main thread was stuck.
+
+Every call runs the same iteration of the reactor, so a stall is
+attributed to the code the watchdog found the main thread in, or else
+to the delayed call or selectable that ran the longest during the
+iteration.
+"""
+
+import os, sys, time, thread, threading, traceback
+
+from twisted.python import log
+
+
+class Histogram(object):
+    """
+    Histogram of durations, in seconds.
+
+    @ivar bounds: upper bounds of the buckets; the last bucket holds
+        everything above the last bound.
+    """
+
+    bounds = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+              1.0, 2.0, 5.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def buckets(self):
+        """
+        Return a list of C{(upper bound, count)} tuples, where the
+        upper bound of the last bucket is C{None}.
+        """
+        return zip(self.bounds + (None,), self.counts)
+
+
+class StallMonitor(object):
+    """
+    Measures the calls that the reactor sends to the main thread.
+
+    @ivar threshold: calls running longer than this many seconds are
+        reported as stalls.
+    @ivar queueDelay: L{Histogram} of the time calls spent waiting to
+        run on the main thread.
+    @ivar execution: L{Histogram} of the time calls took to run.
+    @ivar stalls: the most recent stalls, as dictionaries with the
+        keys C{origin}, C{delay}, C{duration} and C{stack}.
+    @ivar sampledOrigin: where the watchdog found the main thread in
+        the current call, if it sampled it.
+    @ivar slowest: C{(duration, target)} of the delayed call or
+        selectable that ran the longest in the current call.
+    """
+
+    maxStalls = 100
+
+    def __init__(self, threshold=0.1, clock=time.time):
+        self.threshold = threshold
+        self.clock = clock
+        self.queueDelay = Histogram()
+        self.execution = Histogram()
+        self.stalls = list()
+        self.current = None
+        self.sampledStack = None
+        self.sampledOrigin = None
+        self.slowest = None
+        self.mainThreadId = None
+        self.watchdog = None
+
+    def wrap(self, waker):
+        """
+        Wrap interleave function C{waker}.
+        """
+        def monitoredWaker(fn):
+            queued = self.clock()
+            waker(lambda: self.run(fn, queued))
+        return monitoredWaker
+
+    def instrument(self, reactor):
+        """
+        Time the delayed calls and selectables C{reactor} runs, so
+        that stalls can be attributed to them.
+        """
+        callLater = reactor.callLater
+        def timedCallLater(delay, f, *args, **kw):
+            return callLater(delay, self.timed, f, f, *args, **kw)
+        reactor.callLater = timedCallLater
+        doReadOrWrite = getattr(reactor, '_doReadOrWrite', None)
+        if doReadOrWrite is not None:
+            def timedDoReadOrWrite(selectable, method, dict):
+                return self.timed(selectable, doReadOrWrite, selectable,
+                                  method, dict)
+            reactor._doReadOrWrite = timedDoReadOrWrite
+
+    def timed(self, target, f, *args, **kw):
+        """
+        Call C{f}, recording C{target} as the slowest thing run in the
+        current call if it is.
+        """
+        start = self.clock()
+        try:
+            return f(*args, **kw)
+        finally:
+            duration = self.clock() - start
+            if self.slowest is None or duration > self.slowest[0]:
+                self.slowest = (duration, target)
+
+    def run(self, fn, queued):
+        """
+        Run C{fn}, that was queued at time C{queued}.
+        """
+        start = self.clock()
+        if self.mainThreadId is None:
+            self.mainThreadId = thread.get_ident()
+        self.sampledStack = None
+        self.sampledOrigin = None
+        self.slowest = None
+        self.current = (fn, start)
+        try:
+            return fn()
+        finally:
+            self.current = None
+            duration = self.clock() - start
+            delay = start - queued
+            self.queueDelay.add(delay)
+            self.execution.add(duration)
+            if duration > self.threshold:
+                self.stalled(fn, delay, duration)
+
+    def stalled(self, fn, delay, duration):
+        if self.sampledOrigin is not None:
+            origin = self.sampledOrigin
+        elif self.slowest is not None:
+            origin = describe(self.slowest[1])
+        else:
+            origin = describe(fn)
+        stall = {
+            'origin': origin,
+            'delay': delay,
+            'duration': duration,
+            'stack': self.sampledStack,
+            }
+        self.stalls.append(stall)
+        del self.stalls[:-self.maxStalls]
+        log.msg("event loop stalled for %.1f ms in %s" % (
+                duration * 1000, stall['origin']))
+        if stall['stack'] is not None:
+            log.msg("main thread was at:\n%s" % ''.join(stall['stack']))
+
+    def startWatchdog(self, interval=None):
+        """
+        Start a thread that samples the stack of the main thread when
+        a call has been running for longer than the threshold, so that
+        stalls can be attributed to the code that caused them.
+        """
+        if interval is None:
+            interval = self.threshold / 2
+        self.watchdog = threading.Thread(target=self._watch,
+                                         args=(interval,))
+        self.watchdog.setDaemon(True)
+        self.watchdog.start()
+
+    def stopWatchdog(self):
+        self.watchdog = None
+
+    def _watch(self, interval):
+        me = self.watchdog
+        while self.watchdog is me:
+            time.sleep(interval)
+            current = self.current
+            if current is None or self.sampledStack is not None:
+                continue
+            fn, start = current
+            if self.clock() - start <= self.threshold:
+                continue
+            frame = sys._current_frames().get(self.mainThreadId)
+            if frame is not None and self.current is current:
+                self.sample(frame)
+
+    def sample(self, frame):
+        """
+        Record the stack of the main thread at C{frame}, and the
+        outermost code it runs that is neither this monitor nor the
+        reactor as the origin of the stall.
+        """
+        entries = traceback.extract_stack(frame)
+        self.sampledStack = traceback.format_list(entries)
+        origin = None
+        for filename, lineno, name, line in entries:
+            if _isMonitor(filename):
+                origin = None
+            elif origin is None and not _isReactor(filename):
+                origin = '%s (%s:%d)' % (name, filename, lineno)
+        self.sampledOrigin = origin
+
+    def stats(self):
+        """
+        Return a dictionary with the collected metrics.
+        """
+        return {
+            'calls': self.execution.count,
+            'stalls': len(self.stalls),
+            'queueDelay': {
+                'mean': self.queueDelay.mean(),
+                'max': self.queueDelay.max,
+                'buckets': self.queueDelay.buckets(),
+                },
+            'execution': {
+                'mean': self.execution.mean(),
+                'max': self.execution.max,
+                'buckets': self.execution.buckets(),
+                },
+            }
+
+
+def _isMonitor(filename):
+    return (os.path.splitext(filename)[0]
+            == os.path.splitext(__file__)[0])
+
+
+def _isReactor(filename):
+    # the main loop, the delayed calls and the logging context.
+    directory = os.path.dirname(filename)
+    return (directory.endswith(os.path.join('twisted', 'internet'))
+            or directory.endswith(os.path.join('twisted', 'python')))
+
+
+def describe(fn):
+    """
+    Return a description of where C{fn} comes from.
+    """
+    target = getattr(fn, 'im_self', getattr(fn, '__self__', None))
+    if target is not None:
+        code = getattr(target, 'gi_code', None)
+        if code is not None:
+            # the main loop of the reactor is a generator.
+            return 'generator %s (%s:%d)' % (code.co_name, code.co_filename,
+                                             code.co_firstlineno)
+        name = getattr(fn, '__name__', repr(fn))
+        return '%s.%s' % (type(target).__name__, name)
+    code = getattr(fn, 'func_code', None)
+    if code is not None:
+        return '%s (%s:%d)' % (fn.__name__, code.co_filename,
+                               code.co_firstlineno)
+    return repr(fn)
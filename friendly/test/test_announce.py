@@ -0,0 +1,453 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Tests for L{friendly.core.announce}.
+"""
+
+import struct
+
+from twisted.trial import unittest
+from twisted.internet import defer, protocol, task, reactor
+from twisted.internet.ssl import KeyPair
+from twisted.web import server, resource
+
+from friendly.core.model import Account, Contact
+from friendly.core.endpoints import EndpointDirectory
+from friendly.test.helpers import makeAccount
+from friendly.core.announce import (AnnounceClient, AccountAnnouncer,
+                                    presenceHash, NONE, STARTED, STOPPED)
+
+
+def bencode(value):
+    if isinstance(value, int):
+        return 'i%de' % (value,)
+    if isinstance(value, str):
+        return '%d:%s' % (len(value), value)
+    if isinstance(value, list):
+        return 'l' + ''.join(map(bencode, value)) + 'e'
+    return 'd' + ''.join(bencode(key) + bencode(value[key])
+                         for key in sorted(value)) + 'e'
+
+
+def compact(host, port):
+    return (''.join(chr(int(part)) for part in host.split('.'))
+            + struct.pack('>H', port))
+
+
+class Swarm(object):
+    """
+    The peers a stand-in tracker knows about, by info-hash.
+    """
+
+    def __init__(self):
+        self.peers = dict()
+
+    def announce(self, infoHash, peer):
+        peers = [other for other in self.peers.get(infoHash, ())
+                 if other != peer]
+        self.peers.setdefault(infoHash, set()).add(peer)
+        return ''.join(compact(*other) for other in peers)
+
+    def leave(self, infoHash, peer):
+        self.peers.get(infoHash, set()).discard(peer)
+
+
+class UDPTracker(protocol.DatagramProtocol):
+    """
+    A stand-in tracker speaking the UDP tracker protocol.
+    """
+
+    def __init__(self, swarm):
+        self.swarm = swarm
+        self.announces = 0
+
+    def datagramReceived(self, data, address):
+        if len(data) == 16:
+            magic, action, transaction = struct.unpack('>QII', data)
+            self.transport.write(struct.pack('>IIQ', 0, transaction, 42),
+                                 address)
+            return
+        (connection, action, transaction, infoHash, peerId, downloaded,
+         left, uploaded, event, ip, key, wanted,
+         port) = struct.unpack('>QII20s20sQQQIIIiH', data)
+        self.announces += 1
+        if event == STOPPED:
+            self.swarm.leave(infoHash, (address[0], port))
+            peers = ''
+        else:
+            peers = self.swarm.announce(infoHash, (address[0], port))
+        self.transport.write(
+            struct.pack('>IIIII', 1, transaction, 900, 0, len(peers) / 6)
+            + peers, address)
+
+
+class HTTPTracker(resource.Resource):
+    """
+    A stand-in tracker speaking the HTTP tracker protocol.
+    """
+    isLeaf = True
+
+    def __init__(self, swarm):
+        resource.Resource.__init__(self)
+        self.swarm = swarm
+        self.announces = 0
+
+    def render_GET(self, request):
+        self.announces += 1
+        infoHash = request.args['info_hash'][0]
+        port = int(request.args['port'][0])
+        peer = (request.getClientIP(), port)
+        if request.args.get('event') == ['stopped']:
+            self.swarm.leave(infoHash, peer)
+            return bencode({'interval': 1200, 'peers': ''})
+        peers = self.swarm.announce(infoHash, peer)
+        return bencode({'interval': 1200, 'peers': peers})
+
+
+class RecordingClient(AnnounceClient):
+    """
+    An announce client that records its announces instead of sending
+    them.
+    """
+
+    def __init__(self, urls, port):
+        self.now = 1000
+        AnnounceClient.__init__(self, urls, port, reactor=task.Clock(),
+                                clock=lambda: self.now)
+        self.sent = []
+        self.pending = []
+
+    def _announceUDP(self, tracker, announces):
+        self.sent.append((tracker.url, announces))
+        d = defer.Deferred()
+        self.pending.append((d, announces))
+        return d
+
+    def answer(self, interval=900):
+        pending, self.pending = self.pending, []
+        for d, announces in pending:
+            d.callback([(infoHash, interval, [])
+                        for infoHash, event, port in announces])
+
+
+class AnnounceClientTests(unittest.TestCase):
+    """
+    Tests for the scheduling of L{AnnounceClient}.
+    """
+
+    def setUp(self):
+        self.client = RecordingClient(['udp://tracker:6969/announce'], 1232)
+
+    def test_startedOnce(self):
+        """
+        An info-hash is announced with the started event until the
+        tracker acknowledges it, and without an event after that.
+        """
+        self.client.add('a' * 20)
+        self.client.announce()
+        self.client.answer()
+        self.client.now += 900
+        self.client.announce()
+        self.assertEqual(
+            [announces for url, announces in self.client.sent],
+            [[('a' * 20, STARTED, 1232)], [('a' * 20, NONE, 1232)]])
+
+    def test_portOverride(self):
+        """
+        An info-hash added with a port of its own is announced with it.
+        """
+        self.client.add('a' * 20, port=0)
+        self.client.announce()
+        self.assertEqual(self.client.sent[0][1],
+                         [('a' * 20, STARTED, 0)])
+
+    def test_addAnnouncesOnlyNew(self):
+        """
+        Adding an info-hash between announces sends only that
+        info-hash, and does not move the next full announce.
+        """
+        self.client.add('a' * 20)
+        self.client.announce()
+        self.client.answer()
+        tracker = self.client.trackers[0]
+        scheduled = tracker.nextAnnounce
+        self.client.now += 10
+        self.client.add('b' * 20)
+        self.client.announce()
+        self.client.answer()
+        self.assertEqual(self.client.sent[-1][1],
+                         [('b' * 20, STARTED, 1232)])
+        self.assertEqual(tracker.nextAnnounce, scheduled)
+        self.client.now += 10
+        self.client.announce()
+        self.assertEqual(len(self.client.sent), 2)
+
+    def test_backoff(self):
+        """
+        A failing tracker backs off exponentially and is not told
+        about new info-hashes until it is due.
+        """
+        self.client.add('a' * 20)
+        self.client.announce()
+        d, announces = self.client.pending.pop()
+        d.errback(Exception("tracker down"))
+        tracker = self.client.trackers[0]
+        self.assertEqual(tracker.failures, 1)
+        self.assertEqual(tracker.nextAnnounce, 1000 + self.client.backoff)
+        self.client.add('b' * 20)
+        self.client.announce()
+        self.assertEqual(len(self.client.sent), 1)
+
+    def test_remove(self):
+        """
+        A removed info-hash is no longer announced, and is started
+        again when it is added back.
+        """
+        self.client.add('a' * 20)
+        self.client.add('b' * 20)
+        self.client.announce()
+        self.client.answer()
+        self.client.remove('a' * 20)
+        self.client.now += 900
+        self.client.announce()
+        self.client.answer()
+        self.assertEqual(self.client.sent[-1][1],
+                         [('b' * 20, NONE, 1232)])
+        self.client.add('a' * 20)
+        self.client.announce()
+        self.assertEqual(self.client.sent[-1][1],
+                         [('a' * 20, STARTED, 1232)])
+
+    def test_stop(self):
+        """
+        Stopping sends the stopped event for the info-hashes the
+        tracker acknowledged, and fires once the tracker answered.
+        """
+        self.client.add('a' * 20)
+        self.client.announce()
+        self.client.answer()
+        self.client.add('b' * 20)
+        d = self.client.stop()
+        self.assertEqual(self.client.sent[-1][1],
+                         [('a' * 20, STOPPED, 1232)])
+        self.assertNoResult(d)
+        self.client.answer()
+        self.successResultOf(d)
+
+    def test_stopFailed(self):
+        """
+        Stopping completes when the tracker does not answer the
+        stopped event.
+        """
+        self.client.add('a' * 20)
+        self.client.announce()
+        self.client.answer()
+        d = self.client.stop()
+        pending, announces = self.client.pending.pop()
+        pending.errback(Exception("tracker down"))
+        self.successResultOf(d)
+
+    def test_stopWhileAnnouncing(self):
+        """
+        Stopping while an announce is in progress sends the stopped
+        event once the tracker acknowledged the info-hashes.
+        """
+        self.client.add('a' * 20)
+        self.client.announce()
+        d = self.client.stop()
+        self.assertEqual(len(self.client.sent), 1)
+        self.client.answer()
+        self.assertEqual(self.client.sent[-1][1],
+                         [('a' * 20, STOPPED, 1232)])
+        self.client.answer()
+        self.successResultOf(d)
+
+    def test_stopUnannounced(self):
+        """
+        Stopping before any tracker acknowledged an info-hash sends
+        nothing.
+        """
+        self.client.add('a' * 20)
+        self.successResultOf(self.client.stop())
+        self.assertEqual(self.client.sent, [])
+
+
+class AccountUpdateTests(unittest.TestCase):
+    """
+    Tests for how L{AccountAnnouncer} follows changes of the account
+    and its contacts.
+    """
+
+    def setUp(self):
+        self.account = Account(u"alice", makeAccount(u"alice").cert)
+        self.client = RecordingClient(['udp://tracker:6969/announce'],
+                                      1232)
+        directory = EndpointDirectory()
+        self.addCleanup(directory.writer.flush)
+        self.announcer = AccountAnnouncer(self.account, self.client,
+                                          directory)
+
+    def presence(self, cert):
+        return presenceHash(cert.digest('md5'))
+
+    def test_certificateGained(self):
+        """
+        A contact is looked up once it gets a certificate.
+        """
+        contact = Contact(u"Bob", u"bob@example.com")
+        self.account.addContact(contact)
+        self.assertEqual(len(self.client.infoHashes), 1)
+        cert = makeAccount(u"bob").cert
+        contact.setCertificate(cert)
+        self.assertEqual(self.client.infoHashes[self.presence(cert)], 0)
+
+    def test_certificateChanged(self):
+        """
+        A contact whose certificate changes is looked up under the
+        new certificate only.
+        """
+        old = makeAccount(u"bob").cert
+        contact = Contact(u"Bob", u"bob@example.com", old.dump())
+        self.account.addContact(contact)
+        new = makeAccount(u"bob").cert
+        contact.setCertificate(new)
+        self.assertNotIn(self.presence(old), self.client.infoHashes)
+        self.assertIn(self.presence(new), self.client.infoHashes)
+
+    def test_sharedCertificate(self):
+        """
+        Contacts sharing a certificate are looked up until the last of
+        them is removed, and all of them learn the endpoints found.
+        """
+        cert = makeAccount(u"bob").cert
+        first = Contact(u"Bob", u"bob@example.com", cert.dump())
+        second = Contact(u"Bob", u"bob@work.com", cert.dump())
+        self.account.addContacts([first, second])
+        infoHash = self.presence(cert)
+        self.announcer.received(infoHash, [('10.0.0.1', 5001)], 900)
+        self.assertEqual(self.announcer.directory.endpoints(first),
+                         [('10.0.0.1', 5001)])
+        self.assertEqual(self.announcer.directory.endpoints(second),
+                         [('10.0.0.1', 5001)])
+        self.account.removeContact(first)
+        self.assertIn(infoHash, self.client.infoHashes)
+        self.account.removeContact(second)
+        self.assertNotIn(infoHash, self.client.infoHashes)
+
+    def test_accountCertificate(self):
+        """
+        The account is announced under its new certificate when it
+        changes.
+        """
+        old = self.account.cert
+        new = makeAccount(u"alice").cert
+        self.account.update(cert=new)
+        self.assertNotIn(self.presence(old), self.client.infoHashes)
+        self.assertEqual(self.client.infoHashes[self.presence(new)], None)
+
+
+class AccountAnnouncerTests(unittest.TestCase):
+    """
+    Two accounts that know each other find each other through
+    stand-in trackers on the loopback interface.
+    """
+
+    def setUp(self):
+        swarm = Swarm()
+        self.udpTracker = UDPTracker(swarm)
+        self.httpTracker = HTTPTracker(swarm)
+        udpPort = reactor.listenUDP(0, self.udpTracker,
+                                    interface='127.0.0.1')
+        self.addCleanup(udpPort.stopListening)
+        httpPort = reactor.listenTCP(0, server.Site(self.httpTracker),
+                                     interface='127.0.0.1')
+        self.addCleanup(httpPort.stopListening)
+        self.urls = [
+            'udp://127.0.0.1:%d/announce' % (udpPort.getHost().port,),
+            'http://127.0.0.1:%d/announce' % (httpPort.getHost().port,)]
+        self.alice = self.account(u"alice")
+        self.bob = self.account(u"bob")
+        self.alice.addContact(Contact(u"Bob", u"bob@example.com",
+                                      certBytes=self.bob.cert.dump()))
+        self.bob.addContact(Contact(u"Alice", u"alice@example.com",
+                                    certBytes=self.alice.cert.dump()))
+
+    def account(self, name):
+        cert = KeyPair.generate(size=1024).selfSignedCert(1, CN=name)
+        return Account(name, cert)
+
+    def announcer(self, account, port, urls):
+        client = AnnounceClient(urls, port)
+        client.udp.timeout = 0.5
+        directory = EndpointDirectory()
+        announcer = AccountAnnouncer(account, client, directory)
+        announcer.start()
+        self.addCleanup(announcer.stop)
+        self.addCleanup(directory.writer.flush)
+        return announcer
+
+    def wait(self, seconds):
+        return task.deferLater(reactor, seconds, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_findEachOther(self):
+        """
+        An account learns the listening port of a contact that
+        announced before it.
+        """
+        self.announcer(self.bob, 5002, self.urls)
+        yield self.wait(0.2)
+        alice = self.announcer(self.alice, 5001, self.urls).directory
+        yield self.wait(1.0)
+        self.assertEqual(alice.endpoints(self.alice.contacts[0]),
+                         [('127.0.0.1', 5002)])
+        self.assertNotEqual(self.udpTracker.announces, 0)
+        self.assertNotEqual(self.httpTracker.announces, 0)
+
+    @defer.inlineCallbacks
+    def test_httpFallback(self):
+        """
+        An HTTP tracker without UDP support is announced to over HTTP
+        after the UDP attempt times out.
+        """
+        urls = self.urls[1:]
+        self.announcer(self.bob, 5002, urls)
+        alice = self.announcer(self.alice, 5001, urls).directory
+        yield self.wait(1.5)
+        self.assertIn(('127.0.0.1', 5002),
+                      alice.endpoints(self.alice.contacts[0]))
+
+    @defer.inlineCallbacks
+    def test_stopped(self):
+        """
+        An account that stopped announcing is no longer found.
+        """
+        bob = self.announcer(self.bob, 5002, self.urls)
+        yield self.wait(0.2)
+        yield bob.stop()
+        alice = self.announcer(self.alice, 5001, self.urls).directory
+        yield self.wait(1.0)
+        self.assertEqual(alice.endpoints(self.alice.contacts[0]), [])
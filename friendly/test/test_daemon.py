@@ -0,0 +1,117 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Tests for L{friendly.core.daemon}.
+"""
+
+import os
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.test.proto_helpers import MemoryReactorClock
+
+from friendly.core.model import Contact
+from friendly.core.endpoints import EndpointDirectory
+from friendly.core.peer import PEER_PORT
+from friendly.core.sqlstore import SQLiteAccountStore
+from friendly.core.daemon import Daemon
+from friendly.test.helpers import makeAccount
+
+
+class UDPPort(object):
+
+    def stopListening(self):
+        pass
+
+
+class NodeReactor(MemoryReactorClock):
+    """
+    A memory reactor that can also listen for datagrams.
+    """
+
+    def __init__(self):
+        MemoryReactorClock.__init__(self)
+        self.udpServers = list()
+
+    def listenUDP(self, port, protocol, interface='', maxPacketSize=8192):
+        self.udpServers.append((port, protocol))
+        return UDPPort()
+
+    def resolve(self, name, timeout=None):
+        return defer.Deferred()
+
+
+class DaemonTests(unittest.TestCase):
+    """
+    Tests for L{Daemon}.
+    """
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.makedirs(self.directory)
+        self.reactor = NodeReactor()
+        self.alice = makeAccount(u"alice")
+        self.alice.announceList = [u"udp://tracker.example.com:6969"]
+        self.alice.addContact(Contact(u"Carol", u"carol@example.com"))
+        self.bob = makeAccount(u"bob")
+
+    def openStore(self):
+        return SQLiteAccountStore(os.path.join(self.directory,
+                                               'accounts.sqlite'))
+
+    def startDaemon(self):
+        store = self.openStore()
+        self.addCleanup(store.close)
+        daemon = Daemon(store, EndpointDirectory(
+                os.path.join(self.directory, 'endpoints.json'),
+                reactor=self.reactor), reactor=self.reactor)
+        daemon.start()
+        self.addCleanup(daemon.stop)
+        return daemon
+
+    def test_serve(self):
+        """
+        Every account accepts connections on a port of its own, and
+        accounts with trackers are announced.
+        """
+        store = self.openStore()
+        store.addAccount(self.alice)
+        store.addAccount(self.bob)
+        d = store.flush()
+        d.addCallback(lambda _: store.close())
+        def stored(_):
+            daemon = self.startDaemon()
+            alice, bob = daemon.accounts
+            self.assertEqual(
+                sorted(port for (port, factory, context, backlog,
+                                 interface) in self.reactor.sslServers),
+                [PEER_PORT, PEER_PORT + 1])
+            self.assertEqual(sorted([alice.listenPort, bob.listenPort]),
+                             [PEER_PORT, PEER_PORT + 1])
+            self.assertEqual(daemon.announcers.keys(), [alice])
+            self.assertEqual(len(self.reactor.udpServers), 1)
+        return d.addCallback(stored)
@@ -0,0 +1,170 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Tests for L{friendly.core.endpoints}.
+"""
+
+import json
+
+from twisted.trial import unittest
+from twisted.internet import defer, protocol, task, reactor
+
+from friendly.core.model import Account, Contact, PIN_DIGEST
+from friendly.core.endpoints import EndpointDirectory, EndpointError
+from friendly.test.helpers import makeAccount
+
+
+class EndpointDirectoryTests(unittest.TestCase):
+    """
+    Tests for L{EndpointDirectory}.
+    """
+
+    def setUp(self):
+        self.now = 1000
+        self.path = self.mktemp()
+        self.directory = self.makeDirectory(task.Clock())
+        self.cert = makeAccount(u"bob").cert
+        self.contact = Contact(u"Bob", u"bob@example.com",
+                               self.cert.dump())
+
+    def makeDirectory(self, reactor, clock=None):
+        directory = EndpointDirectory(
+            self.path, reactor=reactor, clock=clock or (lambda: self.now))
+        self.addCleanup(directory.flush)
+        return directory
+
+    def listen(self):
+        port = reactor.listenTCP(0, protocol.ServerFactory.forProtocol(
+                protocol.Protocol), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return ('127.0.0.1', port.getHost().port)
+
+    @defer.inlineCallbacks
+    def closedEndpoint(self):
+        port = reactor.listenTCP(0, protocol.ServerFactory(),
+                                 interface='127.0.0.1')
+        endpoint = ('127.0.0.1', port.getHost().port)
+        yield port.stopListening()
+        defer.returnValue(endpoint)
+
+    def test_pinned(self):
+        """
+        Candidates are keyed by the fingerprint contacts are pinned by.
+        """
+        self.directory.learn(self.contact, '10.0.0.1', 1232)
+        self.assertEqual(self.directory.candidates.keys(),
+                         [self.cert.digest(PIN_DIGEST)])
+
+    def test_ranking(self):
+        """
+        Candidates are ranked by the time it took to connect to them,
+        those never connected to last, and expired ones are dropped.
+        """
+        for host in ['10.0.0.1', '10.0.0.2', '10.0.0.3']:
+            self.directory.learn(self.contact, host, 1232)
+        self.directory.learn(self.contact, '10.0.0.4', 1232, ttl=10)
+        entries = self.directory.candidates[self.cert.digest(PIN_DIGEST)]
+        entries[('10.0.0.2', 1232)][1] = 0.5
+        entries[('10.0.0.3', 1232)][1] = 0.1
+        self.now += 10
+        self.assertEqual(self.directory.endpoints(self.contact),
+                         [('10.0.0.3', 1232), ('10.0.0.2', 1232),
+                          ('10.0.0.1', 1232)])
+
+    @defer.inlineCallbacks
+    def test_probeSucceeded(self):
+        """
+        Resolving a contact probes its candidates and fires with the
+        one that accepted a connection, which becomes the endpoint of
+        the contact without changing its account.
+        """
+        directory = self.makeDirectory(reactor, clock=reactor.seconds)
+        account = Account(u"alice")
+        account.addContact(self.contact)
+        changes = []
+        account.addObserver(lambda *change: changes.append(change))
+        closed = yield self.closedEndpoint()
+        listening = self.listen()
+        for host, port in [closed, listening]:
+            directory.learn(self.contact, host, port)
+        endpoint = yield directory.resolve(self.contact)
+        self.assertEqual(endpoint, listening)
+        self.assertEqual(self.contact.endpoint, listening)
+        self.assertEqual(directory.endpoints(self.contact)[0], listening)
+        self.assertEqual(changes, [])
+        # the result is reused without probing again.
+        self.assertEqual(self.successResultOf(
+                directory.resolve(self.contact)), listening)
+
+    @defer.inlineCallbacks
+    def test_probeFailed(self):
+        """
+        Resolving a contact none of whose candidates accept a
+        connection fails, and fails again without probing until the
+        backoff has passed.
+        """
+        directory = self.makeDirectory(reactor)
+        closed = yield self.closedEndpoint()
+        directory.learn(self.contact, *closed)
+        yield self.assertFailure(directory.resolve(self.contact),
+                                 EndpointError)
+        self.assertEqual(
+            directory.failures[self.cert.digest(PIN_DIGEST)][0], 1)
+        probes = []
+        directory.probe = probes.append
+        self.failureResultOf(directory.resolve(self.contact),
+                             EndpointError)
+        self.assertEqual(probes, [])
+        self.assertIdentical(self.contact.endpoint, None)
+
+    @defer.inlineCallbacks
+    def test_persistence(self):
+        """
+        The directory is written behind to its file, from which
+        unexpired candidates and failures are loaded.
+        """
+        self.directory.learn(self.contact, '10.0.0.1', 1232)
+        self.directory.learn(self.contact, '10.0.0.2', 1232, ttl=10)
+        fingerprint = self.cert.digest(PIN_DIGEST)
+        self.directory.failures[fingerprint] = [1, 1030]
+        yield self.directory.flush()
+        self.now += 10
+        directory = self.makeDirectory(task.Clock())
+        directory.load()
+        self.assertEqual(directory.endpoints(self.contact),
+                         [('10.0.0.1', 1232)])
+        self.assertEqual(directory.failures, {fingerprint: [1, 1030]})
+
+    def test_otherDigest(self):
+        """
+        A file keyed by another digest is not loaded.
+        """
+        fp = open(self.path, 'w')
+        json.dump({'candidates': {self.cert.digest('md5'): [
+                        ['10.0.0.1', 1232, self.now + 60, None]]},
+                   'failures': {}}, fp)
+        fp.close()
+        self.directory.load()
+        self.assertEqual(self.directory.candidates, {})
@@ -0,0 +1,569 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Tests for L{friendly.plugins.gmail}.
+"""
+
+import base64
+
+from twisted.trial import unittest
+from twisted.internet import defer, protocol, task, reactor, error
+from twisted.internet.ssl import KeyPair, optionsForClientTLS
+from twisted.names import dns
+from twisted.names.error import DNSNameError, DNSQueryTimeoutError
+from twisted.test.proto_helpers import MemoryReactor
+from twisted.words.protocols.jabber import xmlstream, sasl, jid
+from twisted.words.protocols.jabber.client import (NS_XMPP_BIND,
+                                                    NS_XMPP_SESSION)
+from twisted.words.xish import domish
+
+from friendly.plugins.gmail import (SRVCache, XMPPClientConnector,
+                                    XMPPStreamPool, RosterSession,
+                                    RosterCache, NS_ROSTER, NS_ROSTER_VER,
+                                    GoogleTalkContactImporter)
+
+
+class FakeResolver(object):
+    """
+    A resolver answering SRV lookups from a dictionary of records, or
+    failing them with a dictionary of exceptions.
+    """
+
+    def __init__(self, records=None, errors=None):
+        self.records = records or dict()
+        self.errors = errors or dict()
+        self.lookups = []
+
+    def lookupService(self, name):
+        self.lookups.append(name)
+        if name in self.errors:
+            return defer.fail(self.errors[name])
+        answers = [dns.RRHeader(name, dns.SRV, ttl=ttl,
+                                payload=dns.Record_SRV(priority, weight,
+                                                       port, target))
+                   for priority, weight, target, port, ttl
+                   in self.records.get(name, ())]
+        return defer.succeed((answers, [], []))
+
+
+NAME = '_xmpp-client._tcp.example.com'
+
+
+class SRVCacheTests(unittest.TestCase):
+    """
+    Tests for L{SRVCache}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.resolver = FakeResolver({NAME: [
+            (20, 0, 'backup.example.com', 5222, 600),
+            (10, 0, 'xmpp.example.com', 5222, 300)]})
+        self.cache = SRVCache(self.resolver, self.clock)
+
+    def lookup(self):
+        servers = []
+        self.cache.lookup('xmpp-client', 'example.com').addCallback(
+            servers.extend)
+        return servers
+
+    def test_order(self):
+        """
+        Servers are ordered by priority.
+        """
+        self.assertEqual(self.lookup(), [('xmpp.example.com', 5222),
+                                         ('backup.example.com', 5222)])
+
+    def test_smallestTTL(self):
+        """
+        Answers are cached for the smallest TTL of the records.
+        """
+        self.lookup()
+        self.clock.advance(299)
+        self.lookup()
+        self.assertEqual(len(self.resolver.lookups), 1)
+        self.assertEqual(self.cache.hits, 1)
+        self.clock.advance(1)
+        self.lookup()
+        self.assertEqual(len(self.resolver.lookups), 2)
+
+    def test_coalesce(self):
+        """
+        Concurrent lookups of the same name share one query.
+        """
+        d = defer.Deferred()
+        self.resolver.lookupService = lambda name: d
+        first, second = self.lookup(), self.lookup()
+        d.callback(([], [], []))
+        self.assertEqual((first, second), ([], []))
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_noRecords(self):
+        """
+        A domain without SRV records is cached for the negative TTL.
+        """
+        self.resolver.errors[NAME] = DNSNameError()
+        self.assertEqual(self.lookup(), [])
+        self.clock.advance(self.cache.negativeTTL - 1)
+        self.lookup()
+        self.assertEqual(len(self.resolver.lookups), 1)
+
+    def test_timeoutNotCached(self):
+        """
+        A lookup that timed out falls back without SRV records, and is
+        retried on the next lookup.
+        """
+        self.resolver.errors[NAME] = DNSQueryTimeoutError(NAME)
+        self.assertEqual(self.lookup(), [])
+        del self.resolver.errors[NAME]
+        self.assertEqual(self.lookup(), [('xmpp.example.com', 5222),
+                                         ('backup.example.com', 5222)])
+        self.assertEqual(len(self.resolver.lookups), 2)
+
+
+class XMPPClientConnectorTests(unittest.TestCase):
+    """
+    Tests for L{XMPPClientConnector}.
+    """
+
+    def setUp(self):
+        self.reactor = MemoryReactor()
+        resolver = FakeResolver({NAME: [
+            (10, 0, 'first.example.com', 5222, 300),
+            (20, 0, 'second.example.com', 5223, 300)]})
+        self.cache = SRVCache(resolver, task.Clock())
+        self.connector = XMPPClientConnector(
+            self.reactor, 'example.com', protocol.ClientFactory(),
+            self.cache)
+
+    def attempts(self, count):
+        for i in range(count):
+            self.connector.connect()
+        return [(host, port) for (host, port, factory, timeout, bind)
+                in self.reactor.tcpClients]
+
+    def test_walkServers(self):
+        """
+        Retries go through the servers in order, and start over when
+        all of them have been tried.
+        """
+        self.assertEqual(self.attempts(3),
+                         [('first.example.com', 5222),
+                          ('second.example.com', 5223),
+                          ('first.example.com', 5222)])
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_fallback(self):
+        """
+        Without SRV records the domain itself is tried on port 5222.
+        """
+        self.connector = XMPPClientConnector(
+            self.reactor, 'example.org', protocol.ClientFactory(),
+            self.cache)
+        self.assertEqual(self.attempts(2), [('example.org', 5222)] * 2)
+
+
+class StandInAuthenticator(xmlstream.ListenAuthenticator):
+    """
+    Server side of the stream negotiation of a stand-in XMPP server:
+    STARTTLS, then SASL PLAIN, then resource binding.
+    """
+    namespace = 'jabber:client'
+
+    def __init__(self, server):
+        xmlstream.ListenAuthenticator.__init__(self)
+        self.server = server
+        self.secured = False
+        self.authenticated = False
+
+    def associateWithStream(self, xs):
+        xmlstream.ListenAuthenticator.associateWithStream(self, xs)
+        xs.addObserver('/starttls', self.onStartTLS)
+        xs.addObserver('/auth', self.onAuth)
+        xs.addObserver("/iq[@type='set']/bind", self.onBind)
+        xs.addObserver("/iq[@type='set']/session", self.onSession)
+        xs.addObserver("/iq[@type='get']/query[@xmlns='%s']" % NS_ROSTER,
+                       self.server.onRoster, xs=xs)
+        xs.addObserver("/iq[@type='result']", self.server.onResult)
+
+    def streamStarted(self, rootElement):
+        xmlstream.ListenAuthenticator.streamStarted(self, rootElement)
+        xs = self.xmlstream
+        xs.sendHeader()
+        features = domish.Element((xmlstream.NS_STREAMS, 'features'))
+        if not self.secured:
+            features.addElement((xmlstream.NS_XMPP_TLS, 'starttls'))
+        elif not self.authenticated:
+            mechanisms = features.addElement((sasl.NS_XMPP_SASL,
+                                              'mechanisms'))
+            mechanisms.addElement('mechanism', content='PLAIN')
+        else:
+            features.addElement((NS_XMPP_BIND, 'bind'))
+            features.addElement((NS_XMPP_SESSION, 'session'))
+            if self.username in self.server.versions:
+                features.addElement((NS_ROSTER_VER, 'ver'))
+        xs.send(features)
+
+    def onStartTLS(self, element):
+        xs = self.xmlstream
+        xs.send(domish.Element((xmlstream.NS_XMPP_TLS, 'proceed')))
+        xs.transport.startTLS(self.server.cert.options())
+        self.secured = True
+        xs.reset()
+
+    def onAuth(self, element):
+        xs = self.xmlstream
+        authzid, username, password = base64.b64decode(
+            str(element)).split('\0')
+        if self.server.passwords.get(username) != password:
+            failure = domish.Element((sasl.NS_XMPP_SASL, 'failure'))
+            failure.addElement('not-authorized')
+            xs.send(failure)
+            return
+        self.server.authentications += 1
+        self.username = username
+        self.authenticated = True
+        xs.send(domish.Element((sasl.NS_XMPP_SASL, 'success')))
+        xs.reset()
+
+    def onBind(self, iq):
+        result = xmlstream.toResponse(iq, 'result')
+        bind = result.addElement((NS_XMPP_BIND, 'bind'))
+        bind.addElement('jid', content='%s@%s/friendly' % (
+                self.username, self.server.domain))
+        self.xmlstream.send(result)
+
+    def onSession(self, iq):
+        self.xmlstream.send(xmlstream.toResponse(iq, 'result'))
+
+
+class StandInServer(object):
+    """
+    A stand-in XMPP server serving the rosters of its users.
+
+    @ivar versions: C{dict} mapping the users whose rosters are
+        versioned to the version a client may have cached.
+    @ivar pushes: C{dict} mapping users to the C{(from, jid, name,
+        ver)} roster pushes that bring a cached roster up to date.
+    @ivar authentications: number of streams authenticated.
+    @ivar rosterRequests: number of roster requests answered.
+    @ivar pushed: number of roster pushes sent.
+    @ivar results: number of results received, such as the
+        acknowledgements of roster pushes.
+    """
+    domain = 'example.com'
+
+    def __init__(self, passwords, rosters, versions=None, pushes=None):
+        self.passwords = passwords
+        self.rosters = rosters
+        self.versions = versions or dict()
+        self.pushes = pushes or dict()
+        self.pushed = 0
+        self.results = 0
+        self.cert = KeyPair.generate(size=1024).selfSignedCert(
+            1, CN=self.domain)
+        self.authentications = 0
+        self.rosterRequests = 0
+        self.streams = list()
+
+    def buildFactory(self):
+        factory = xmlstream.XmlStreamServerFactory(
+            lambda: StandInAuthenticator(self))
+        factory.addBootstrap(xmlstream.STREAM_CONNECTED_EVENT,
+                             self.connected)
+        return factory
+
+    def connected(self, xs):
+        self.streams.append(xs)
+
+    def onRoster(self, iq, xs):
+        self.rosterRequests += 1
+        username = xs.authenticator.username
+        result = xmlstream.toResponse(iq, 'result')
+        ver = iq.query.getAttribute('ver')
+        if ver and ver == self.versions.get(username):
+            # the cached roster is current, apart from the pushes.
+            xs.send(result)
+            for sender, email, name, ver in self.pushes.get(username, ()):
+                push = xmlstream.IQ(xs, 'set')
+                if sender is not None:
+                    push['from'] = sender
+                query = push.addElement((NS_ROSTER, 'query'))
+                query['ver'] = ver
+                item = query.addElement('item')
+                item['jid'] = email
+                item['name'] = name
+                xs.send(push)
+                self.pushed += 1
+            return
+        query = result.addElement((NS_ROSTER, 'query'))
+        if username in self.versions:
+            query['ver'] = self.versions[username]
+        for email, name in self.rosters[username]:
+            item = query.addElement('item')
+            item['jid'] = email
+            item['name'] = name
+        xs.send(result)
+
+    def onResult(self, iq):
+        self.results += 1
+
+
+class StandInServerMixin:
+    """
+    Mixin for tests importing rosters from a L{StandInServer} over the
+    loopback interface.
+    """
+
+    def startServer(self, server, poolReactor, cache=None):
+        """
+        Start C{server}, and an importer for it whose pool uses
+        C{poolReactor} to keep time.
+        """
+        self.server = server
+        port = reactor.listenTCP(0, self.server.buildFactory(),
+                                 interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.pool = XMPPStreamPool(
+            poolReactor, idleTimeout=120,
+            connect=lambda jid, factory: reactor.connectTCP(
+                '127.0.0.1', port.getHost().port, factory),
+            configurationForTLS=optionsForClientTLS(
+                u'example.com', trustRoot=self.server.cert))
+        self.addCleanup(self.closeAll)
+        self.importer = GoogleTalkContactImporter(pool=self.pool)
+        # without a cache, rosters are always fetched in full.
+        self.importer.cache = cache
+
+    def closeAll(self):
+        """
+        Close the streams of the pool, and wait until the server has
+        seen them go.
+        """
+        closed = list()
+        for xs in self.server.streams:
+            if xs.transport.connected:
+                d = defer.Deferred()
+                xs.addObserver(xmlstream.STREAM_END_EVENT,
+                               lambda reason, d=d: d.callback(None))
+                closed.append(d)
+        self.pool.closeAll()
+        return defer.DeferredList(closed)
+
+    def importRoster(self, password='secret'):
+        return self.importer.importContacts(u'alice@example.com', password,
+                                            lambda message: None)
+
+    def assertRoster(self, contacts,
+                     emails=(u'bob@example.com', u'carol@example.com')):
+        self.assertEqual(sorted(contact['email'] for contact in contacts),
+                         list(emails))
+
+
+class XMPPStreamPoolTests(StandInServerMixin, unittest.TestCase):
+    """
+    Tests for L{XMPPStreamPool} and L{RosterSession}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.startServer(StandInServer(
+                {'alice': 'secret'},
+                {'alice': [(u'bob@example.com', u'Bob'),
+                           (u'carol@example.com', u'Carol')]}),
+                         self.clock)
+
+    def test_parallel(self):
+        """
+        Parallel imports for the same account share one stream.
+        """
+        d = defer.gatherResults([self.importRoster(),
+                                 self.importRoster()])
+        def imported(rosters):
+            for contacts in rosters:
+                self.assertRoster(contacts)
+            self.assertEqual((self.server.authentications,
+                              self.server.rosterRequests), (1, 2))
+        return d.addCallback(imported)
+
+    def test_reuse(self):
+        """
+        An import following another reuses its stream while it has not
+        been idle for C{idleTimeout} seconds.
+        """
+        d = self.importRoster()
+        def again(contacts):
+            self.clock.advance(self.pool.idleTimeout - 1)
+            return self.importRoster()
+        d.addCallback(again)
+        def imported(contacts):
+            self.assertRoster(contacts)
+            self.assertEqual((self.server.authentications,
+                              self.server.rosterRequests), (1, 2))
+        return d.addCallback(imported)
+
+    def test_idle(self):
+        """
+        A stream that was idle for C{idleTimeout} seconds is closed, and
+        the next import opens a new one.
+        """
+        d = self.importRoster()
+        def idle(contacts):
+            self.clock.advance(self.pool.idleTimeout)
+            self.assertEqual(self.pool.streams, {})
+            return self.importRoster()
+        d.addCallback(idle)
+        def imported(contacts):
+            self.assertRoster(contacts)
+            self.assertEqual(self.server.authentications, 2)
+        return d.addCallback(imported)
+
+    def test_wrongPassword(self):
+        """
+        A failed authentication fails the import and leaves no stream
+        in the pool.
+        """
+        d = self.importRoster('guess')
+        self.assertFailure(d, sasl.SASLAuthError)
+        d.addCallback(lambda _: self.assertEqual(self.pool.streams, {}))
+        return d
+
+    @defer.inlineCallbacks
+    def test_unreachable(self):
+        """
+        Requests for a stream fail once every retry to connect failed,
+        and leave no stream in the pool.
+        """
+        port = reactor.listenTCP(0, protocol.ServerFactory(),
+                                 interface='127.0.0.1')
+        closed = port.getHost().port
+        yield port.stopListening()
+        attempts = []
+        def connect(jid, factory):
+            attempts.append(factory)
+            return reactor.connectTCP('127.0.0.1', closed, factory)
+        self.pool.connect = connect
+        d = self.pool.acquire(jid.JID(u'alice@example.com'), 'secret',
+                              lambda message: None)
+        failures = []
+        d.addErrback(failures.append)
+        while not failures:
+            # let the attempt fail, then move on to the next retry.
+            yield task.deferLater(reactor, 0.01, lambda: None)
+            self.clock.advance(60)
+        failures[0].trap(error.ConnectionRefusedError)
+        self.assertEqual(attempts[0].retries, self.pool.maxRetries)
+        self.assertEqual(self.pool.streams, {})
+
+
+
+class RosterVersioningTests(StandInServerMixin, unittest.TestCase):
+    """
+    Tests for the roster versioning of L{RosterSession}.
+    """
+
+    def setUp(self):
+        self.patch(RosterSession, 'pushTimeout', 0.1)
+        self.cache = RosterCache(self.mktemp())
+        self.alice = jid.JID(u'alice@example.com')
+        self.cache.store(self.alice, u'v1', {u'bob@example.com': u'Bob'})
+
+    def start(self, pushes):
+        self.startServer(StandInServer(
+                {'alice': 'secret'},
+                {'alice': [(u'bob@example.com', u'Bob'),
+                           (u'carol@example.com', u'Carol')]},
+                {'alice': u'v1'}, {'alice': pushes}),
+                         reactor, self.cache)
+
+    def test_current(self):
+        """
+        When the cached roster is current, the server sends no items
+        and the cached ones are imported.
+        """
+        self.start([])
+        d = self.importRoster()
+        def imported(contacts):
+            self.assertRoster(contacts, [u'bob@example.com'])
+            self.assertEqual(self.cache.load(self.alice),
+                             (u'v1', {u'bob@example.com': u'Bob'}))
+        return d.addCallback(imported)
+
+    def test_push(self):
+        """
+        Roster pushes following an empty result are applied to the
+        cached roster, which is stored with the version of the last
+        push.
+        """
+        self.start([(None, u'carol@example.com', u'Carol', u'v2')])
+        d = self.importRoster()
+        def imported(contacts):
+            self.assertRoster(contacts)
+            self.assertEqual(self.cache.load(self.alice),
+                             (u'v2', {u'bob@example.com': u'Bob',
+                                      u'carol@example.com': u'Carol'}))
+            self.assertEqual(self.server.results, 1)
+        return d.addCallback(imported)
+
+    def test_pushFromUser(self):
+        """
+        Pushes from the bare JID of the user are accepted.
+        """
+        self.start([(u'alice@example.com', u'carol@example.com',
+                     u'Carol', u'v2')])
+        return self.importRoster().addCallback(self.assertRoster)
+
+    def test_spoofedPush(self):
+        """
+        Pushes from other entities are ignored.
+        """
+        self.start([(u'mallory@example.com', u'mallory@example.com',
+                     u'Mallory', u'v2'),
+                    (u'alice@example.com/other', u'mallory@example.com',
+                     u'Mallory', u'v3')])
+        d = self.importRoster()
+        def imported(contacts):
+            self.assertRoster(contacts, [u'bob@example.com'])
+            self.assertEqual(self.cache.load(self.alice),
+                             (u'v1', {u'bob@example.com': u'Bob'}))
+            self.assertEqual(self.server.results, 0)
+        return d.addCallback(imported)
+
+    def test_sharedStream(self):
+        """
+        Each push received on a stream shared by parallel imports is
+        acknowledged once and applied to each of them.
+        """
+        self.start([(None, u'carol@example.com', u'Carol', u'v2')])
+        d = defer.gatherResults([self.importRoster(),
+                                 self.importRoster()])
+        def imported(rosters):
+            self.assertEqual(self.server.authentications, 1)
+            for contacts in rosters:
+                self.assertRoster(contacts)
+            self.assertEqual(self.server.pushed, 2)
+            self.assertEqual(self.server.results, 2)
+        return d.addCallback(imported)
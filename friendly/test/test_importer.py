@@ -0,0 +1,90 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Tests for L{friendly.importer}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from friendly.importer import MultiServiceImport, AllImportsFailed
+
+
+class Importer(object):
+    """
+    An importer answering with the given contacts or failure.
+    """
+    description = "Stand-in"
+
+    def __init__(self, result):
+        self.result = result
+
+    def importContacts(self, username, password, progress):
+        if isinstance(self.result, Exception):
+            return defer.fail(self.result)
+        return defer.succeed(self.result)
+
+
+class MultiServiceImportTests(unittest.TestCase):
+    """
+    Tests for L{MultiServiceImport}.
+    """
+
+    def start(self, *results):
+        self.received = []
+        job = MultiServiceImport(
+            [(Importer(result), 'user', 'secret') for result in results],
+            self.received.extend, lambda message: None)
+        return job.start()
+
+    def test_merge(self):
+        """
+        Contacts from every source are passed on once per email.
+        """
+        d = self.start([{'email': u'bob@example.com'}],
+                       [{'email': u'Bob@Example.com'},
+                        {'email': u'carol@example.com'}])
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertEqual([contact['email'] for contact in self.received],
+                         [u'bob@example.com', u'carol@example.com'])
+
+    def test_someFailed(self):
+        """
+        The failure of some of the sources is logged, and the others
+        still count.
+        """
+        d = self.start(RuntimeError("down"), [{'email': u'bob@x.com'}])
+        self.assertEqual(self.successResultOf(d), 1)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    def test_allFailed(self):
+        """
+        When every source fails, each failure is logged once and the
+        import fails with L{AllImportsFailed}.
+        """
+        d = self.start(RuntimeError("down"), RuntimeError("also down"))
+        failure = self.failureResultOf(d, AllImportsFailed)
+        self.assertEqual(len(failure.value.failures), 2)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 2)
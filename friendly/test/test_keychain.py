@@ -0,0 +1,128 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Tests for L{friendly.keychain}.
+"""
+
+import os, sys
+
+from twisted.trial import unittest
+
+from friendly import keychain
+
+
+# a stand-in for the security tool, recording its arguments and
+# standard input, and exiting with the status and output it is told.
+FAKE_SECURITY = """#!%s
+import os, sys
+directory = os.path.dirname(sys.argv[0])
+log = open(os.path.join(directory, 'calls'), 'a')
+log.write(repr((sys.argv[1:], sys.stdin.read())) + '\\n')
+log.close()
+command = sys.argv[1]
+status, output = eval(open(os.path.join(directory, command)).read())
+sys.stdout.write(output)
+sys.exit(status)
+"""
+
+
+class KeychainTests(unittest.TestCase):
+    """
+    Tests for the passphrases kept in the keychain, with a stand-in
+    for the security tool.
+    """
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.makedirs(self.directory)
+        path = os.path.join(self.directory, 'security')
+        fp = open(path, 'w')
+        fp.write(FAKE_SECURITY % (sys.executable,))
+        fp.close()
+        os.chmod(path, 0755)
+        self.patch(keychain, 'SECURITY', path)
+        self.answer('add-generic-password', 0)
+
+    def answer(self, command, status, output=''):
+        fp = open(os.path.join(self.directory, command), 'w')
+        fp.write(repr((status, output)))
+        fp.close()
+
+    def calls(self):
+        try:
+            fp = open(os.path.join(self.directory, 'calls'))
+        except IOError:
+            return []
+        try:
+            return [eval(line) for line in fp]
+        finally:
+            fp.close()
+
+    def test_found(self):
+        """
+        A stored passphrase is returned.
+        """
+        self.answer('find-generic-password', 0, 'secret\n')
+        self.assertEqual(keychain.passphraseFor('Friendly', 'store'),
+                         'secret')
+        self.assertEqual(len(self.calls()), 1)
+
+    def test_notFound(self):
+        """
+        A new passphrase is stored when there is none, on the standard
+        input of the tool, and without replacing existing items.
+        """
+        self.answer('find-generic-password', keychain.ITEM_NOT_FOUND)
+        passphrase = keychain.passphraseFor('Friendly', 'store')
+        find, add = self.calls()
+        arguments, input = add
+        self.assertEqual(arguments, ['add-generic-password', '-s',
+                                     'Friendly', '-a', 'store', '-w'])
+        self.assertNotIn('-U', arguments)
+        self.assertEqual(input, '%s\n%s\n' % (passphrase, passphrase))
+
+    def test_locked(self):
+        """
+        A keychain that cannot be read raises L{KeychainError} and no
+        new passphrase is stored.
+        """
+        # errSecInteractionNotAllowed, as for a locked keychain.
+        self.answer('find-generic-password', 36)
+        self.assertRaises(keychain.KeychainError,
+                          keychain.passphraseFor, 'Friendly', 'store')
+        self.assertEqual([arguments[0] for arguments, input
+                          in self.calls()], ['find-generic-password'])
+
+    def test_storeFailed(self):
+        """
+        A passphrase that cannot be stored raises L{KeychainError}.
+        """
+        self.answer('find-generic-password', keychain.ITEM_NOT_FOUND)
+        # errSecDuplicateItem
+        self.answer('add-generic-password', 45)
+        self.assertRaises(keychain.KeychainError,
+                          keychain.passphraseFor, 'Friendly', 'store')
@@ -0,0 +1,95 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Tests for L{friendly.keygen}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from friendly.keygen import KeyPairPool
+
+
+class KeyPairPoolTests(unittest.TestCase):
+    """
+    Tests for L{KeyPairPool}, with generations the tests complete.
+    """
+
+    def setUp(self):
+        self.generations = []
+        self.clock = task.Clock()
+        self.pool = KeyPairPool(size=1, generate=self.generate,
+                                reactor=self.clock)
+
+    def generate(self):
+        d = defer.Deferred()
+        self.generations.append(d)
+        return d
+
+    def test_hit(self):
+        """
+        A key pair that is ready is handed out at once, and a
+        replacement is generated.
+        """
+        self.pool.fill()
+        self.generations.pop().callback('key pair')
+        self.assertEqual(self.successResultOf(self.pool.get()),
+                         'key pair')
+        self.assertEqual(len(self.generations), 1)
+
+    def test_miss(self):
+        """
+        Without a key pair ready, the caller gets the next one
+        generated, and the pool is still refilled.
+        """
+        d = self.pool.get()
+        self.assertNoResult(d)
+        self.assertEqual(len(self.generations), 2)
+        self.generations.pop(0).callback('first')
+        self.assertEqual(self.successResultOf(d), 'first')
+        self.generations.pop(0).callback('second')
+        self.assertEqual(self.pool.keyPairs, ['second'])
+
+    def test_failedWaiting(self):
+        """
+        A failed generation fails the caller waiting for it.
+        """
+        d = self.pool.get()
+        self.generations.pop(0).errback(RuntimeError("no entropy"))
+        self.failureResultOf(d, RuntimeError)
+        self.assertEqual(self.flushLoggedErrors(RuntimeError), [])
+
+    def test_failedInAdvance(self):
+        """
+        A failed generation nobody waits for is logged, and retried
+        after a delay.
+        """
+        self.pool.fill()
+        self.generations.pop().errback(RuntimeError("no entropy"))
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.assertEqual(self.generations, [])
+        self.clock.advance(self.pool.retryDelay)
+        self.generations.pop().callback('key pair')
+        self.assertEqual(self.pool.keyPairs, ['key pair'])
@@ -0,0 +1,91 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Tests for L{friendly.core.model}.
+"""
+
+from twisted.trial import unittest
+
+from friendly.core.model import Account, Contact
+from friendly.test.helpers import makeAccount
+
+
+class IndexTests(unittest.TestCase):
+    """
+    Tests for the email and fingerprint indexes of L{Account}.
+    """
+
+    def setUp(self):
+        self.account = Account(u"Alice")
+
+    def test_sameEmail(self):
+        """
+        Removing one of two contacts whose emails only differ in case
+        leaves the other one in the index.
+        """
+        first = Contact(u"A", u"a@x.com")
+        second = Contact(u"A again", u"A@x.com")
+        self.account.addContacts([first, second])
+        self.account.removeContact(second)
+        self.assertTrue(self.account.hasContactWithEmail(u'a@x.com'))
+        self.assertIdentical(self.account.contactWithEmail(u'A@X.COM'),
+                             first)
+        self.account.removeContact(first)
+        self.assertFalse(self.account.hasContactWithEmail(u'a@x.com'))
+        self.assertEqual(self.account.contactsByEmail, {})
+
+    def test_sameCertificate(self):
+        """
+        Removing one of two contacts with the same certificate leaves
+        the other one in the index.
+        """
+        cert = makeAccount(u"Bob").cert
+        fingerprint = cert.digest('md5')
+        first = Contact(u"Bob", u"bob@x.com", cert.dump())
+        second = Contact(u"Bob at work", u"bob@y.com", cert.dump())
+        self.account.addContacts([first, second])
+        self.assertIdentical(
+            self.account.contactWithFingerprint(fingerprint), first)
+        self.account.removeContact(first)
+        self.assertIdentical(
+            self.account.contactWithFingerprint(fingerprint), second)
+        self.account.removeContact(second)
+        self.assertIdentical(
+            self.account.contactWithFingerprint(fingerprint), None)
+        self.assertEqual(self.account.contactsByFingerprint, {})
+
+    def test_update(self):
+        """
+        Changing the email of a contact moves it in the index, without
+        touching the contacts that shared its old email.
+        """
+        first = Contact(u"A", u"a@x.com")
+        second = Contact(u"A again", u"a@x.com")
+        self.account.addContacts([first, second])
+        first.update(email=u"b@x.com")
+        self.assertIdentical(self.account.contactWithEmail(u'a@x.com'),
+                             second)
+        self.assertIdentical(self.account.contactWithEmail(u'b@x.com'),
+                             first)
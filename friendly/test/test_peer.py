@@ -0,0 +1,426 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Tests for L{friendly.core.peer}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.error import ConnectionLost
+from OpenSSL import SSL
+
+from friendly.core.model import Contact, OFFLINE, CONNECTING, CONNECTED
+from friendly.core.peer import (CertificateIndex, PeerConnectionManager,
+                                PeerError, SessionCache, Ping,
+                                verifyFingerprint, PIN_DIGEST)
+from friendly.test.helpers import makeAccount
+
+
+class CertificateIndexTests(unittest.TestCase):
+    """
+    Tests for L{CertificateIndex}.
+    """
+
+    def setUp(self):
+        self.alice = makeAccount(u"alice")
+        self.bob = makeAccount(u"bob")
+        self.carol = makeAccount(u"carol")
+        self.index = CertificateIndex()
+        self.index.addAccount(self.alice)
+        self.index.addAccount(self.carol)
+        self.contact = Contact(u"Bob", u"bob@example.com",
+                               certBytes=self.bob.cert.dump())
+
+    def fingerprint(self, account):
+        return account.cert.digest(PIN_DIGEST)
+
+    def test_pinDigest(self):
+        """
+        Contacts are indexed by the SHA-256 fingerprint of their
+        certificate.
+        """
+        self.alice.addContact(self.contact)
+        self.assertEqual(self.index.entries.keys(),
+                         [self.fingerprint(self.bob)])
+        self.assertEqual(len(self.fingerprint(self.bob)), 32 * 3 - 1)
+
+    def test_lookup(self):
+        """
+        A contact is found through the account it belongs to only.
+        """
+        self.alice.addContact(self.contact)
+        fingerprint = self.fingerprint(self.bob)
+        self.assertIdentical(self.index.lookup(fingerprint, self.alice),
+                             self.contact)
+        self.assertIdentical(self.index.lookup(fingerprint, self.carol),
+                             None)
+        self.assertEqual(self.index.accounts(fingerprint),
+                         [(self.alice, self.contact)])
+
+    def test_md5Collision(self):
+        """
+        A certificate is not accepted on its MD5 fingerprint.
+        """
+        self.alice.addContact(self.contact)
+        self.assertIdentical(
+            self.index.lookup(self.bob.cert.digest('md5'), self.alice),
+            None)
+
+    def test_knownFingerprint(self):
+        """
+        A contact whose SHA-256 fingerprint is already known is indexed
+        without loading its certificate.
+        """
+        def load():
+            self.fail("certificate loaded")
+        contact = Contact(u"Bob", u"bob@example.com", certLoader=load,
+                          fingerprint=u"12:34",
+                          fingerprints={PIN_DIGEST: u"AB:CD"})
+        self.alice.addContact(contact)
+        self.assertIdentical(self.index.lookup(u"AB:CD", self.alice),
+                             contact)
+
+    def test_follow(self):
+        """
+        The index follows contacts that are removed or get another
+        certificate, and accounts that are removed.
+        """
+        self.alice.addContact(self.contact)
+        self.contact.setCertificate(self.carol.cert)
+        self.assertIdentical(
+            self.index.lookup(self.fingerprint(self.bob), self.alice), None)
+        self.assertIdentical(
+            self.index.lookup(self.fingerprint(self.carol), self.alice),
+            self.contact)
+        self.index.removeAccount(self.alice)
+        self.assertEqual(self.index.entries, {})
+        self.alice.addContact(Contact(u"Bob", u"bob@example.com",
+                                      certBytes=self.bob.cert.dump()))
+        self.assertEqual(self.index.entries, {})
+
+    def test_verify(self):
+        """
+        The verify callback accepts the leaf certificate if its
+        fingerprint is accepted, and ignores the rest of the chain.
+        """
+        seen = []
+        def accept(fingerprint):
+            seen.append(fingerprint)
+            return fingerprint == self.fingerprint(self.bob)
+        verify = verifyFingerprint(accept)
+        self.assertTrue(verify(None, self.bob.cert.original, 0, 0, 0))
+        self.assertFalse(verify(None, self.carol.cert.original, 0, 0, 1))
+        self.assertTrue(verify(None, self.carol.cert.original, 0, 1, 0))
+        self.assertEqual(seen, [self.fingerprint(self.bob),
+                                self.fingerprint(self.carol)])
+
+
+class SessionCacheTests(unittest.TestCase):
+    """
+    Tests for L{SessionCache}.
+    """
+
+    def test_leastRecentlyUsed(self):
+        """
+        The sessions of the least recently used contacts are evicted
+        first.
+        """
+        cache = SessionCache(size=2)
+        cache.put('alice', 1)
+        cache.put('bob', 2)
+        self.assertEqual(cache.get('alice'), 1)
+        cache.put('carol', 3)
+        self.assertEqual([cache.get(contact) for contact
+                          in ('alice', 'bob', 'carol')], [1, None, 3])
+
+    def test_discard(self):
+        """
+        A discarded session is not resumed.
+        """
+        cache = SessionCache()
+        cache.put('alice', 1)
+        cache.discard('alice')
+        cache.discard('bob')
+        self.assertIdentical(cache.get('alice'), None)
+
+    def test_handshake(self):
+        cache = SessionCache()
+        for resumed in (False, True, True):
+            cache.handshake(resumed)
+        self.assertEqual((cache.full, cache.resumed), (1, 2))
+
+
+class SilentProtocol(protocol.Protocol):
+    """
+    An end of a connection that never sends anything, and fires
+    C{closed} when the connection is lost.
+    """
+
+    def __init__(self, closed):
+        self.closed = closed
+
+    def connectionLost(self, reason):
+        self.closed.callback(None)
+
+
+class RecordingManager(PeerConnectionManager):
+    """
+    A connection manager that records the status changes of contacts
+    and the connections that are still open.
+    """
+
+    def __init__(self, account, **kw):
+        PeerConnectionManager.__init__(
+            self, account, statusChanged=self.setStatus,
+            index=CertificateIndex(), **kw)
+        self.statuses = list()
+        self.open = dict()
+
+    def setStatus(self, contact, status):
+        self.statuses.append((contact.name, status))
+
+    def authenticated(self, connection):
+        self.open[connection] = defer.Deferred()
+        PeerConnectionManager.authenticated(self, connection)
+
+    def lost(self, connection, reason):
+        PeerConnectionManager.lost(self, connection, reason)
+        d = self.open.pop(connection, None)
+        if d is not None:
+            d.callback(None)
+
+    def stop(self):
+        """
+        Stop, returning a L{Deferred} that fires when the listening
+        ports and the connections are closed.
+        """
+        ports, self.ports = self.ports, list()
+        closed = [port.stopListening() for port in ports]
+        closed.extend(self.open.values())
+        PeerConnectionManager.stop(self)
+        return defer.DeferredList(closed)
+
+
+class ConnectionTests(unittest.TestCase):
+    """
+    Tests for L{PeerConnectionManager} connecting accounts over the
+    loopback interface.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.alice = makeAccount(u"alice")
+        self.bob = makeAccount(u"bob")
+        self.aliceOfBob = self.addContact(self.bob, self.alice, u"Alice")
+        self.bobOfAlice = self.addContact(self.alice, self.bob, u"Bob")
+        self.aliceManager = self.startManager(self.alice)
+        self.bobManager = self.startManager(self.bob)
+
+    def clock(self):
+        return self.now
+
+    def addContact(self, account, peer, name):
+        """
+        Add a contact with the certificate of C{peer} to C{account}.
+        """
+        contact = Contact(name, name.lower() + u"@example.com",
+                          certBytes=peer.cert.dump())
+        account.addContact(contact)
+        return contact
+
+    def startManager(self, account):
+        manager = RecordingManager(account, clock=self.clock,
+                                   keepaliveInterval=3600)
+        port = manager.listen(0, interface='127.0.0.1')
+        account.endpoint = ('127.0.0.1', port.getHost().port)
+        self.addCleanup(manager.stop)
+        return manager
+
+    def dial(self, manager, contact, peer):
+        """
+        Dial C{contact} where the account C{peer} listens.
+        """
+        contact.endpoint = peer.endpoint
+        return manager.connect(contact)
+
+    def test_reuse(self):
+        """
+        Concurrent and later connects to a contact share a single
+        connection.
+        """
+        d = defer.gatherResults([
+                self.dial(self.aliceManager, self.bobOfAlice, self.bob),
+                self.dial(self.aliceManager, self.bobOfAlice, self.bob)])
+        def connected((first, second)):
+            self.assertIdentical(first, second)
+            self.assertEqual(self.bobManager.connections.keys(),
+                             [self.aliceOfBob])
+            d = self.aliceManager.connect(self.bobOfAlice)
+            d.addCallback(self.assertIdentical, first)
+            d.addCallback(lambda _: first.callRemote(Ping))
+            return d
+        d.addCallback(connected)
+        d.addCallback(lambda _: self.assertEqual(
+                self.aliceManager.statuses,
+                [(u"Bob", CONNECTING), (u"Bob", CONNECTED)]))
+        return d
+
+    def test_simultaneousDial(self):
+        """
+        When both sides dial each other at the same time, both keep
+        the same connection.
+        """
+        d = defer.gatherResults([
+                self.dial(self.aliceManager, self.bobOfAlice, self.bob),
+                self.dial(self.bobManager, self.aliceOfBob, self.alice)])
+        def connected((ofAlice, ofBob)):
+            self.assertIdentical(
+                self.aliceManager.connections[self.bobOfAlice], ofAlice)
+            self.assertIdentical(
+                self.bobManager.connections[self.aliceOfBob], ofBob)
+            self.assertNotEqual(ofAlice.outgoing, ofBob.outgoing)
+            # both ends answer over the connection they kept.
+            return defer.gatherResults([ofAlice.callRemote(Ping),
+                                        ofBob.callRemote(Ping)])
+        return d.addCallback(connected)
+
+    def test_unknownCertificate(self):
+        """
+        A peer whose certificate is not the one of a contact of the
+        account is rejected.
+        """
+        eve = makeAccount(u"eve")
+        bobOfEve = self.addContact(eve, self.bob, u"Bob")
+        eveManager = self.startManager(eve)
+        d = self.dial(eveManager, bobOfEve, self.bob)
+        # the server refuses the handshake; with TLS 1.3 the client
+        # may only notice when its first command goes unanswered.
+        self.assertFailure(d, SSL.Error, ConnectionLost)
+        def rejected(_):
+            self.assertEqual(self.bobManager.connections, {})
+            self.assertEqual(eveManager.connections, {})
+            self.assertEqual(eveManager.statuses[-1], (u"Bob", OFFLINE))
+        return d.addCallback(rejected)
+
+    def test_idleEviction(self):
+        """
+        A connection that is not used for C{idleTimeout} seconds is
+        closed at the next keepalive.
+        """
+        d = self.dial(self.aliceManager, self.bobOfAlice, self.bob)
+        def connected(connection):
+            self.now += self.aliceManager.idleTimeout / 2
+            self.aliceManager._keepalive()
+            self.assertEqual(self.aliceManager.connections.keys(),
+                             [self.bobOfAlice])
+            self.now += self.aliceManager.idleTimeout
+            self.aliceManager._keepalive()
+            return defer.gatherResults(
+                self.aliceManager.open.values()
+                + self.bobManager.open.values())
+        def closed(_):
+            self.assertEqual(self.aliceManager.connections, {})
+            self.assertEqual(self.bobManager.connections, {})
+            self.assertEqual(self.aliceManager.statuses[-1],
+                             (u"Bob", OFFLINE))
+            self.assertEqual(self.bobManager.statuses[-1],
+                             (u"Alice", OFFLINE))
+        return d.addCallback(connected).addCallback(closed)
+
+    def test_stalledHandshake(self):
+        """
+        A dial to a peer that accepts the connection but never
+        completes the handshake fails after C{handshakeTimeout}
+        seconds, and gives back its dial slot.
+        """
+        closed = defer.Deferred()
+        factory = protocol.Factory()
+        factory.protocol = lambda: SilentProtocol(closed)
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.aliceManager.handshakeTimeout = 0.1
+        self.bobOfAlice.endpoint = ('127.0.0.1', port.getHost().port)
+        d = self.aliceManager.connect(self.bobOfAlice)
+        self.assertFailure(d, PeerError)
+        def failed(_):
+            self.assertEqual(self.aliceManager.dialing, {})
+            self.assertEqual(self.aliceManager.dials.tokens,
+                             self.aliceManager.dials.limit)
+            return closed
+        return d.addCallback(failed)
+
+    def test_stalledInbound(self):
+        """
+        An incoming connection that does not complete the handshake is
+        closed after C{handshakeTimeout} seconds.
+        """
+        closed = defer.Deferred()
+        self.bobManager.handshakeTimeout = 0.1
+        host, port = self.bob.endpoint
+        protocol.ClientCreator(reactor, SilentProtocol,
+                               closed).connectTCP(host, port)
+        return closed
+
+    def test_resume(self):
+        """
+        Dialing a contact again resumes the TLS session of the last
+        connection, at both ends.
+        """
+        def reconnect(connection):
+            connection.transport.loseConnection()
+            d = defer.gatherResults(self.aliceManager.open.values()
+                                    + self.bobManager.open.values())
+            d.addCallback(lambda _: self.aliceManager.connect(
+                    self.bobOfAlice))
+            return d
+        d = self.dial(self.aliceManager, self.bobOfAlice, self.bob)
+        d.addCallback(reconnect)
+        d.addCallback(lambda connection: connection.callRemote(Ping))
+        def resumed(_):
+            for manager in (self.aliceManager, self.bobManager):
+                self.assertEqual(
+                    (manager.sessions.full, manager.sessions.resumed),
+                    (1, 1))
+        return d.addCallback(resumed)
+
+    def test_noResumeAfterReject(self):
+        """
+        A session is not resumed with a contact whose certificate no
+        longer matches the one presented, and is dropped.
+        """
+        def changed(connection):
+            connection.transport.loseConnection()
+            self.bobOfAlice.setCertificate(makeAccount(u"mallory").cert)
+            d = defer.gatherResults(self.aliceManager.open.values()
+                                    + self.bobManager.open.values())
+            d.addCallback(lambda _: self.aliceManager.connect(
+                    self.bobOfAlice))
+            return self.assertFailure(d, PeerError, SSL.Error)
+        d = self.dial(self.aliceManager, self.bobOfAlice, self.bob)
+        d.addCallback(changed)
+        d.addCallback(lambda _: self.assertIdentical(
+                self.aliceManager.sessions.get(self.bobOfAlice), None))
+        return d
@@ -0,0 +1,108 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Tests for L{friendly.core.presence}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from friendly.core.model import Contact, OFFLINE, CONNECTING, CONNECTED
+from friendly.core.presence import StatusAggregator
+
+
+class StatusAggregatorTests(unittest.TestCase):
+    """
+    Tests for L{StatusAggregator}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.batches = []
+        self.aggregator = StatusAggregator(self.apply, rate=10,
+                                           reactor=self.clock,
+                                           clock=self.clock.seconds)
+        self.alice = Contact(u"Alice", u"alice@example.com",
+                             status=OFFLINE)
+        self.bob = Contact(u"Bob", u"bob@example.com", status=OFFLINE)
+
+    def apply(self, statuses):
+        self.batches.append(statuses)
+        for contact, status in statuses.iteritems():
+            contact.status = status
+
+    def test_batch(self):
+        """
+        Changes queued together are applied in one batch, with the
+        latest status of each contact.
+        """
+        self.aggregator.setStatus(self.alice, CONNECTING)
+        self.aggregator.setStatus(self.bob, CONNECTING)
+        self.aggregator.setStatus(self.alice, CONNECTED)
+        self.assertEqual(self.batches, [])
+        self.clock.advance(0)
+        self.assertEqual(self.batches, [{self.alice: CONNECTED,
+                                         self.bob: CONNECTING}])
+        self.assertEqual(self.aggregator.updates, 3)
+        self.assertEqual(self.aggregator.flushes, 1)
+
+    def test_rate(self):
+        """
+        Batches are applied at most C{rate} times per second.
+        """
+        self.aggregator.setStatus(self.alice, CONNECTED)
+        self.clock.advance(0)
+        self.aggregator.setStatus(self.bob, CONNECTED)
+        self.clock.advance(0.05)
+        self.assertEqual(len(self.batches), 1)
+        self.clock.advance(0.05)
+        self.assertEqual(self.batches[1], {self.bob: CONNECTED})
+
+    def test_changedBack(self):
+        """
+        A contact back to its status before the batch is left out.
+        """
+        self.aggregator.setStatus(self.alice, CONNECTING)
+        self.aggregator.setStatus(self.alice, OFFLINE)
+        self.aggregator.setStatus(self.bob, CONNECTED)
+        self.clock.advance(0)
+        self.assertEqual(self.batches, [{self.bob: CONNECTED}])
+
+    def test_unchanged(self):
+        """
+        Setting the current status queues nothing.
+        """
+        self.aggregator.setStatus(self.alice, OFFLINE)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stop(self):
+        """
+        Stopping drops the queued changes.
+        """
+        self.aggregator.setStatus(self.alice, CONNECTED)
+        self.aggregator.stop()
+        self.clock.advance(1)
+        self.assertEqual(self.batches, [])
+        self.assertEqual(self.alice.status, OFFLINE)
@@ -0,0 +1,166 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Tests for L{friendly.registry}.
+"""
+
+import os, sys, zipfile
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from twisted.trial import unittest
+
+from friendly.ifriendly import IContactImporter
+from friendly.registry import PluginRegistry
+
+
+PLUGIN = """
+from zope.interface import implements
+from twisted.plugin import IPlugin
+from friendly.ifriendly import IContactImporter
+
+class Importer(object):
+    implements(IPlugin, IContactImporter)
+    description = %r
+
+%s = Importer()
+"""
+
+
+class PluginRegistryTests(unittest.TestCase):
+    """
+    Tests for L{PluginRegistry}.
+    """
+    packageName = 'friendlytestplugins'
+
+    def setUp(self):
+        self.directory = os.path.abspath(self.mktemp())
+        self.packageDirectory = os.path.join(self.directory,
+                                             self.packageName)
+        os.makedirs(self.packageDirectory)
+        open(os.path.join(self.packageDirectory, '__init__.py'),
+             'w').close()
+        self.writePlugin('service', 'Service', 'importer')
+        sys.path.insert(0, self.directory)
+        self.addCleanup(sys.path.remove, self.directory)
+        self.addCleanup(self.forget)
+        self.package = __import__(self.packageName)
+        self.manifest = os.path.join(self.directory, 'plugins.json')
+
+    def forget(self):
+        for name in list(sys.modules):
+            if name.split('.')[0] == self.packageName:
+                del sys.modules[name]
+
+    def writePlugin(self, module, description, name):
+        path = os.path.join(self.packageDirectory, module + '.py')
+        fp = open(path, 'w')
+        fp.write(PLUGIN % (description, name))
+        fp.close()
+        return path
+
+    def registry(self, version='1.0'):
+        return PluginRegistry(IContactImporter, self.package,
+                              self.manifest, version)
+
+    def test_discover(self):
+        """
+        Without a manifest the plugins are imported, and a manifest is
+        written.
+        """
+        entries = self.registry().getEntries()
+        self.assertEqual([(entry.description, entry.name)
+                          for entry in entries],
+                         [('Service', self.packageName + '.service.importer')])
+        self.assertTrue(os.path.exists(self.manifest))
+
+    def test_manifest(self):
+        """
+        An up to date manifest is used without importing the plugins.
+        """
+        self.registry().getEntries()
+        self.forget()
+        entries = self.registry().getEntries()
+        self.assertEqual([entry.description for entry in entries],
+                         ['Service'])
+        self.assertNotIn(self.packageName + '.service', sys.modules)
+        self.assertEqual(entries[0].load().description, 'Service')
+
+    def test_compiledFiles(self):
+        """
+        Compiled plugin files are part of the manifest.
+        """
+        registry = self.registry()
+        registry.getEntries()
+        compiled = os.path.join(self.packageDirectory, 'other.pyc')
+        open(compiled, 'w').close()
+        self.assertIn(compiled, registry.pluginFiles())
+        self.assertIdentical(registry.readManifest(registry.pluginFiles()),
+                             None)
+
+    def test_version(self):
+        """
+        A manifest written by another version is rebuilt.
+        """
+        self.registry('1.0').getEntries()
+        registry = self.registry('1.1')
+        self.assertIdentical(registry.readManifest(registry.pluginFiles()),
+                             None)
+
+    def test_staleEntryPoint(self):
+        """
+        An entry point of the manifest that cannot be imported makes
+        the registry discover the plugins again.
+        """
+        self.registry().getEntries()
+        manifest = json.load(open(self.manifest))
+        manifest['entries'][0]['name'] = self.packageName + '.service.gone'
+        json.dump(manifest, open(self.manifest, 'w'))
+        registry = self.registry()
+        entry, = registry.getEntries()
+        self.assertEqual(entry.load().description, 'Service')
+        self.assertEqual([entry.name for entry in registry.entries],
+                         [self.packageName + '.service.importer'])
+        self.assertEqual(json.load(open(self.manifest))['entries'][0]['name'],
+                         self.packageName + '.service.importer')
+
+    def test_archive(self):
+        """
+        A package imported from a zip archive is represented by the
+        archive.
+        """
+        archive = os.path.join(self.directory, 'site-packages.zip')
+        zipfile.ZipFile(archive, 'w').close()
+        registry = self.registry()
+        self.assertEqual(
+            registry.archiveOf(os.path.join(archive, 'friendly', 'plugins')),
+            archive)
+        self.assertIdentical(
+            registry.archiveOf(os.path.join(self.directory, 'missing')),
+            None)
@@ -0,0 +1,123 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Tests for L{friendly.core.search}.
+"""
+
+from twisted.trial import unittest
+
+from friendly.core.model import Account, Contact
+from friendly.core.search import ContactIndex, SearchSession
+
+
+class SearchTests(unittest.TestCase):
+    """
+    Tests for L{ContactIndex} and L{SearchSession}.
+    """
+
+    def setUp(self):
+        self.account = Account(u"alice")
+        self.bob = Contact(u"Bob Dylan", u"bob@example.com")
+        self.bobby = Contact(u"Bobby Fischer", u"bobby@chess.org")
+        self.carol = Contact(u"Carol King", u"carol@example.com")
+        self.account.addContacts([self.bob, self.bobby, self.carol])
+        self.index = ContactIndex()
+        self.index.addAccount(self.account)
+        self.session = SearchSession(self.index)
+
+    def search(self, query):
+        results = self.session.search(query)
+        if results is None:
+            return None
+        return sorted(contact.name for contact in results)
+
+    def test_prefix(self):
+        """
+        Contacts are found by prefixes of the words of their name and
+        email, regardless of case.
+        """
+        self.assertEqual(self.search(u"bo"), [u"Bob Dylan",
+                                              u"Bobby Fischer"])
+        self.assertEqual(self.search(u"EXAMPLE"), [u"Bob Dylan",
+                                                   u"Carol King"])
+        self.assertEqual(self.search(u"chess.o"), [u"Bobby Fischer"])
+
+    def test_everyWord(self):
+        """
+        Contacts must match every word of the query.
+        """
+        self.assertEqual(self.search(u"bob exa"), [u"Bob Dylan"])
+        self.assertEqual(self.search(u"carol bob"), [])
+
+    def test_empty(self):
+        """
+        A query without words matches everything.
+        """
+        self.assertIdentical(self.search(u" "), None)
+
+    def test_refine(self):
+        """
+        A query extending the previous one is answered from the
+        previous results.
+        """
+        self.search(u"b")
+        self.index.search = lambda query: self.fail("searched the index")
+        self.assertEqual(self.search(u"bobby"), [u"Bobby Fischer"])
+        self.assertEqual(self.search(u"bobby f"), [u"Bobby Fischer"])
+
+    def test_changes(self):
+        """
+        The index follows changes to the account, and a session does
+        not reuse results from before a change.
+        """
+        self.assertEqual(self.search(u"d"), [u"Bob Dylan"])
+        dave = Contact(u"Dave Brubeck", u"dave@example.com")
+        self.account.addContact(dave)
+        self.assertEqual(self.search(u"da"), [u"Dave Brubeck"])
+        self.bob.update(name=u"Robert Zimmerman")
+        self.assertEqual(self.search(u"dylan"), [])
+        self.assertEqual(self.search(u"zim"), [u"Robert Zimmerman"])
+        self.account.removeContact(self.carol)
+        self.assertEqual(self.search(u"carol"), [])
+
+    def test_removeAccount(self):
+        """
+        The contacts of a removed account are no longer found, and its
+        changes no longer followed.
+        """
+        self.index.removeAccount(self.account)
+        self.assertEqual(self.search(u"bob"), [])
+        self.account.addContact(Contact(u"Bob Marley", u"bob@reggae.org"))
+        self.assertEqual(self.search(u"bob"), [])
+
+    def test_rebuild(self):
+        """
+        Words of removed contacts are dropped from the sorted words
+        once most of them are gone.
+        """
+        self.account.removeContacts([self.bob, self.bobby])
+        self.assertEqual(self.search(u"b"), [])
+        self.assertNotIn(u"bobby", self.index.sortedWords)
+        self.assertEqual(self.search(u"ca"), [u"Carol King"])
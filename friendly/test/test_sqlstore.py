@@ -0,0 +1,128 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Tests for L{friendly.core.sqlstore}.
+"""
+
+import sqlite3
+
+from twisted.trial import unittest
+
+from friendly.core.model import Contact
+from friendly.core.sqlstore import SQLiteAccountStore
+from friendly.core.store import (dumpCertificate, isEncrypted,
+                                 PassphraseError)
+from friendly.test.helpers import makeAccount
+
+
+class SQLiteAccountStoreTests(unittest.TestCase):
+    """
+    Tests for L{SQLiteAccountStore}.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.alice = makeAccount(u"alice")
+        self.bob = makeAccount(u"bob")
+        self.alice.addContact(Contact(u"Bob", u"bob@example.com",
+                                      certBytes=self.bob.cert.dump()))
+
+    def openStore(self, passphrase='secret'):
+        store = SQLiteAccountStore(self.path, passphrase=passphrase)
+        self.addCleanup(store.close)
+        return store
+
+    def storedCertificate(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(
+                "SELECT cert FROM accounts").fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_roundTrip(self):
+        """
+        Accounts and contacts added to the store are loaded back, with
+        the private key of the account.
+        """
+        store = self.openStore()
+        store.addAccount(self.alice)
+        def loaded(_):
+            [account] = self.openStore().load()
+            self.assertEqual(account.displayName, u"alice")
+            self.assertEqual(account.cert.privateKey.dump(),
+                             self.alice.cert.privateKey.dump())
+            [contact] = account.contacts
+            self.assertEqual(contact.fingerprint('sha256'),
+                             self.bob.cert.digest('sha256'))
+            self.assertEqual(contact.certificateBytes(),
+                             self.bob.cert.dump())
+        return store.flush().addCallback(loaded)
+
+    def test_encryptedKey(self):
+        """
+        The private key of an account is stored encrypted with the
+        passphrase of the store.
+        """
+        store = self.openStore()
+        store.addAccount(self.alice)
+        def written(_):
+            pem = self.storedCertificate()
+            self.assertTrue(isEncrypted(pem))
+            self.assertNotIn(dumpCertificate(self.alice.cert), pem)
+        return store.flush().addCallback(written)
+
+    def test_wrongPassphrase(self):
+        """
+        The accounts cannot be loaded with another passphrase.
+        """
+        store = self.openStore()
+        store.addAccount(self.alice)
+        def written(_):
+            self.assertRaises(PassphraseError,
+                              self.openStore('guess').load)
+        return store.flush().addCallback(written)
+
+    def test_encryptPlainKey(self):
+        """
+        Private keys stored unencrypted are encrypted when loaded by a
+        store with a passphrase.
+        """
+        store = self.openStore(None)
+        store.addAccount(self.alice)
+        d = store.flush()
+        def written(_):
+            self.assertFalse(isEncrypted(self.storedCertificate()))
+            store = self.openStore()
+            [account] = store.load()
+            self.assertEqual(account.cert.privateKey.dump(),
+                             self.alice.cert.privateKey.dump())
+            return store.flush()
+        d.addCallback(written)
+        d.addCallback(lambda _: self.assertTrue(
+                isEncrypted(self.storedCertificate())))
+        return d
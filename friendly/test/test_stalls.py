@@ -0,0 +1,160 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Tests for L{friendly.stalls}.
+"""
+
+import sys
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from friendly.stalls import StallMonitor, describe
+
+
+class FakeClock(object):
+    """
+    A clock that only moves when told to.
+    """
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class StallMonitorTests(unittest.TestCase):
+    """
+    Tests for L{StallMonitor}, driven by a fake clock.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.monitor = StallMonitor(threshold=0.1, clock=self.clock)
+        self.queue = []
+        self.waker = self.monitor.wrap(self.queue.append)
+
+    def runQueued(self, delay):
+        """
+        Run the queued calls after they waited C{delay} seconds.
+        """
+        self.clock.now += delay
+        queue, self.queue[:] = list(self.queue), []
+        for fn in queue:
+            fn()
+
+    def busy(self, seconds):
+        def run():
+            self.clock.now += seconds
+        return run
+
+    def test_stats(self):
+        """
+        The time calls wait and run is collected, and calls running
+        longer than the threshold are counted as stalls.
+        """
+        self.waker(self.busy(0.001))
+        self.waker(self.busy(0.3))
+        self.runQueued(0.02)
+        stats = self.monitor.stats()
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['stalls'], 1)
+        self.assertAlmostEqual(stats['execution']['max'], 0.3)
+        self.assertAlmostEqual(stats['execution']['mean'], 0.1505)
+        self.assertEqual(
+            [count for (bound, count) in stats['execution']['buckets']
+             if count],
+            [1, 1])
+        self.assertEqual(dict(stats['execution']['buckets'])[0.5], 1)
+        # the second call also waited for the first one to run.
+        self.assertAlmostEqual(stats['queueDelay']['max'], 0.021)
+        self.assertAlmostEqual(self.monitor.stalls[0]['duration'], 0.3)
+
+    def test_slowestDelayedCall(self):
+        """
+        A stall is attributed to the delayed call that ran the longest
+        in it.
+        """
+        reactor = task.Clock()
+        self.monitor.instrument(reactor)
+        def quick():
+            self.clock.now += 0.01
+        def slow():
+            self.clock.now += 0.2
+        reactor.callLater(0, quick)
+        reactor.callLater(0, slow)
+        self.waker(lambda: reactor.advance(0))
+        self.runQueued(0)
+        [stall] = self.monitor.stalls
+        self.assertEqual(stall['origin'], describe(slow))
+        self.assertIdentical(stall['stack'], None)
+
+    def test_slowestSelectable(self):
+        """
+        A stall is attributed to the selectable that ran the longest in
+        it.
+        """
+        test = self
+        class Reactor(task.Clock):
+            def _doReadOrWrite(self, selectable, method, dict):
+                getattr(selectable, method)()
+        class Selectable(object):
+            def doRead(self):
+                test.clock.now += 0.2
+        reactor = Reactor()
+        self.monitor.instrument(reactor)
+        selectable = Selectable()
+        self.waker(lambda: reactor._doReadOrWrite(selectable, 'doRead',
+                                                  {}))
+        self.runQueued(0)
+        self.assertEqual(self.monitor.stalls[0]['origin'],
+                         describe(selectable))
+
+    def test_sampledOrigin(self):
+        """
+        A stall during which the watchdog sampled the main thread is
+        attributed to the code it was running below the monitor.
+        """
+        def sampled():
+            self.clock.now += 0.2
+            self.monitor.sample(sys._getframe())
+        def iteration():
+            sampled()
+        self.waker(iteration)
+        self.runQueued(0)
+        [stall] = self.monitor.stalls
+        self.assertTrue(stall['origin'].startswith('iteration ('),
+                        stall['origin'])
+        self.assertIn(', in sampled', stall['stack'][-1])
+
+    def test_noStall(self):
+        """
+        Calls within the threshold are not stalls.
+        """
+        self.waker(self.busy(0.05))
+        self.runQueued(0)
+        self.assertEqual(self.monitor.stats()['stalls'], 0)
+        self.assertEqual(self.monitor.stalls, [])
@@ -0,0 +1,159 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Tests for L{friendly.core.writebehind}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from friendly.core.writebehind import WriteBehindScheduler
+
+
+class WriteFailed(Exception):
+    pass
+
+
+class WriteBehindSchedulerTests(unittest.TestCase):
+    """
+    Tests for L{WriteBehindScheduler}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.written = []
+        self.failing = 0
+        self.writer = WriteBehindScheduler(self.write, delay=0.5,
+                                           reactor=self.clock)
+
+    def write(self, batch):
+        if self.failing:
+            self.failing -= 1
+            raise WriteFailed()
+        self.written.append(batch)
+
+    def test_coalesce(self):
+        """
+        Changes made within the delay of each other are written in a
+        single batch.
+        """
+        for i in range(100):
+            self.writer.schedule(i)
+            self.clock.advance(0.001)
+        self.assertEqual(self.written, [])
+        self.clock.advance(0.5)
+        d = self.writer.writing
+        d.addCallback(lambda _: self.assertEqual(
+                (self.written, self.writer.writes, self.writer.requests),
+                ([range(100)], 1, 100)))
+        return d
+
+    def test_flush(self):
+        """
+        Flushing writes the queued changes without waiting for the
+        delay.
+        """
+        self.writer.schedule('change')
+        d = self.writer.flush()
+        d.addCallback(lambda _: self.assertEqual(self.written,
+                                                 [['change']]))
+        return d
+
+    def test_flushNothing(self):
+        """
+        Flushing without queued changes does not write.
+        """
+        d = self.writer.flush()
+        self.assertEqual(self.written, [])
+        return d
+
+    def test_flushOrder(self):
+        """
+        Flushes requested while a batch is written fire after those
+        waiting for the batch.
+        """
+        fired = []
+        self.writer.schedule('change')
+        first = self.writer.flush()
+        first.addCallback(lambda _: fired.append('first'))
+        second = self.writer.flush()
+        second.addCallback(lambda _: fired.append('second'))
+        d = defer.gatherResults([first, second])
+        d.addCallback(lambda _: self.assertEqual(fired,
+                                                 ['first', 'second']))
+        return d
+
+    def test_queuedWhileWriting(self):
+        """
+        Changes queued while a batch is written go in the next batch.
+        """
+        self.writer.schedule(1)
+        d = self.writer.flush()
+        self.writer.schedule(2)
+        d.addCallback(lambda _: self.writer.flush())
+        d.addCallback(lambda _: self.assertEqual(self.written,
+                                                 [[1], [2]]))
+        return d
+
+    @defer.inlineCallbacks
+    def test_retryFailed(self):
+        """
+        A batch that fails to be written is logged and written again,
+        together with the changes made since, after a delay.
+        """
+        self.failing = 1
+        self.writer.schedule(1)
+        yield self.assertFailure(self.writer.flush(), WriteFailed)
+        self.assertEqual(len(self.flushLoggedErrors(WriteFailed)), 1)
+        self.assertEqual(self.writer.failures, 1)
+        self.writer.schedule(2)
+        self.clock.advance(0.5)
+        self.assertIdentical(self.writer.writing, None)
+        self.clock.advance(0.5)
+        yield self.writer.writing
+        self.assertEqual(self.written, [[1, 2]])
+        self.assertEqual(self.writer.failures, 0)
+
+    @defer.inlineCallbacks
+    def test_retryBackoff(self):
+        """
+        The retry delay doubles with every failure in a row, up to
+        C{maxRetryDelay}.
+        """
+        self.failing = 10
+        self.writer.schedule(1)
+        yield self.assertFailure(self.writer.flush(), WriteFailed)
+        delays = []
+        while self.failing:
+            call = self.writer.delayedCall
+            delays.append(call.getTime() - self.clock.seconds())
+            self.clock.advance(delays[-1])
+            try:
+                yield self.writer.writing
+            except WriteFailed:
+                pass
+        self.flushLoggedErrors(WriteFailed)
+        self.assertEqual(delays, [1, 2, 4, 8, 16, 32, 60, 60, 60])
@@ -0,0 +1,87 @@
+# This file is part of Friendly.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Startup timeline.
+
+Records how long the phases of application startup take.  The
+timeline is always recorded since it is cheap; it is only reported
+when the C{FRIENDLY_STARTUP_TIMELINE} environment variable is set.
+
+This module must not import anything heavy, since it is imported
+before everything else.
+"""
+
+import os, time
+
+
+class Timeline(object):
+    """
+    A list of named phases with their start offsets and durations,
+    in seconds.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.origin = clock()
+        self.started = dict()
+        self.phases = list()
+        self.enabled = 'FRIENDLY_STARTUP_TIMELINE' in os.environ
+
+    def begin(self, name):
+        """
+        Mark the start of phase C{name}.
+        """
+        self.started[name] = self.clock()
+
+    def end(self, name):
+        """
+        Mark the end of phase C{name}.
+        """
+        start = self.started.pop(name, None)
+        if start is None:
+            return
+        self.phases.append((name, start - self.origin,
+                            self.clock() - start))
+
+    def report(self):
+        """
+        Return the recorded phases as a list of C{(name, start,
+        duration)} tuples.
+        """
+        return list(self.phases)
+
+    def format(self):
+        """
+        Return the recorded phases as a human readable string.
+        """
+        lines = ['%-40s %12s %12s' % ('phase', 'start', 'duration')]
+        for name, start, duration in self.phases:
+            lines.append('%-40s %9.1f ms %9.1f ms'
+                         % (name, start * 1000, duration * 1000))
+        return '\n'.join(lines)
+
+
+startupTimeline = Timeline()
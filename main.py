@@ -22,23 +22,41 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import os
+
+from friendly.timeline import startupTimeline as timeline
+
+timeline.begin('reactor install')
 from twisted.internet._threadedselect import install
 reactor = install()
+timeline.end('reactor install')
 
+timeline.begin('import frameworks')
 from PyObjCTools import AppHelper
 
-import Automator
 import BWToolkitFramework
 import Foundation
 import AppKit
 import MGScopeBar
 import objc
+timeline.end('import frameworks')
 
 # import modules containing classes required to start application and
-# load MainMenu.nib:
-from friendly import app, master, account, contacts
+# load MainMenu.nib.  the modules for the other windows are imported
+# when the windows are first opened.
+timeline.begin('import friendly')
+from friendly import app, master
+timeline.end('import friendly')
 
 # pass control to AppKit
-reactor.interleave(AppHelper.callAfter)
+waker = AppHelper.callAfter
+if 'FRIENDLY_STALL_THRESHOLD' in os.environ:
+    from friendly.stalls import StallMonitor
+    stallMonitor = StallMonitor(float(os.environ['FRIENDLY_STALL_THRESHOLD']))
+    stallMonitor.instrument(reactor)
+    stallMonitor.startWatchdog()
+    waker = stallMonitor.wrap(waker)
+reactor.interleave(waker)
 reactor.addSystemEventTrigger('after', 'shutdown', AppHelper.stopEventLoop)
+timeline.begin('first window')
 AppHelper.runEventLoop()